@@ -8,7 +8,23 @@ import json
 import logging
 import sqlite3
 import shutil
-from flask import Flask, request, jsonify, g
+import hashlib
+import signal
+import socket
+import sys
+import re
+import resource
+import fcntl
+import contextlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify
+
+try:
+    import prometheus_client
+except ImportError:  # /metrics is disabled without it
+    prometheus_client = None
 
 app = Flask(__name__)
 
@@ -19,22 +35,178 @@ R2_ACCESS_KEY = os.environ.get("R2_ACCESS_KEY")
 R2_SECRET_KEY = os.environ.get("R2_SECRET_KEY")
 R2_BUCKET = os.environ.get("R2_BUCKET")
 R2_PUBLIC_URL = os.environ.get("R2_PUBLIC_URL", "https://pub-879b72d29274423bab4fd53b5946501d.r2.dev")
-DB_PATH = "/tmp/jobs.db"  # Use /tmp as it is likely writable and preserved on worker restart (but not deploy)
+# R2 transfer tuning (sizes in MB); the client and its connection pool are shared process-wide
+R2_MAX_POOL_CONNECTIONS = int(os.environ.get("R2_MAX_POOL_CONNECTIONS", "10"))
+R2_MULTIPART_THRESHOLD = int(os.environ.get("R2_MULTIPART_THRESHOLD_MB", "16")) * 1024 * 1024
+R2_MULTIPART_CHUNKSIZE = max(int(os.environ.get("R2_MULTIPART_CHUNK_MB", "8")), 5) * 1024 * 1024  # S3 minimum part is 5MB
+R2_MAX_CONCURRENCY = int(os.environ.get("R2_MAX_CONCURRENCY", "4"))
+# Upload fragmented MP4 parts while ffmpeg is still encoding
+R2_STREAMING_UPLOAD = os.environ.get("R2_STREAMING_UPLOAD", "false").lower() == "true"
+# "output": "hls" jobs: target segment length; each segment is uploaded as soon as ffmpeg closes it
+HLS_SEGMENT_SECONDS = float(os.environ.get("HLS_SEGMENT_SECONDS", "4"))
+# OS-level limits for every ffmpeg child (0 / empty = not set). The memory limit caps address space
+# (RLIMIT_AS), which runs well above RSS with many encoder threads; a CPU-limited child is stopped once it has used that much CPU.
+FFMPEG_NICE = int(os.environ.get("FFMPEG_NICE", "0"))
+FFMPEG_IONICE_CLASS = os.environ.get("FFMPEG_IONICE_CLASS", "")  # best-effort or idle
+FFMPEG_IONICE_LEVEL = int(os.environ.get("FFMPEG_IONICE_LEVEL", "4"))  # 0 (highest) - 7, for best-effort
+FFMPEG_MEMORY_LIMIT_MB = int(os.environ.get("FFMPEG_MEMORY_LIMIT_MB", "0"))
+FFMPEG_CPU_LIMIT_SECONDS = int(os.environ.get("FFMPEG_CPU_LIMIT_SECONDS", "0"))
+STATS_DEFAULT_WINDOW_SECONDS = 86400  # GET /stats without ?since covers the last day
+# Segment-parallel encoding for long re-encodes (add-subtitles).
+# SEGMENT_PARALLELISM=0 derives the segment count from the cores each pool slot gets.
+SEGMENT_PARALLELISM = int(os.environ.get("SEGMENT_PARALLELISM", "0"))
+SEGMENT_MIN_DURATION = float(os.environ.get("SEGMENT_MIN_DURATION", "60"))  # Shorter videos encode in one process
+# Minimum seconds between progress writes to SQLite for a single job
+PROGRESS_UPDATE_INTERVAL = float(os.environ.get("PROGRESS_UPDATE_INTERVAL", "2"))
+# Completion delivery: long-poll cap, SSE keepalive, and webhook retries
+MAX_LONG_POLL_SECONDS = int(os.environ.get("MAX_LONG_POLL_SECONDS", "60"))
+SSE_KEEPALIVE_SECONDS = 15
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get("CALLBACK_MAX_ATTEMPTS", "5"))
+CALLBACK_TIMEOUT = 10
+DB_PATH = os.environ.get("DB_PATH", "/tmp/jobs.db")  # Use /tmp as it is likely writable and preserved on worker restart (but not deploy)
+DB_BUSY_TIMEOUT_MS = 30000
+# Finished jobs older than this are deleted by the retention sweeper (0 keeps them forever)
+JOB_RETENTION_SECONDS = float(os.environ.get("JOB_RETENTION_HOURS", "72")) * 3600
+RETENTION_SWEEP_INTERVAL = 600
+
+# Worker pool sizing: 0 means derive from CPU count and memory budget
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "0"))
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", "256"))  # Koyeb nano instance
+JOB_MEMORY_MB = int(os.environ.get("JOB_MEMORY_MB", "160"))  # Rough peak of one libx264 encode
+QUEUE_POLL_INTERVAL = float(os.environ.get("QUEUE_POLL_INTERVAL", "2"))  # Seconds between queue scans when idle
+# Jobs interrupted by a worker crash are requeued until they have been started this many times
+MAX_JOB_ATTEMPTS = int(os.environ.get("MAX_JOB_ATTEMPTS", "3"))
+# Run the pool inside the web process. Set to false when jobs are run by `python -m app worker`
+# processes (or containers sharing DB_PATH's volume), so the API only enqueues and reports.
+EMBEDDED_WORKERS = os.environ.get("EMBEDDED_WORKERS", "true").lower() == "true"
+# A running job's lease is renewed every JOB_LEASE_SECONDS / 3; once it lapses, any worker requeues the job
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "60"))
+DEFAULT_JOB_SECONDS = 60  # Used for ETA until we have completed jobs to average
+CANCEL_POLL_INTERVAL = 1.0  # How often workers look for DELETE /tasks/<id> requests made in another process
+
+# Admission control: a queued job starts only when its estimated scratch disk and memory fit
+# next to the running jobs (a job always starts on an idle instance). Younger jobs may pass one
+# that doesn't fit until it has waited ADMISSION_MAX_DEFER_SECONDS; then it goes next.
+ADMISSION_REJECT = os.environ.get("ADMISSION_REJECT", "false").lower() == "true"  # 429 instead of queueing
+ADMISSION_MAX_DEFER_SECONDS = float(os.environ.get("ADMISSION_MAX_DEFER_SECONDS", "300"))
+DISK_HEADROOM_MB = int(os.environ.get("DISK_HEADROOM_MB", "100"))  # Free space never handed out to jobs
+FFMPEG_BASE_MEMORY_MB = 40  # One ffmpeg process with its demuxers and decoders, before encoder buffers
+DEFAULT_INPUT_MB = 50  # Assumed size of an input whose server sends no Content-Length
+# Scratch disk of a job as a multiple of its inputs' size: downloads, intermediates and output
+SCRATCH_DISK_FACTORS = {"logic_concat": 2.0, "logic_merge_audio": 2.0, "logic_add_subtitles": 3.0, "logic_pipeline": 2.0}
+# Optional tmpfs scratch area (e.g. /dev/shm/ffmpeg_work) for jobs needing at most TMPFS_MAX_JOB_MB.
+# tmpfs pages are RAM, so those jobs reserve their scratch size from MEMORY_BUDGET_MB as well.
+SCRATCH_TMPFS_DIR = os.environ.get("SCRATCH_TMPFS_DIR", "")
+TMPFS_MAX_JOB_MB = int(os.environ.get("TMPFS_MAX_JOB_MB", "64"))
+
+# Encode settings for libx264 re-encodes, picked per request with "profile"; part of the request fingerprint
+X264_PRESET = os.environ.get("X264_PRESET", "medium")
+X264_CRF = os.environ.get("X264_CRF", "23")
+AUDIO_BITRATE = "128k"
+ENCODE_PROFILES = {
+    # gop is the max keyframe interval in frames, lookahead the rc-lookahead depth (frames buffered per encode)
+    "fast": {"preset": "veryfast", "crf": "26", "tune": None, "gop": 250, "lookahead": 10},
+    "balanced": {"preset": X264_PRESET, "crf": X264_CRF, "tune": None, "gop": 250, "lookahead": 40},
+    "quality": {"preset": "slow", "crf": "20", "tune": "film", "gop": 250, "lookahead": 60},
+}
+DEFAULT_ENCODE_PROFILE = os.environ.get("ENCODE_PROFILE", "balanced")
+# Cores shared by all libx264 processes of this instance, split between running jobs (0 = all CPUs)
+X264_THREAD_BUDGET = int(os.environ.get("X264_THREAD_BUDGET", "0")) or os.cpu_count() or 1
+
+# Input fetching: per-job parallel downloads, bounded by a process-wide connection limit
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "4"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "8"))
+
+# Trim straight from seekable MP4 URLs with HTTP Range requests instead of downloading whole clips
+PARTIAL_FETCH_ENABLED = os.environ.get("PARTIAL_FETCH_ENABLED", "true").lower() == "true"
+
+# ffprobe of input URLs: LRU of results keyed by URL + ETag/Last-Modified, and checks run at submit
+# so unreadable inputs, missing streams or oversized video are rejected before taking a worker slot
+PROBE_CACHE_SIZE = int(os.environ.get("PROBE_CACHE_SIZE", "256"))
+PROBE_VALIDATION = os.environ.get("PROBE_VALIDATION", "true").lower() == "true"
+PROBE_MAX_URLS = int(os.environ.get("PROBE_MAX_URLS", "50"))  # Per POST /probe
+# Per input URL probe inside an HTTP request; a source slower than this is left for the worker to find out
+PROBE_TIMEOUT_SECONDS = float(os.environ.get("PROBE_TIMEOUT_SECONDS", "8"))
+MAX_INPUT_PIXELS = int(os.environ.get("MAX_INPUT_PIXELS", "0"))  # Largest accepted width*height (0 = no limit)
+
+# Shared input cache; set DOWNLOAD_CACHE_MAX_MB=0 to disable
+DOWNLOAD_CACHE_DIR = os.environ.get("DOWNLOAD_CACHE_DIR", "/tmp/ffmpeg_cache")
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get("DOWNLOAD_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+# merge-audio inputs are transcoded once to AAC at AUDIO_BITRATE / AUDIO_ASSET_SAMPLE_RATE (optionally
+# loudness-normalized) and kept, keyed by URL + ETag/Last-Modified, so merges stream-copy both tracks.
+# Set AUDIO_ASSET_CACHE_MAX_MB=0 to transcode per job without keeping the result.
+AUDIO_ASSET_DIR = os.environ.get("AUDIO_ASSET_DIR", "/tmp/ffmpeg_audio_assets")
+AUDIO_ASSET_CACHE_MAX_BYTES = int(os.environ.get("AUDIO_ASSET_CACHE_MAX_MB", "256")) * 1024 * 1024
+AUDIO_ASSET_SAMPLE_RATE = int(os.environ.get("AUDIO_ASSET_SAMPLE_RATE", "48000"))
+AUDIO_LOUDNORM = os.environ.get("AUDIO_LOUDNORM", "false").lower() == "true"  # EBU R128, -16 LUFS
+
+# POST /batch: max jobs per request, and how long inputs shared by a batch are kept out of cache eviction
+BATCH_MAX_JOBS = int(os.environ.get("BATCH_MAX_JOBS", "500"))
+BATCH_PIN_SECONDS = float(os.environ.get("BATCH_PIN_SECONDS", "3600"))
+
+# Job chaining: outputs read by dependent jobs (job:<id> inputs) are kept here instead of uploaded.
+# Must be shared by all worker processes, like DB_PATH. Outputs kept for a job nobody references
+# yet (intermediate: true) are deleted after ARTIFACT_TTL_SECONDS.
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", "/tmp/ffmpeg_artifacts")
+ARTIFACT_TTL_SECONDS = float(os.environ.get("ARTIFACT_TTL_SECONDS", "3600"))
+
+# Per-job scratch directories live under this root
+WORK_ROOT = "/tmp/ffmpeg_work"
+
+# Prometheus metrics on /metrics (needs prometheus_client). Under several gunicorn workers,
+# set PROMETHEUS_MULTIPROC_DIR to a shared, empty directory so every worker's samples are merged.
+METRICS_ENABLED = prometheus_client is not None and os.environ.get("METRICS_ENABLED", "true").lower() == "true"
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Database Setup ---
-def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
-    return db
+# Each thread keeps one connection for its lifetime: no reconnect per query, and
+# sqlite3's per-connection statement cache keeps the hot queries prepared.
+# WAL lets /tasks readers proceed while worker threads write.
+
+_db_local = threading.local()
+
+def get_conn():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous = NORMAL")  # Durable enough under WAL, far fewer fsyncs
+        _db_local.conn = conn
+    return conn
+
+JOB_EXTRA_COLUMNS = {
+    "params": "TEXT",       # JSON kwargs for the logic function, so queued jobs survive restarts
+    "started_at": "REAL",
+    "fingerprint": "TEXT",  # Hash of the request, used to answer retries with the existing job
+    "progress": "TEXT",     # JSON: stage, percent, speed, eta of the running job
+    "callback_url": "TEXT", # Single webhook of jobs created before callback_urls
+    "attempts": "INTEGER DEFAULT 0",  # Times a worker has started the job
+    "worker_pid": "INTEGER",  # Process running the job, to spot jobs orphaned by a crash
+    "worker_host": "TEXT",    # Host (container) of that process; pids are only comparable on the same one
+    "lease_expires_at": "REAL",  # Renewed by the worker's heartbeat while it runs the job
+    "checkpoint": "TEXT",   # JSON: stage -> files (or URL) a previous attempt already produced
+    "resources": "TEXT",    # JSON: estimated disk/memory bytes, and the scratch root picked at admission
+    "intermediate": "INTEGER DEFAULT 0",  # Keep the output for dependent jobs instead of uploading it
+    "artifact": "TEXT",     # Path of the kept output in ARTIFACT_DIR until no pending job reads it
+    "priority": "INTEGER DEFAULT 0",  # Higher runs first; equal priorities run in submission order
+    "deadline": "REAL",     # Dropped (cancelled) if still waiting or queued at this time
+    "cancel_requested": "REAL",  # When DELETE /tasks/<id> asked the job's worker to stop it
+    "usage": "TEXT",        # JSON: CPU, peak RSS, wall time and bytes written by its ffmpeg runs, per stage
+    "callback_urls": "TEXT",  # JSON list: the callback_url of every request sharing the job, each POSTed the final record
+    "submitters": "INTEGER DEFAULT 1",  # Requests sharing the job; DELETE only cancels it for the last one
+}
+
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
 
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
+    conn = get_conn()
+    conn.execute("PRAGMA journal_mode = WAL")  # Persistent: recorded in the database file
+    with conn:
         conn.execute('''
             CREATE TABLE IF NOT EXISTS jobs (
                 id TEXT PRIMARY KEY,
@@ -46,12 +218,60 @@ def init_db():
                 error TEXT
             )
         ''')
-
-@app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+        # Columns added after the first release; older /tmp/jobs.db files lack them
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, ddl in JOB_EXTRA_COLUMNS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {ddl}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_fingerprint ON jobs (fingerprint)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_type ON jobs (type)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_priority ON jobs (status, priority DESC, created_at)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS download_cache (
+                url TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER,
+                last_used REAL
+            )
+        ''')
+        if "pinned_until" not in {row[1] for row in conn.execute("PRAGMA table_info(download_cache)")}:
+            # Inputs shared by a pending batch; eviction skips them until this time
+            conn.execute("ALTER TABLE download_cache ADD COLUMN pinned_until REAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS batch_jobs (
+                batch_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                job_id TEXT NOT NULL,
+                PRIMARY KEY (batch_id, position)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS audio_assets (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER,
+                last_used REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS job_dependencies (
+                job_id TEXT NOT NULL,
+                parent_id TEXT NOT NULL,
+                PRIMARY KEY (job_id, parent_id)
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_job_dependencies_parent ON job_dependencies (parent_id)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS prefetching (
+                url TEXT PRIMARY KEY,
+                expires_at REAL NOT NULL
+            )
+        ''')
 
 # Initialize DB on startup
 try:
@@ -64,7 +284,7 @@ except Exception as e:
 def update_job(job_id, status, result=None, error=None):
     """Updates job status in SQLite"""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with get_conn() as conn:
             update_fields = ["status = ?", "updated_at = ?"]
             params = [status, time.time()]
             
@@ -83,47 +303,695 @@ def update_job(job_id, status, result=None, error=None):
             logger.info(f"Job {job_id} updated to {status}")
     except Exception as e:
         logger.error(f"Failed to update job {job_id}: {e}")
+        return
+    notify_job_changed()
+    if status in TERMINAL_STATUSES:
+        settle_finished_job(job_id, status, error)
+
+def settle_finished_job(job_id, status, error=None):
+    """
+    Follow-up to a job reaching a terminal status: its metrics, its webhook, its dependents,
+    outputs nothing reads any more. Paths that set the status without update_job call it too.
+    """
+    count_finished_job(job_id, status, error)
+    schedule_callback(job_id)
+    settle_dependents(job_id, status)
+    collect_artifacts()
+
+def decode_job(row):
+    """Row -> dict with the JSON columns parsed"""
+    job = dict(row)
+    for field in ('result', 'progress', 'usage'):
+        if job.get(field):
+            try:
+                job[field] = json.loads(job[field])
+            except:
+                pass
+    return job
 
 def get_job_from_db(job_id):
     """Retrieves job from SQLite"""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
-            row = cur.fetchone()
-            if row:
-                job = dict(row)
-                if job['result']:
-                    try:
-                        job['result'] = json.loads(job['result'])
-                    except:
-                        pass
-                return job
-            return None
+        row = get_conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return decode_job(row) if row else None
     except Exception as e:
         logger.error(f"Failed to get job {job_id}: {e}")
         return None
 
-def run_ffmpeg(cmd, timeout=300, job_id=None):
+def get_batch_jobs(batch_id):
+    """Jobs of a batch in submission order (empty for an unknown batch)"""
+    try:
+        rows = get_conn().execute(
+            "SELECT jobs.* FROM batch_jobs JOIN jobs ON jobs.id = batch_jobs.job_id "
+            "WHERE batch_jobs.batch_id = ? ORDER BY batch_jobs.position",
+            (batch_id,)
+        ).fetchall()
+        return [decode_job(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Failed to get batch {batch_id}: {e}")
+        return []
+
+def list_jobs(statuses=None, since=None, limit=50, cursor=None):
+    """
+    Jobs in creation order, optionally filtered by status and created_at >= since.
+    `cursor` is the (created_at, rowid) of the last job of the previous page.
+    """
+    clauses, params = [], []
+    if statuses:
+        clauses.append(f"status IN ({', '.join('?' for _ in statuses)})")
+        params.extend(statuses)
+    if since is not None:
+        clauses.append("created_at >= ?")
+        params.append(since)
+    if cursor:
+        clauses.append("(created_at > ? OR (created_at = ? AND rowid > ?))")
+        params.extend([cursor[0], cursor[0], cursor[1]])
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    rows = get_conn().execute(
+        f"SELECT rowid AS _rowid, * FROM jobs {where} ORDER BY created_at, rowid LIMIT ?",
+        params + [limit]
+    ).fetchall()
+    jobs = [decode_job(row) for row in rows]
+    next_cursor = f"{jobs[-1]['created_at']}:{jobs[-1]['_rowid']}" if len(jobs) == limit else None
+    for job in jobs:
+        job.pop('_rowid')
+    return jobs, next_cursor
+
+def sweep_expired_jobs():
+    """Deletes finished jobs past the retention window so jobs.db doesn't grow without bound"""
+    if JOB_RETENTION_SECONDS <= 0:
+        return 0
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    placeholders = ', '.join('?' for _ in TERMINAL_STATUSES)
+    with get_conn() as conn:
+        for (artifact,) in conn.execute(
+            f"SELECT artifact FROM jobs WHERE status IN ({placeholders}) AND updated_at < ? AND artifact IS NOT NULL",
+            (*TERMINAL_STATUSES, cutoff)
+        ).fetchall():
+            if os.path.exists(artifact):
+                os.remove(artifact)
+        deleted = conn.execute(
+            f"DELETE FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?",
+            (*TERMINAL_STATUSES, cutoff)
+        ).rowcount
+        conn.execute("DELETE FROM batch_jobs WHERE job_id NOT IN (SELECT id FROM jobs)")
+        conn.execute("DELETE FROM job_dependencies WHERE job_id NOT IN (SELECT id FROM jobs)")
+    if deleted:
+        logger.info(f"Retention sweep removed {deleted} job(s)")
+    return deleted
+
+def retention_sweeper():
+    while True:
+        try:
+            sweep_expired_jobs()
+        except Exception as e:
+            logger.error(f"Retention sweep failed: {e}")
+        collect_artifacts()
+        time.sleep(RETENTION_SWEEP_INTERVAL)
+
+# --- Progress Reporting ---
+# ffmpeg's -progress output is parsed as it runs; writes to SQLite are coalesced
+# so a job touches its row at most once per PROGRESS_UPDATE_INTERVAL.
+
+_progress_last_write = {}
+_progress_lock = threading.Lock()
+_stage_clock = {}  # job_id -> (stage, started_at), timed into the job's "timings" stats
+
+def set_job_progress(job_id, progress, force=False):
+    """Stores the latest progress snapshot, dropping writes that come too soon after the previous one"""
+    if job_id is None:
+        return
+    now = time.time()
+    with _progress_lock:
+        if not force and now - _progress_last_write.get(job_id, 0) < PROGRESS_UPDATE_INTERVAL:
+            return
+        _progress_last_write[job_id] = now
+    try:
+        with get_conn() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(dict(progress, updated_at=now)), now, job_id)
+            )
+    except Exception as e:
+        logger.error(f"Failed to store progress for job {job_id}: {e}")
+        return
+    notify_job_changed()
+
+def mark_stage(job_id, stage):
+    """Adds the wall time of the job's current stage to its timings and starts timing `stage` (None stops)"""
+    if job_id is None:
+        return
+    now = time.time()
+    with _progress_lock:
+        previous = _stage_clock.get(job_id)
+        if previous and previous[0] == stage:
+            return
+        if stage:
+            _stage_clock[job_id] = (stage, now)
+        else:
+            _stage_clock.pop(job_id, None)
+    if previous:
+        record_job_stat(job_id, 'timings', f"{previous[0]}_seconds", round(now - previous[1], 3))
+
+def set_job_stage(job_id, stage):
+    """Marks the start of a stage that has no ffmpeg progress of its own (download, upload)"""
+    mark_stage(job_id, stage)
+    set_job_progress(job_id, {"stage": stage}, force=True)
+
+def clear_job_progress(job_id):
+    with _progress_lock:
+        _progress_last_write.pop(job_id, None)
+        _stage_clock.pop(job_id, None)
+
+_encode_speed = None  # Moving average of libx264 speed (media seconds per wall second)
+
+def note_encode_speed(speed):
+    global _encode_speed
+    if speed:
+        _encode_speed = speed if _encode_speed is None else 0.8 * _encode_speed + 0.2 * speed
+
+def estimate_encode_seconds(duration):
+    """How long a full re-encode of `duration` media seconds would take at the recent speed"""
+    return duration / (_encode_speed or 1.0)
+
+if DEFAULT_ENCODE_PROFILE not in ENCODE_PROFILES:
+    logger.warning(f"Unknown ENCODE_PROFILE {DEFAULT_ENCODE_PROFILE!r}, using 'balanced'")
+    DEFAULT_ENCODE_PROFILE = "balanced"
+
+def encode_threads(share=1):
+    """
+    libx264 threads for one encoder process: the thread budget split between the jobs
+    running on this host (in every worker process, as counted by reserved_resources),
+    then between the `share` encoders a job runs at once
+    """
+    try:
+        running = get_conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'processing' AND (worker_host = ? OR worker_host IS NULL)",
+            (HOSTNAME,)
+        ).fetchone()[0]
+    except Exception as e:
+        logger.error(f"Failed to count running jobs: {e}")
+        running = WORKER_POOL_SIZE
+    return max(1, X264_THREAD_BUDGET // max(running, 1) // share)
+
+def x264_args(profile, threads, job_id=None):
+    """
+    Output options for a libx264 encode with the named profile and an explicit thread count.
+    A job admitted with a shorter lookahead than its profile's (see estimate_job_resources) gets that one.
+    """
+    settings = ENCODE_PROFILES[profile]
+    lookahead = settings["lookahead"]
+    if _lookahead_caps.get(job_id) is not None:
+        lookahead = min(lookahead, _lookahead_caps[job_id])
+    args = ["-c:v", "libx264", "-preset", settings["preset"], "-crf", settings["crf"]]
+    if settings["tune"]:
+        args += ["-tune", settings["tune"]]
+    args += [
+        "-threads", str(threads),
+        "-x264-params", f"keyint={settings['gop']}:rc-lookahead={lookahead}",
+    ]
+    return args
+
+def probe_duration(path):
+    """Container duration in seconds via ffprobe, or None if it can't be read"""
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", path],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30, text=True
+        )
+        return float(result.stdout.strip())
+    except Exception:
+        return None
+
+def _expected_duration(cmd):
+    """Output duration implied by a command: its -t, else the duration of its first local input"""
+    t_positions = [i for i, arg in enumerate(cmd) if arg == "-t"]
+    if t_positions:
+        try:
+            return float(cmd[t_positions[-1] + 1])
+        except (IndexError, ValueError):
+            pass
+    if "-i" in cmd and "concat" not in cmd:
+        source = cmd[cmd.index("-i") + 1]
+        if os.path.isfile(source):
+            return probe_duration(source)
+    return None
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None  # ffmpeg reports N/A before the first frame
+
+def _progress_snapshot(fields, stage, duration, started):
+    # out_time_ms is actually microseconds in ffmpeg's progress output, same as out_time_us
+    out_time = (_to_float(fields.get("out_time_us") or fields.get("out_time_ms")) or 0) / 1_000_000
+    speed = _to_float(fields.get("speed", "").rstrip("x"))
+    total_size = _to_float(fields.get("total_size"))
+    snapshot = {
+        "stage": stage,
+        "out_time": round(out_time, 2),
+        "fps": _to_float(fields.get("fps")),
+        "speed": speed,
+        "total_size": int(total_size) if total_size is not None else None,
+        "elapsed": round(time.time() - started, 1),
+    }
+    if duration:
+        snapshot["percent"] = round(min(out_time / duration, 1.0) * 100, 1)
+        if speed:
+            snapshot["eta_seconds"] = round(max(duration - out_time, 0) / speed, 1)
+    return snapshot
+
+# --- Completion Delivery ---
+# Long-poll and SSE readers wait on a condition that every job write notifies.
+# They also re-read SQLite at least once a second, so writes from another process are seen too.
+
+_job_changed = threading.Condition()
+
+def notify_job_changed():
+    with _job_changed:
+        _job_changed.notify_all()
+
+def wait_for_job_change(job_id, seen, timeout):
+    """
+    Blocks until the job's state differs from `seen` (a value of job_state) or timeout passes.
+    Returns the latest job record.
+    """
+    deadline = time.time() + timeout
+    job = get_job_from_db(job_id)
+    while job and job_state(job) == seen:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        with _job_changed:
+            _job_changed.wait(min(remaining, 1.0))
+        job = get_job_from_db(job_id)
+    return job
+
+def job_state(job):
+    progress = job.get('progress') or {}
+    return job['status'], progress.get('updated_at') if isinstance(progress, dict) else None
+
+def job_view(job, queue_info=True):
+    """The public shape of a job, shared by /tasks, SSE events and webhooks"""
+    job = dict(job)
+    for internal in ('params', 'callback_url', 'callback_urls', 'worker_pid', 'worker_host', 'lease_expires_at', 'checkpoint',
+                     'resources', 'intermediate', 'artifact', 'submitters'):
+        job.pop(internal, None)
+    if queue_info and job['status'] == 'queued':
+        job.update(get_queue_info(job))
+    return job
+
+def callback_urls(job):
+    """Webhooks of a job: one per request that resolved to it (a deduplicated retry adds its own)"""
+    urls = json.loads(job.get('callback_urls') or '[]')
+    if job.get('callback_url') and job['callback_url'] not in urls:
+        urls.insert(0, job['callback_url'])
+    return urls
+
+_callback_threads = set()  # Deliveries in flight, which a stopping worker waits for
+_callback_threads_lock = threading.Lock()
+
+def schedule_callback(job_id, urls=None):
+    """Delivers the job's final record to `urls` (default: all its webhooks), one thread per URL"""
+    if urls is None:
+        job = get_job_from_db(job_id)
+        urls = callback_urls(job) if job else []
+    for url in urls:
+        thread = threading.Thread(target=deliver_callback, args=(job_id, url), name=f"callback-{job_id}")
+        thread.daemon = True
+        with _callback_threads_lock:
+            _callback_threads.add(thread)
+        thread.start()
+
+def pending_callbacks():
+    with _callback_threads_lock:
+        return [thread for thread in _callback_threads if thread.is_alive()]
+
+def deliver_callback(job_id, url):
+    """POSTs the final job record to url, retrying with exponential backoff"""
+    try:
+        _deliver_callback(job_id, url)
+    finally:
+        with _callback_threads_lock:
+            _callback_threads.discard(threading.current_thread())
+
+def _deliver_callback(job_id, url):
+    job = get_job_from_db(job_id)
+    if not job:
+        return
+    payload = job_view(job)
+    for attempt in range(1, CALLBACK_MAX_ATTEMPTS + 1):
+        try:
+            r = HTTP_SESSION.post(url, json=payload, timeout=CALLBACK_TIMEOUT)
+            if r.ok:
+                logger.info(f"Callback for job {job_id} to {url} delivered (HTTP {r.status_code})")
+                return
+            # 4xx is retried too: an n8n resume URL 404s until the execution reaches its Wait node
+            error = f"HTTP {r.status_code}"
+        except Exception as e:
+            error = str(e)
+        logger.warning(f"Callback for job {job_id} to {url} failed (attempt {attempt}/{CALLBACK_MAX_ATTEMPTS}): {error}")
+        if attempt < CALLBACK_MAX_ATTEMPTS:
+            time.sleep(2 ** attempt)
+    logger.error(f"Giving up on callback for job {job_id} to {url}")
+
+# --- Process Limits and Accounting ---
+# Limits are applied to each ffmpeg child right after it starts, from this process (a preexec
+# hook could deadlock in the forked child of a threaded server). Nice and I/O priority are
+# per thread on Linux, so they are set on every thread ffmpeg has by then; threads it creates
+# later inherit them. The child's rusage comes from wait4 when it is reaped.
+
+IOPRIO_CLASSES = {"best-effort": 2, "idle": 3}
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "aarch64": 30, "armv7l": 314, "i686": 289}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+_ioprio_warned = False
+
+def set_io_priority(tid, ioprio):
+    global _ioprio_warned
+    import ctypes
+    import platform
+
+    number = IOPRIO_SET_SYSCALLS.get(platform.machine())
+    if number is None or ctypes.CDLL(None, use_errno=True).syscall(number, IOPRIO_WHO_PROCESS, tid, ioprio) != 0:
+        if not _ioprio_warned:
+            _ioprio_warned = True
+            logger.warning(f"Could not set I/O priority of ffmpeg (errno {ctypes.get_errno()}), ignoring "
+                           f"FFMPEG_IONICE_CLASS")
+
+def limit_process(pid):
+    """Applies FFMPEG_NICE, FFMPEG_IONICE_* and the rlimits to a freshly started child"""
+    try:
+        if FFMPEG_MEMORY_LIMIT_MB > 0:
+            limit = FFMPEG_MEMORY_LIMIT_MB * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_AS, (limit, limit))
+        if FFMPEG_CPU_LIMIT_SECONDS > 0:
+            resource.prlimit(pid, resource.RLIMIT_CPU, (FFMPEG_CPU_LIMIT_SECONDS, FFMPEG_CPU_LIMIT_SECONDS + 5))
+        if FFMPEG_NICE or FFMPEG_IONICE_CLASS in IOPRIO_CLASSES:
+            ioprio = None
+            if FFMPEG_IONICE_CLASS in IOPRIO_CLASSES:
+                level = FFMPEG_IONICE_LEVEL if FFMPEG_IONICE_CLASS == "best-effort" else 0
+                ioprio = IOPRIO_CLASSES[FFMPEG_IONICE_CLASS] << IOPRIO_CLASS_SHIFT | level
+            for tid in (int(name) for name in os.listdir(f"/proc/{pid}/task")):
+                if FFMPEG_NICE:
+                    os.setpriority(os.PRIO_PROCESS, tid, FFMPEG_NICE)
+                if ioprio is not None:
+                    set_io_priority(tid, ioprio)
+    except (ProcessLookupError, FileNotFoundError):
+        pass  # Exited already
+    except OSError as e:
+        logger.warning(f"Could not limit ffmpeg process {pid}: {e}")
+
+if FFMPEG_IONICE_CLASS and FFMPEG_IONICE_CLASS not in IOPRIO_CLASSES:
+    logger.warning(f"Unknown FFMPEG_IONICE_CLASS {FFMPEG_IONICE_CLASS!r}, expected one of {list(IOPRIO_CLASSES)}")
+
+USAGE_METRICS = ("cpu_seconds", "max_rss_mb", "wall_seconds", "written_mb")
+
+def record_usage(job_id, stage, rusage, wall_seconds):
+    """Adds one ffmpeg run's rusage to the job's usage, under its stage and the job total"""
+    if job_id is None:
+        return
+    run = {
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime,
+        "max_rss_mb": rusage.ru_maxrss / 1024,  # KiB on Linux
+        "wall_seconds": wall_seconds,
+        "written_mb": rusage.ru_oublock * 512 / 1024 / 1024,  # Block writes, so tmpfs scratch reads 0
+    }
+    try:
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT usage FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            usage = json.loads(row[0]) if row and row[0] else {"total": {}, "stages": {}}
+            for entry in (usage["total"], usage["stages"].setdefault(stage, {})):
+                entry["runs"] = entry.get("runs", 0) + 1
+                for metric, value in run.items():
+                    if metric == "max_rss_mb":
+                        entry[metric] = round(max(entry.get(metric, 0), value), 1)
+                    else:
+                        entry[metric] = round(entry.get(metric, 0) + value, 3)
+            conn.execute("UPDATE jobs SET usage = ? WHERE id = ?", (json.dumps(usage), job_id))
+    except Exception as e:
+        logger.error(f"Failed to record usage of job {job_id}: {e}")
+
+def percentiles(values):
+    values = sorted(values)
+    n = len(values)
+    summary = {"mean": round(sum(values) / n, 3)}
+    for p in (50, 90, 99):
+        summary[f"p{p}"] = values[max(1, -(-p * n // 100)) - 1]  # Nearest rank
+    summary["max"] = values[-1]
+    return summary
+
+def usage_stats(since, statuses=None):
+    """
+    Percentiles of ffmpeg usage per job type over jobs created since `since`, for the job
+    totals and per stage. rss_over_estimate counts jobs whose peak RSS beat their admission estimate.
+    """
+    clauses, params = ["usage IS NOT NULL", "created_at >= ?"], [since]
+    if statuses:
+        clauses.append(f"status IN ({', '.join('?' for _ in statuses)})")
+        params.extend(statuses)
+    rows = get_conn().execute(
+        f"SELECT type, status, usage, resources FROM jobs WHERE {' AND '.join(clauses)}", params
+    ).fetchall()
+    types = {}
+    for row in rows:
+        usage = json.loads(row['usage'])
+        group = types.setdefault(job_endpoint(row['type']), {
+            "jobs": 0, "statuses": Counter(), "rss_over_estimate": 0, "total": {}, "stages": {}})
+        group["jobs"] += 1
+        group["statuses"][row['status']] += 1
+        if usage["total"].get("max_rss_mb", 0) * MB > job_resources(row)["memory"]:
+            group["rss_over_estimate"] += 1
+        for target, entry in [(group["total"], usage["total"])] + [
+                (group["stages"].setdefault(stage, {}), entry) for stage, entry in usage["stages"].items()]:
+            for metric in USAGE_METRICS + ("runs",):
+                target.setdefault(metric, []).append(entry.get(metric, 0))
+    return {
+        "since": since,
+        "jobs": len(rows),
+        "types": {
+            name: {
+                "jobs": group["jobs"],
+                "statuses": dict(group["statuses"]),
+                "rss_over_estimate": group["rss_over_estimate"],
+                "total": {metric: percentiles(values) for metric, values in group["total"].items()},
+                "stages": {stage: {metric: percentiles(values) for metric, values in metrics.items()}
+                           for stage, metrics in sorted(group["stages"].items())},
+            }
+            for name, group in sorted(types.items())
+        },
+    }
+
+# --- Cancellation ---
+# DELETE /tasks/<id> drops a waiting or queued job at once. A running job is flagged in the
+# job store; the process running it (this one, or a worker found by watch_cancellations)
+# kills its ffmpeg process groups, and its downloads and uploads stop at the next chunk.
+# The failure that follows is recorded as 'cancelled' and the work dir removed as usual.
+
+_cancel_events = {}  # job_id -> Event set once the job is cancelled, for jobs running in this process
+_job_processes = {}  # job_id -> ffmpeg processes the job is running
+_cancel_lock = threading.Lock()
+
+def job_cancelled(job_id):
+    event = _cancel_events.get(job_id)
+    return event is not None and event.is_set()
+
+def check_cancelled(job_id):
+    if job_cancelled(job_id):
+        raise Exception("Cancelled")
+
+def kill_process_group(proc):
+    """ffmpeg runs in its own session, so this also takes down any process it spawned"""
+    if proc.returncode is not None:
+        return  # Reaped; its pid may belong to someone else by now
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def cancel_local(job_id):
+    """Stops a job running in this process; False if it isn't running here"""
+    with _cancel_lock:
+        event = _cancel_events.get(job_id)
+        if event is None:
+            return False
+        event.set()
+        processes = list(_job_processes.get(job_id, ()))
+    for proc in processes:
+        kill_process_group(proc)
+    logger.info(f"Job {job_id} cancelling, killed {len(processes)} ffmpeg process(es)")
+    return True
+
+def cancel_job(job_id):
+    """
+    Withdraws one request from a job and returns (status it had, requests still sharing it);
+    status is None if there is no such job. Only the last request's withdrawal cancels the job:
+    waiting and queued jobs are cancelled here, a processing one is flagged for its worker to stop.
+    """
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT status, COALESCE(submitters, 1) FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None, 0
+        status, submitters = row
+        now = time.time()
+        if status not in TERMINAL_STATUSES and submitters > 1:
+            # Deduplicated: other requests still wait for this job's result
+            conn.execute("UPDATE jobs SET submitters = ? WHERE id = ?", (submitters - 1, job_id))
+            logger.info(f"Job {job_id}: one of {submitters} requests withdrawn, job kept")
+            return status, submitters - 1
+        if status in ('waiting', 'queued'):
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', error = 'Cancelled', cancel_requested = ?, updated_at = ? "
+                "WHERE id = ?",
+                (now, now, job_id)
+            )
+        elif status == 'processing':
+            conn.execute("UPDATE jobs SET cancel_requested = ? WHERE id = ?", (now, job_id))
+    if status in ('waiting', 'queued'):
+        logger.info(f"Job {job_id} cancelled before it started")
+        notify_job_changed()
+        settle_finished_job(job_id, 'cancelled')
+    elif status == 'processing':
+        cancel_local(job_id)
+    return status, 0
+
+def expire_overdue_jobs():
+    """Cancels waiting and queued jobs whose deadline passed before a worker got to them"""
+    try:
+        conn = get_conn()
+        now = time.time()
+        overdue = [row[0] for row in conn.execute(
+            "SELECT id FROM jobs WHERE status IN ('waiting', 'queued') AND deadline < ?", (now,)
+        ).fetchall()]
+        if not overdue:
+            return
+        expired = []
+        with conn:
+            for job_id in overdue:
+                if conn.execute(
+                    "UPDATE jobs SET status = 'cancelled', error = 'Deadline passed before the job started', "
+                    "updated_at = ? WHERE id = ? AND status IN ('waiting', 'queued')",
+                    (now, job_id)
+                ).rowcount:
+                    expired.append(job_id)
+    except Exception as e:
+        logger.error(f"Failed to expire overdue jobs: {e}")
+        return
+    for job_id in expired:
+        logger.warning(f"Job {job_id} dropped: deadline passed before it started")
+        settle_finished_job(job_id, 'cancelled')
+    if expired:
+        notify_job_changed()
+
+def watch_cancellations():
+    """Picks up cancellations of this process's jobs requested through another process"""
+    while True:
+        time.sleep(CANCEL_POLL_INTERVAL)
+        try:
+            job_ids = [job_id for job_id, event in list(_cancel_events.items()) if not event.is_set()]
+            if not job_ids:
+                continue
+            rows = get_conn().execute(
+                f"SELECT id FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))}) AND cancel_requested IS NOT NULL",
+                job_ids
+            ).fetchall()
+            for row in rows:
+                cancel_local(row[0])
+        except Exception as e:
+            logger.error(f"Failed to check for cancelled jobs: {e}")
+
+def run_ffmpeg(cmd, timeout=300, job_id=None, stage=None, duration=None):
     """
     Run FFmpeg command with timeout and log to file to save RAM.
     Avoids capture_output=True which causes OOM on large outputs.
+    When a stage is given, -progress output is parsed and stored on the job as it runs.
     """
     job_part_id = uuid.uuid4().hex[:6]
     log_file_path = f"/tmp/ffmpeg_{job_id}_{job_part_id}.log"
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats"] + cmd[1:]
+    if stage and duration is None:
+        duration = _expected_duration(cmd)
+    timed_out = threading.Event()
+    if job_cancelled(job_id):
+        return False, "Cancelled"
+    if stage:
+        mark_stage(job_id, stage)
+    proc = None
+    rusage = None
     try:
         logger.info(f"Running command: {' '.join(cmd)}")
         
-        # Redirect stdout/stderr to a file instead of memory
+        # Redirect stderr to a file instead of memory; stdout carries only the small progress blocks
         with open(log_file_path, "w") as f:
-            result = subprocess.run(
+            started = time.time()
+            proc = subprocess.Popen(
                 cmd,
-                stdout=f,
-                stderr=subprocess.STDOUT, # Merge stderr into stdout
-                timeout=timeout
+                stdout=subprocess.PIPE,
+                stderr=f,
+                text=True,
+                start_new_session=True  # Own process group, killed as a whole on timeout or cancel
             )
+
+            def kill_on_timeout():
+                timed_out.set()
+                kill_process_group(proc)
+
+            timer = threading.Timer(timeout, kill_on_timeout)
+            timer.daemon = True
+            try:
+                limit_process(proc.pid)
+                if job_id:
+                    with _cancel_lock:
+                        _job_processes.setdefault(job_id, set()).add(proc)
+                    if job_cancelled(job_id):
+                        kill_process_group(proc)  # Cancelled between the check above and the spawn
+                timer.start()
+                fields = {}
+                for line in proc.stdout:
+                    key, _, value = line.strip().partition("=")
+                    fields[key] = value
+                    if key == "progress":
+                        if stage:
+                            snapshot = _progress_snapshot(fields, stage, duration, started)
+                            set_job_progress(job_id, snapshot, force=(value == "end"))
+                            if stage == "encode" and value == "end":
+                                note_encode_speed(snapshot["speed"])
+                        fields = {}
+                # Reaped here rather than by proc.wait() to get the child's rusage
+                _pid, wait_status, rusage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(wait_status)
+            finally:
+                timer.cancel()
+                proc.stdout.close()
+                if proc.returncode is None:
+                    # Something above raised: don't leave ffmpeg running, or unreaped
+                    kill_process_group(proc)
+                    try:
+                        _pid, wait_status, rusage = os.wait4(proc.pid, 0)
+                        proc.returncode = os.waitstatus_to_exitcode(wait_status)
+                    except ChildProcessError:
+                        pass
+                if rusage is not None:
+                    current_stage = stage or _stage_clock.get(job_id, (None,))[0]
+                    record_usage(job_id, current_stage or "ffmpeg", rusage, time.time() - started)
+        
+        if timed_out.is_set():
+            return False, "FFmpeg timeout"
+
+        if proc.returncode != 0 and job_cancelled(job_id):
+            return False, "Cancelled"
+
+        # ffmpeg traps SIGXCPU and exits on its own, so judge by the CPU time it actually used
+        cpu_used = rusage.ru_utime + rusage.ru_stime
+        if proc.returncode != 0 and FFMPEG_CPU_LIMIT_SECONDS > 0 and cpu_used >= FFMPEG_CPU_LIMIT_SECONDS:
+            return False, f"FFmpeg exceeded FFMPEG_CPU_LIMIT_SECONDS ({FFMPEG_CPU_LIMIT_SECONDS}s of CPU)"
         
-        if result.returncode != 0:
+        if proc.returncode != 0:
             # Read only the last 1KB of logs for error reporting
             try:
                 with open(log_file_path, "r") as f:
@@ -135,15 +1003,23 @@ def run_ffmpeg(cmd, timeout=300, job_id=None):
                 error_log = f"Could not read log file: {read_err}"
             
             logger.error(f"FFmpeg Error (tail): {error_log}")
-            return False, f"FFmpeg exited with code {result.returncode}. Log tail: {error_log}"
-            
+            return False, f"FFmpeg exited with code {proc.returncode}. Log tail: {error_log}"
+        
+        output = cmd[-1]
+        observe_stage(job_id, "ffmpeg", time.time() - started,
+                      os.path.getsize(output) if os.path.isfile(output) else None)
         return True, None
         
-    except subprocess.TimeoutExpired:
-        return False, "FFmpeg timeout"
     except Exception as e:
         return False, str(e)
     finally:
+        if proc and job_id:
+            with _cancel_lock:
+                processes = _job_processes.get(job_id)
+                if processes:
+                    processes.discard(proc)
+                    if not processes:
+                        del _job_processes[job_id]
         # Cleanup log file to prevent filling up /tmp
         if os.path.exists(log_file_path):
             try:
@@ -151,188 +1027,2271 @@ def run_ffmpeg(cmd, timeout=300, job_id=None):
             except:
                 pass
 
-def upload_to_r2(file_path, object_name):
-    """Uploads a file to Cloudflare R2 using boto3"""
-    import boto3
-    from botocore.exceptions import NoCredentialsError
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """Process-wide S3 client; boto3 clients are thread-safe and keep their own connection pool"""
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            import boto3
+            from botocore.config import Config
+
+            _s3_client = boto3.client(
+                's3',
+                endpoint_url=R2_ENDPOINT,
+                aws_access_key_id=R2_ACCESS_KEY,
+                aws_secret_access_key=R2_SECRET_KEY,
+                config=Config(
+                    max_pool_connections=R2_MAX_POOL_CONNECTIONS,
+                    retries={'max_attempts': 5, 'mode': 'standard'}
+                )
+            )
+        return _s3_client
+
+def get_transfer_config():
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(
+        multipart_threshold=R2_MULTIPART_THRESHOLD,
+        multipart_chunksize=R2_MULTIPART_CHUNKSIZE,
+        max_concurrency=R2_MAX_CONCURRENCY,
+        use_threads=R2_MAX_CONCURRENCY > 1
+    )
+
+def upload_to_r2(file_path, object_name, job_id=None, content_type=None):
+    """Uploads a file to Cloudflare R2 using boto3; cancelling job_id aborts it at the next chunk"""
+    from botocore.exceptions import NoCredentialsError
+
+    if not all([R2_ENDPOINT, R2_ACCESS_KEY, R2_SECRET_KEY, R2_BUCKET]):
+        return None, "R2 configuration missing"
+
+    def check_cancelled_chunk(bytes_sent):
+        check_cancelled(job_id)  # Raising fails the transfer, which aborts the multipart upload
+
+    try:
+        get_s3_client().upload_file(file_path, R2_BUCKET, object_name, Config=get_transfer_config(),
+                                    ExtraArgs={'ContentType': content_type} if content_type else None,
+                                    Callback=check_cancelled_chunk if job_id else None)
+        # Construct public URL
+        url = f"{R2_PUBLIC_URL}/{object_name}"
+        return url, None
+    except NoCredentialsError:
+        return None, "Credentials not available"
+    except Exception as e:
+        return None, str(e)
+
+class StreamingUpload:
+    """
+    Multipart upload of a file that ffmpeg is still writing.
+    Only works for outputs written strictly sequentially (fragmented MP4), since
+    parts already sent can't be rewritten.
+    """
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, file_path, object_name):
+        self.file_path = file_path
+        self.object_name = object_name
+        self.upload_id = None
+        self.parts = []
+        self.offset = 0
+        self.error = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not all([R2_ENDPOINT, R2_ACCESS_KEY, R2_SECRET_KEY, R2_BUCKET]):
+            return "R2 configuration missing"
+        try:
+            response = get_s3_client().create_multipart_upload(Bucket=R2_BUCKET, Key=self.object_name)
+        except Exception as e:
+            return str(e)
+        self.upload_id = response['UploadId']
+        self._thread = threading.Thread(target=self._run, name=f"upload-{self.object_name}")
+        self._thread.daemon = True
+        self._thread.start()
+        return None
+
+    def _upload_part(self, data):
+        part_number = len(self.parts) + 1
+        response = get_s3_client().upload_part(
+            Bucket=R2_BUCKET, Key=self.object_name, UploadId=self.upload_id,
+            PartNumber=part_number, Body=data
+        )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.offset += len(data)
+
+    def _send_available(self, final=False):
+        """Uploads every full part on disk; on the final pass also the (possibly short) tail"""
+        if not os.path.exists(self.file_path):
+            return
+        with open(self.file_path, 'rb') as f:
+            while True:
+                available = os.path.getsize(self.file_path) - self.offset
+                if available <= 0 or (available < R2_MULTIPART_CHUNKSIZE and not final):
+                    return
+                f.seek(self.offset)
+                self._upload_part(f.read(min(available, R2_MULTIPART_CHUNKSIZE)))
+
+    def _run(self):
+        try:
+            while not self._done.wait(self.POLL_INTERVAL):
+                self._send_available()
+        except Exception as e:
+            self.error = str(e)
+
+    def finish(self, success):
+        """Completes the upload once ffmpeg has exited; aborts it if the encode failed"""
+        self._done.set()
+        self._thread.join()
+        client = get_s3_client()
+        if success and not self.error:
+            try:
+                self._send_available(final=True)
+                client.complete_multipart_upload(
+                    Bucket=R2_BUCKET, Key=self.object_name, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts}
+                )
+                return f"{R2_PUBLIC_URL}/{self.object_name}", None
+            except Exception as e:
+                self.error = str(e)
+        try:
+            client.abort_multipart_upload(Bucket=R2_BUCKET, Key=self.object_name, UploadId=self.upload_id)
+        except Exception as e:
+            logger.error(f"Failed to abort multipart upload {self.upload_id}: {e}")
+        return None, self.error or "Encode failed"
+
+class HlsUpload:
+    """
+    Publishes an HLS output while ffmpeg writes it. ffmpeg only lists a segment in the
+    playlist once it has closed it, so every pass uploads the init segment and newly listed
+    segments, deletes them locally, and then uploads the playlist, which therefore never
+    names a segment that isn't in R2 yet. A job resumed after a crash publishes under the
+    prefix of its interrupted attempt (resumed=True), whose leftovers are cleared at the end.
+    """
+
+    POLL_INTERVAL = 0.5
+    PLAYLIST = "index.m3u8"
+    CONTENT_TYPES = {".m3u8": "application/vnd.apple.mpegurl", ".mp4": "video/mp4", ".m4s": "video/iso.segment"}
+
+    def __init__(self, job_id, hls_dir, prefix, resumed=False):
+        self.job_id = job_id
+        self.hls_dir = hls_dir
+        self.prefix = prefix
+        self.resumed = resumed
+        self.playlist_url = f"{R2_PUBLIC_URL}/{prefix}/{self.PLAYLIST}"
+        self.uploaded = []
+        self.published = None  # Playlist text last uploaded
+        self.error = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not all([R2_ENDPOINT, R2_ACCESS_KEY, R2_SECRET_KEY, R2_BUCKET]):
+            return "R2 configuration missing"
+        self._thread = threading.Thread(target=self._run, name=f"hls-{self.prefix}")
+        self._thread.daemon = True
+        self._thread.start()
+        return None
+
+    def _sync(self):
+        try:
+            with open(os.path.join(self.hls_dir, self.PLAYLIST)) as f:
+                playlist = f.read()  # Replaced by rename (hls_flags temp_file), so never half-written
+        except FileNotFoundError:
+            return
+        if playlist == self.published:
+            return
+        names = re.findall(r'#EXT-X-MAP:URI="([^"]+)"', playlist)
+        names += [line for line in playlist.splitlines() if line and not line.startswith("#")]
+        for name in names:
+            if name in self.uploaded:
+                continue
+            path = os.path.join(self.hls_dir, name)
+            url, error = upload_to_r2(path, f"{self.prefix}/{name}", job_id=self.job_id,
+                                      content_type=self.CONTENT_TYPES.get(os.path.splitext(name)[1]))
+            if error:
+                raise Exception(error)
+            os.remove(path)  # Disk is released segment by segment, not at the end of the job
+            self.uploaded.append(name)
+        get_s3_client().put_object(Bucket=R2_BUCKET, Key=f"{self.prefix}/{self.PLAYLIST}", Body=playlist.encode(),
+                                   ContentType=self.CONTENT_TYPES[".m3u8"], CacheControl="no-cache")
+        if self.published is None:
+            publish_partial_result(self.job_id, {"playlist_url": self.playlist_url})
+            logger.info(f"Job {self.job_id} playlist live at {self.playlist_url}")
+        self.published = playlist
+
+    def _run(self):
+        try:
+            while not self._done.wait(self.POLL_INTERVAL):
+                self._sync()
+        except Exception as e:
+            self.error = str(e)
+
+    def finish(self, success):
+        """Uploads what ffmpeg wrote last (and the playlist's end tag); removes the partial output if it failed"""
+        self._done.set()
+        self._thread.join()
+        if success and not self.error:
+            try:
+                self._sync()
+                record_job_stat(self.job_id, 'hls', 'segments', len(self.uploaded) - 1)
+            except Exception as e:
+                self.error = str(e)
+            else:
+                if self.resumed:
+                    # Segments the interrupted attempt got further with than this one
+                    self._delete(keep={f"{self.prefix}/{name}" for name in self.uploaded + [self.PLAYLIST]})
+                return self.playlist_url, None
+        self._delete()
+        return None, self.error or "Encode failed"
+
+    def _delete(self, keep=()):
+        try:
+            removed = delete_r2_prefix(self.prefix, keep)
+        except Exception as e:
+            logger.error(f"Failed to remove partial HLS output {self.prefix}: {e}")
+            return
+        if removed:
+            logger.info(f"Job {self.job_id} removed {removed} stale HLS object(s) under {self.prefix}")
+
+def delete_r2_prefix(prefix, keep=()):
+    """Deletes every object under prefix/ but the keys in keep; returns how many it deleted"""
+    s3_client = get_s3_client()
+    keys = []
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=R2_BUCKET, Prefix=f"{prefix}/"):
+        keys += [obj["Key"] for obj in page.get("Contents", []) if obj["Key"] not in keep]
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(Bucket=R2_BUCKET, Delete={'Objects': [{'Key': k} for k in keys[i:i + 1000]]})
+    return len(keys)
+
+def publish_partial_result(job_id, result):
+    """Result fields readable while the job is still processing; the final result replaces them"""
+    try:
+        with get_conn() as conn:
+            conn.execute("UPDATE jobs SET result = ? WHERE id = ? AND status = 'processing'",
+                         (json.dumps(result), job_id))
+    except Exception as e:
+        logger.error(f"Failed to publish partial result of job {job_id}: {e}")
+        return
+    notify_job_changed()
+
+def hls_cmd(cmd, hls_dir):
+    """The final ffmpeg command rewritten to write HLS with fMP4 segments into hls_dir"""
+    args = cmd[:-1]
+    if "libx264" in args:
+        # Segments can only start on keyframes, so place one every HLS_SEGMENT_SECONDS
+        args += ["-force_key_frames", f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS:g})"]
+    return args + [
+        "-f", "hls",
+        "-hls_time", f"{HLS_SEGMENT_SECONDS:g}",
+        "-hls_playlist_type", "event",
+        "-hls_segment_type", "fmp4",
+        "-hls_fmp4_init_filename", "init.mp4",
+        "-hls_segment_filename", os.path.join(hls_dir, "seg_%05d.m4s"),
+        "-hls_flags", "independent_segments+temp_file",
+        os.path.join(hls_dir, HlsUpload.PLAYLIST)
+    ]
+
+def encode_and_upload_hls(cmd, output_path, failure_label, timeout, job_id, duration, stage):
+    """
+    encode_and_upload for "output": "hls". Segments go to R2 under the output's name as ffmpeg
+    closes them, and the playlist URL is in the job's result from the first segment on. The
+    prefix is checkpointed first, so a crashed attempt's objects are reused or removed on resume.
+    """
+    hls_dir = os.path.join(os.path.dirname(output_path), "hls")
+    os.makedirs(hls_dir, exist_ok=True)
+    prefix = load_checkpoint(job_id).get('hls_prefix')
+    resumed = prefix is not None
+    if not resumed:
+        prefix = os.path.splitext(os.path.basename(output_path))[0]
+    upload = HlsUpload(job_id, hls_dir, prefix, resumed)
+    error = upload.start()
+    if error:
+        raise Exception(f"Upload failed: {error}")
+    if not resumed:
+        save_checkpoint(job_id, 'hls_prefix', prefix)
+    success, error = run_ffmpeg(hls_cmd(cmd, hls_dir), timeout=timeout, job_id=job_id, stage=stage,
+                                duration=duration)
+    set_job_stage(job_id, "upload")
+    url, upload_error = upload.finish(success)
+    if not success:
+        raise Exception(f"{failure_label}: {error}")
+    if upload_error:
+        raise Exception(f"Upload failed: {upload_error}")
+    save_checkpoint(job_id, 'uploaded', url)
+    return url
+
+def encode_and_upload(cmd, output_path, output_filename, failure_label, timeout=300, job_id=None, duration=None,
+                      stage="encode", output="mp4"):
+    """
+    Runs the final ffmpeg command of a job and uploads its output. An intermediate job keeps it for
+    dependent jobs instead; any other job with dependents waiting uploads it and keeps it as well.
+    With R2_STREAMING_UPLOAD the output is written as fragmented MP4 and uploaded
+    part by part while ffmpeg runs, so upload time overlaps encode time.
+    With output="hls" it is published as HLS instead (see encode_and_upload_hls).
+    """
+    upload = None
+    keep = keeps_output(job_id)  # Intermediate: stays local for dependent jobs, nothing goes to R2
+    if output == "hls" and not keep:
+        return encode_and_upload_hls(cmd, output_path, failure_label, timeout, job_id, duration, stage)
+    if R2_STREAMING_UPLOAD and not keep:
+        cmd = cmd[:-1] + ["-movflags", "frag_keyframe+empty_moov+default_base_moof", cmd[-1]]
+        upload = StreamingUpload(output_path, output_filename)
+        error = upload.start()
+        if error:
+            logger.warning(f"Streaming upload unavailable, uploading after encode: {error}")
+            upload = None
+
+    success, error = run_ffmpeg(cmd, timeout=timeout, job_id=job_id, stage=stage, duration=duration)
+    set_job_stage(job_id, "upload")
+    started = time.time()
+    if upload:
+        url, upload_error = upload.finish(success)
+    if not success:
+        raise Exception(f"{failure_label}: {error}")
+
+    save_checkpoint(job_id, 'encoded', [output_path])
+    if keep:
+        url = store_artifact(job_id, output_path)
+        save_checkpoint(job_id, 'uploaded', url)
+        return url
+
+    if not upload:
+        url, upload_error = upload_to_r2(output_path, output_filename, job_id=job_id)
+    if upload_error:
+        raise Exception(f"Upload failed: {upload_error}")
+    observe_stage(job_id, "upload", time.time() - started, os.path.getsize(output_path))
+    share_output(job_id, output_path)
+    save_checkpoint(job_id, 'uploaded', url)
+    return url
+
+# --- Job Stats ---
+# Per-job counters collected while a job runs and merged into its result
+
+_job_stats = {}
+_job_stats_lock = threading.Lock()
+
+def record_job_stat(job_id, group, key, amount=1):
+    if job_id is None:
+        return
+    with _job_stats_lock:
+        stats = _job_stats.setdefault(job_id, {}).setdefault(group, {})
+        stats[key] = stats.get(key, 0) + amount
+
+def set_job_stat(job_id, group, key, value):
+    if job_id is None:
+        return
+    with _job_stats_lock:
+        _job_stats.setdefault(job_id, {}).setdefault(group, {})[key] = value
+
+def pop_job_stats(job_id):
+    with _job_stats_lock:
+        return _job_stats.pop(job_id, {})
+
+# --- Metrics ---
+# Stage histograms are labelled by endpoint, looked up from the job id, so the hot paths
+# only pass the job id along. Queue and disk gauges are computed at scrape time from the
+# shared job store and filesystem, which keeps them correct across gunicorn workers.
+
+_job_endpoints = {}  # job_id -> endpoint name of jobs running in this process
+
+if METRICS_ENABLED:
+    from prometheus_client.core import GaugeMetricFamily
+
+    STAGE_SECONDS = prometheus_client.Histogram(
+        "ffmpeg_api_stage_duration_seconds", "Wall time of one download, ffmpeg run or upload",
+        ["endpoint", "stage"], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+    )
+    STAGE_BYTES = prometheus_client.Histogram(
+        "ffmpeg_api_stage_bytes", "Bytes downloaded, written by ffmpeg or uploaded",
+        ["endpoint", "stage"], buckets=tuple(2 ** n for n in range(16, 33, 2))  # 64KB .. 4GB
+    )
+    JOBS_FINISHED = prometheus_client.Counter(
+        "ffmpeg_api_jobs_finished", "Jobs that reached a terminal status", ["endpoint", "status"]
+    )
+    JOB_FAILURES = prometheus_client.Counter(
+        "ffmpeg_api_job_failures", "Failed jobs by failure reason", ["endpoint", "reason"]
+    )
+
+    class JobStoreCollector:
+        """Queue depth, running jobs and work dir disk use, read when /metrics is scraped"""
+
+        def describe(self):
+            return []  # Otherwise register() runs a full collect() at import time
+
+        def collect(self):
+            try:
+                with get_conn() as conn:
+                    counts = dict(conn.execute(
+                        "SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'processing') GROUP BY status"
+                    ).fetchall())
+                    reserved = reserved_resources(conn)
+            except Exception as e:
+                logger.error(f"Failed to read queue depth for metrics: {e}")
+                counts, reserved = {}, {"disk": 0, "memory": 0}
+            yield GaugeMetricFamily("ffmpeg_api_queue_depth", "Jobs waiting for a worker slot",
+                                    value=counts.get('queued', 0))
+            yield GaugeMetricFamily("ffmpeg_api_running_jobs", "Jobs being processed",
+                                    value=counts.get('processing', 0))
+            yield GaugeMetricFamily("ffmpeg_api_work_dir_bytes", "Bytes used in the job scratch areas",
+                                    value=sum(directory_size(root) for root in scratch_roots()))
+            yield GaugeMetricFamily("ffmpeg_api_reserved_disk_bytes", "Scratch disk estimated for running jobs",
+                                    value=reserved["disk"])
+            yield GaugeMetricFamily("ffmpeg_api_reserved_memory_bytes", "Memory estimated for running jobs",
+                                    value=reserved["memory"])
+            free = shutil.disk_usage(WORK_ROOT if os.path.isdir(WORK_ROOT) else "/tmp").free
+            yield GaugeMetricFamily("ffmpeg_api_work_dir_free_bytes", f"Free bytes on the filesystem of {WORK_ROOT}",
+                                    value=free)
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+        METRICS_REGISTRY = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(METRICS_REGISTRY)
+    else:
+        METRICS_REGISTRY = prometheus_client.REGISTRY
+    METRICS_REGISTRY.register(JobStoreCollector())
+
+def directory_size(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass  # Removed by its job mid-walk
+    return total
+
+def job_endpoint(job_type):
+    """logic_merge_audio -> merge-audio"""
+    return (job_type or "unknown").replace("logic_", "", 1).replace("_", "-")
+
+def observe_stage(job_id, stage, seconds, size=None):
+    if not METRICS_ENABLED:
+        return
+    endpoint = _job_endpoints.get(job_id, "unknown")
+    STAGE_SECONDS.labels(endpoint, stage).observe(seconds)
+    if size is not None:
+        STAGE_BYTES.labels(endpoint, stage).observe(size)
+
+def failure_reason(error):
+    """Small fixed set of labels, so raw error text never becomes a metric label"""
+    if isinstance(error, requests.RequestException):
+        return "download"
+    message = str(error)
+    if message.startswith("Upload failed"):
+        return "upload"
+    if message.startswith("Dependency "):
+        return "dependency"
+    if message.startswith("Interrupted "):
+        return "interrupted"
+    if "FFmpeg timeout" in message:
+        return "timeout"
+    if "FFmpeg exited" in message:
+        return "ffmpeg"
+    return "other"
+
+def count_finished_job(job_id, status, error=None):
+    if not METRICS_ENABLED:
+        return
+    endpoint = _job_endpoints.get(job_id)
+    if endpoint is None:
+        # Finished without running here: cancelled or expired in the queue, failed with a parent,
+        # given up on by recovery or never started (unknown type, corrupt params)
+        try:
+            row = get_conn().execute("SELECT type FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        except Exception as e:
+            logger.error(f"Failed to read the type of job {job_id}: {e}")
+            row = None
+        endpoint = job_endpoint(row[0]) if row and row[0] in JOB_FUNCTIONS else "unknown"
+    JOBS_FINISHED.labels(endpoint, status).inc()
+    if status == 'failed':
+        JOB_FAILURES.labels(endpoint, failure_reason(error)).inc()
+
+# --- HTTP Session ---
+# One pooled session for all input fetches so connections to R2 and the
+# generator CDNs are reused across downloads and jobs.
+
+HTTP_SESSION = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=HTTP_MAX_CONNECTIONS, pool_maxsize=HTTP_MAX_CONNECTIONS)
+HTTP_SESSION.mount("http://", _http_adapter)
+HTTP_SESSION.mount("https://", _http_adapter)
+_download_slots = threading.BoundedSemaphore(HTTP_MAX_CONNECTIONS)
+
+# --- Download Cache ---
+# Inputs are stored once under DOWNLOAD_CACHE_DIR, keyed by URL plus ETag/Last-Modified,
+# and evicted least-recently-used once DOWNLOAD_CACHE_MAX_BYTES is exceeded.
+
+# URLs hash onto a fixed set of lock stripes, so neither the thread locks nor the lock files
+# grow with the number of URLs seen. Every process must agree on the count, hence no setting.
+URL_LOCK_STRIPES = 64
+# A thread holds at most one stripe of each family and takes them in this order (an audio
+# asset is transcoded from a download), so stripes shared by unrelated URLs can't deadlock
+URL_LOCK_FAMILIES = ("audio", "download")
+
+_url_locks = {family: [threading.Lock() for _ in range(URL_LOCK_STRIPES)] for family in URL_LOCK_FAMILIES}
+_cache_lock = threading.Lock()  # Serializes linking against eviction
+
+@contextlib.contextmanager
+def _url_lock(url, family="download"):
+    """
+    One fetch per URL at a time, across threads and every worker process sharing
+    DOWNLOAD_CACHE_DIR (thread lock plus flock on the URL's stripe); concurrent jobs wait and then
+    hit the cache. URLs sharing a stripe wait for each other too.
+    """
+    stripe = int(hashlib.sha256(url.encode()).hexdigest(), 16) % URL_LOCK_STRIPES
+    lock_dir = os.path.join(DOWNLOAD_CACHE_DIR, "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    with _url_locks[family][stripe], open(os.path.join(lock_dir, f"{family}-{stripe}"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def _cache_lookup(url):
+    try:
+        with get_conn() as conn:
+            row = conn.execute("SELECT * FROM download_cache WHERE url = ?", (url,)).fetchone()
+            return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"Download cache lookup failed for {url}: {e}")
+        return None
+
+def _cache_store(url, path, etag, last_modified):
+    entry = {
+        'url': url,
+        'path': path,
+        'etag': etag,
+        'last_modified': last_modified,
+        'size': os.path.getsize(path),
+        'last_used': time.time(),
+    }
+    with get_conn() as conn:
+        old = conn.execute("SELECT path FROM download_cache WHERE url = ?", (url,)).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO download_cache (url, path, etag, last_modified, size, last_used) "
+            "VALUES (:url, :path, :etag, :last_modified, :size, :last_used)",
+            entry
+        )
+    # A changed validator means a new file; drop the superseded one
+    if old and old[0] != path:
+        try:
+            os.remove(old[0])
+        except OSError:
+            pass
+    return entry
+
+def _cache_link(entry, local_path):
+    """
+    Hardlinks (or copies, across filesystems) a cache entry into a work dir and bumps its LRU time.
+    False when the file is gone: evicted by another worker process, or replaced by a newer version.
+    """
+    with _cache_lock:
+        try:
+            os.link(entry['path'], local_path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            try:
+                shutil.copyfile(entry['path'], local_path)
+            except FileNotFoundError:
+                return False
+        try:
+            with get_conn() as conn:
+                conn.execute("UPDATE download_cache SET last_used = ? WHERE url = ?", (time.time(), entry['url']))
+        except Exception as e:
+            logger.error(f"Failed to touch cache entry for {entry['url']}: {e}")
+    return True
+
+def evict_download_cache():
+    """Removes least-recently-used entries until the cache fits its byte budget"""
+    with _cache_lock:
+        try:
+            with get_conn() as conn:
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM download_cache").fetchone()[0]
+                if total <= DOWNLOAD_CACHE_MAX_BYTES:
+                    return
+                rows = conn.execute(
+                    "SELECT url, path, size FROM download_cache WHERE COALESCE(pinned_until, 0) < ? ORDER BY last_used",
+                    (time.time(),)
+                ).fetchall()
+                for url, path, size in rows:
+                    if total <= DOWNLOAD_CACHE_MAX_BYTES:
+                        break
+                    # Jobs hold their own hardlink, so unlinking here is safe
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    conn.execute("DELETE FROM download_cache WHERE url = ?", (url,))
+                    total -= size or 0
+                    logger.info(f"Evicted {url} from download cache")
+        except Exception as e:
+            logger.error(f"Download cache eviction failed: {e}")
+
+def pin_cached_input(url, until):
+    try:
+        with get_conn() as conn:
+            conn.execute("UPDATE download_cache SET pinned_until = MAX(COALESCE(pinned_until, 0), ?) WHERE url = ?",
+                         (until, url))
+    except Exception as e:
+        logger.error(f"Failed to pin {url} in download cache: {e}")
+
+def prefetch_inputs(urls):
+    """
+    Downloads inputs that several jobs of a batch share into the cache once, in the background,
+    and pins them for BATCH_PIN_SECONDS so eviction can't drop them before the batch's jobs run.
+    Jobs that start first wait on the same per-URL lock and then hit the cache.
+    """
+    def prefetch(url):
+        scratch = os.path.join(DOWNLOAD_CACHE_DIR, f"prefetch_{uuid.uuid4().hex}")
+        try:
+            download_file(url, scratch)
+            pin_cached_input(url, time.time() + BATCH_PIN_SECONDS)
+        except Exception as e:
+            logger.warning(f"Prefetch of {url} failed, its jobs will download it themselves: {e}")
+        finally:
+            try:
+                with get_conn() as conn:
+                    conn.execute("DELETE FROM prefetching WHERE url = ?", (url,))
+            except Exception as e:
+                logger.error(f"Failed to clear prefetch of {url}: {e}")
+            if os.path.exists(scratch):
+                os.remove(scratch)
+
+    def run():
+        os.makedirs(DOWNLOAD_CACHE_DIR, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_CONCURRENCY, len(urls)))) as pool:
+            list(pool.map(prefetch, urls))
+
+    # Marked in the job store before the batch's jobs are queued, so none of them (in any worker
+    # process) races the prefetch with a partial fetch. The mark expires should this process die.
+    try:
+        with get_conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO prefetching (url, expires_at) VALUES (?, ?)",
+                             [(url, time.time() + BATCH_PIN_SECONDS) for url in urls])
+    except Exception as e:
+        logger.error(f"Failed to mark prefetch of {len(urls)} input(s): {e}")
+    thread = threading.Thread(target=run, name="batch-prefetch")
+    thread.daemon = True
+    thread.start()
+
+def is_cached_input(url):
+    """True when url is in the download cache or a batch prefetch is fetching it"""
+    if DOWNLOAD_CACHE_MAX_BYTES <= 0:
+        return False
+    try:
+        with get_conn() as conn:
+            if conn.execute("SELECT 1 FROM prefetching WHERE url = ? AND expires_at > ?", (url, time.time())).fetchone():
+                return True
+    except Exception as e:
+        logger.error(f"Prefetch lookup failed for {url}: {e}")
+    return _cache_lookup(url) is not None
+
+# --- Audio Assets ---
+# The normalized AAC of each distinct audio input (a workflow's background music goes into
+# every video it makes), so merge-audio only has to mux.
+
+LOUDNORM_FILTER = "loudnorm=I=-16:TP=-1.5:LRA=11"
+
+def link_or_copy(source, dest):
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copyfile(source, dest)  # Across filesystems
+
+def audio_asset_settings():
+    return {"codec": "aac", "bitrate": AUDIO_BITRATE, "sample_rate": AUDIO_ASSET_SAMPLE_RATE, "loudnorm": AUDIO_LOUDNORM}
+
+def normalize_audio_cmd(source, output_path, audio):
+    """Audio track of source as AAC in an M4A: stream-copied when it already is AAC and no loudnorm is wanted"""
+    cmd = ["ffmpeg", "-y", "-i", source, "-vn", "-map", "0:a:0"]
+    if audio.get("codec_name") == "aac" and not AUDIO_LOUDNORM:
+        return cmd + ["-c:a", "copy", output_path]
+    if AUDIO_LOUDNORM:
+        cmd += ["-af", LOUDNORM_FILTER]
+    return cmd + ["-c:a", "aac", "-b:a", AUDIO_BITRATE, "-ar", str(AUDIO_ASSET_SAMPLE_RATE), output_path]
+
+def _audio_asset_lookup(key):
+    try:
+        row = get_conn().execute("SELECT * FROM audio_assets WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"Audio asset lookup failed: {e}")
+        return None
+
+def _audio_asset_store(key, url, local_path):
+    os.makedirs(AUDIO_ASSET_DIR, exist_ok=True)
+    path = os.path.join(AUDIO_ASSET_DIR, f"{key}.m4a")
+    tmp_path = f"{path}.{uuid.uuid4().hex}"
+    link_or_copy(local_path, tmp_path)
+    os.replace(tmp_path, path)  # Another worker process may have stored the same asset meanwhile
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO audio_assets (key, url, path, size, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, url, path, os.path.getsize(path), time.time())
+        )
+
+def evict_audio_assets():
+    """Removes least-recently-used assets until they fit AUDIO_ASSET_CACHE_MAX_BYTES"""
+    try:
+        with get_conn() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM audio_assets").fetchone()[0]
+            for key, path, size in conn.execute("SELECT key, path, size FROM audio_assets ORDER BY last_used").fetchall():
+                if total <= AUDIO_ASSET_CACHE_MAX_BYTES:
+                    break
+                try:
+                    os.remove(path)  # Jobs using it hold their own hardlink
+                except OSError:
+                    pass
+                conn.execute("DELETE FROM audio_assets WHERE key = ?", (key,))
+                total -= size or 0
+                logger.info(f"Evicted audio asset {key}")
+    except Exception as e:
+        logger.error(f"Audio asset eviction failed: {e}")
+
+def fetch_audio_asset(job_id, url, local_path, work_dir):
+    """
+    Puts the normalized AAC of an audio input at local_path: linked from the asset cache, or
+    downloaded, transcoded and cached on a miss. Sources without an ETag or Last-Modified (and
+    job:<id> outputs) are transcoded for this job only.
+    """
+    validator = None
+    if AUDIO_ASSET_CACHE_MAX_BYTES > 0 and not is_job_ref(url):
+        validator = head_input(url)[0]
+    key = None
+    if validator:
+        basis = {"url": url, "validator": validator, "settings": audio_asset_settings()}
+        key = hashlib.sha256(json.dumps(basis, sort_keys=True).encode()).hexdigest()
+
+    with _url_lock(key, "audio") if key else contextlib.nullcontext():
+        entry = _audio_asset_lookup(key) if key else None
+        if entry and os.path.exists(entry['path']):
+            link_or_copy(entry['path'], local_path)
+            with get_conn() as conn:
+                conn.execute("UPDATE audio_assets SET last_used = ? WHERE key = ?", (time.time(), key))
+            record_job_stat(job_id, 'audio_asset', 'hits')
+            return local_path
+
+        source_path = os.path.join(work_dir, "audio_source")
+        download_file(url, source_path, job_id=job_id)
+        audio = first_stream(input_probe(url, source_path), "audio")
+        if audio is None:
+            raise Exception(f"Audio input has no audio stream: {url}")
+        success, error = run_ffmpeg(normalize_audio_cmd(source_path, local_path, audio), job_id=job_id,
+                                    stage="audio")
+        os.remove(source_path)
+        if not success:
+            raise Exception(f"Audio transcode failed: {error}")
+        record_job_stat(job_id, 'audio_asset', 'misses')
+        if key:
+            _audio_asset_store(key, url, local_path)
+    if key:
+        evict_audio_assets()
+    return local_path
+
+# --- Async Worker Logic ---
+
+def worker_wrapper(job_id, func, **kwargs):
+    """Executes the function and updates job status (job is already marked processing by the claim)"""
+    try:
+        result_url = resume_from_checkpoint(job_id) or func(job_id, **kwargs) # Pass job_id to func
+        
+        if result_url:
+             mark_stage(job_id, None)
+             result = {'artifact': result_url} if is_job_ref(result_url) else {'url': result_url}
+             if result_url.endswith(".m3u8"):
+                 result['playlist_url'] = result_url  # Same key the running job published it under
+             result.update(pop_job_stats(job_id))
+             set_job_progress(job_id, {"stage": "done", "percent": 100.0}, force=True)
+             update_job(job_id, 'completed', result=result)
+        else:
+             # If func returns None but didn't raise exception (shouldn't happen with current logic)
+             update_job(job_id, 'failed', error="No URL returned")
+             
+    except Exception as e:
+        if job_cancelled(job_id):
+            logger.info(f"Job {job_id} cancelled")
+            update_job(job_id, 'cancelled', error="Cancelled")
+        else:
+            logger.error(f"Job {job_id} failed: {e}")
+            update_job(job_id, 'failed', error=e)  # The exception itself, for its failure reason
+    finally:
+        pop_job_stats(job_id)
+        clear_job_progress(job_id)
+
+def start_async_job(func, fingerprint=None, callback_url=None, resources=None, depends_on=(), intermediate=False,
+                    priority=0, deadline=None, reuse_completed=True, **kwargs):
+    """
+    Persists the job as 'queued' (or 'waiting' on depends_on); a pool worker picks it up when a slot frees.
+    If a queued, running or (with reuse_completed) completed job has the same fingerprint, its id
+    is returned instead (and a new callback_url is added to its webhooks).
+    """
+    try:
+        with get_conn() as conn:
+            # Lookup and insert in one write transaction so concurrent retries can't both insert
+            conn.execute("BEGIN IMMEDIATE")
+            job_id = insert_job(conn, func.__name__, kwargs, fingerprint, callback_url, resources, depends_on,
+                                intermediate, priority, deadline, reuse_completed)
+            failed = failed_on_insert(conn, [job_id]) if depends_on else []
+    except Exception as e:
+        logger.error(f"Failed to create job record: {e}")
+        return None
+
+    for failed_id, error in failed:
+        settle_finished_job(failed_id, 'failed', error)
+    notify_workers()
+    return job_id
+
+def matching_job(conn, fingerprint, reuse_completed=True):
+    """
+    Id of the newest waiting, queued, running or (with reuse_completed) completed job with this
+    fingerprint, unless it is being cancelled
+    """
+    if not fingerprint:
+        return None
+    statuses = ('waiting', 'queued', 'processing') + (('completed',) if reuse_completed else ())
+    row = conn.execute(
+        f"SELECT id FROM jobs WHERE fingerprint = ? AND status IN ({', '.join('?' * len(statuses))}) "
+        "AND cancel_requested IS NULL ORDER BY created_at DESC LIMIT 1",
+        (fingerprint, *statuses)
+    ).fetchone()
+    return row[0] if row else None
+
+def insert_job(conn, job_type, kwargs, fingerprint=None, callback_url=None, resources=None, depends_on=(),
+               intermediate=False, priority=0, deadline=None, reuse_completed=True):
+    """
+    Within an open write transaction: id of the job matching fingerprint (see matching_job), or of a new one.
+    A new job is 'queued', or 'waiting' until every job in depends_on has completed. If one of them
+    has already failed or been cancelled, the new job is recorded 'failed' and the caller settles it
+    once the transaction commits (see failed_on_insert).
+    A matching job takes the higher priority and the later deadline of the two requests, and
+    counts one more submitter while it hasn't finished (see cancel_job).
+    """
+    existing = matching_job(conn, fingerprint, reuse_completed)
+    if existing:
+        logger.info(f"Request matches existing job {existing}")
+        if callback_url:
+            # Every caller is waiting on its own webhook (an n8n resume URL), so none replaces another
+            job = dict(conn.execute("SELECT callback_url, callback_urls FROM jobs WHERE id = ?", (existing,)).fetchone())
+            urls = callback_urls(job)
+            if callback_url not in urls:
+                conn.execute("UPDATE jobs SET callback_urls = ? WHERE id = ?", (json.dumps(urls + [callback_url]), existing))
+        conn.execute(
+            "UPDATE jobs SET priority = MAX(priority, ?), "
+            "deadline = CASE WHEN ? IS NULL OR deadline IS NULL THEN NULL ELSE MAX(deadline, ?) END, "
+            "submitters = CASE WHEN status IN ('waiting', 'queued', 'processing') "
+            "THEN COALESCE(submitters, 1) + 1 ELSE submitters END WHERE id = ?",
+            (priority, deadline, deadline, existing)
+        )
+        return existing
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    status, error = 'queued', None
+    if depends_on:
+        # Read in this transaction: a parent that finished since check_dependencies has already
+        # settled its dependents, so this job must not start out waiting on it
+        parents = dict(conn.execute(
+            f"SELECT id, status FROM jobs WHERE id IN ({', '.join('?' * len(depends_on))})", tuple(depends_on)
+        ).fetchall())
+        unmet = [(parent_id, parents.get(parent_id, 'missing')) for parent_id in depends_on
+                 if parents.get(parent_id) != 'completed']
+        dead = [(parent_id, parent_status) for parent_id, parent_status in unmet
+                if parent_status in ('failed', 'cancelled', 'missing')]
+        if dead:
+            status, error = 'failed', f"Dependency {dead[0][0]} {dead[0][1]}"
+            logger.warning(f"Job {job_id} failed on arrival: {error}")
+        elif unmet:
+            status = 'waiting'
+    conn.execute(
+        "INSERT INTO jobs (id, status, created_at, updated_at, type, params, fingerprint, callback_urls, resources, "
+        "intermediate, priority, deadline, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, status, now, now, job_type, json.dumps(kwargs), fingerprint,
+         json.dumps([callback_url]) if callback_url else None, json.dumps(resources) if resources else None,
+         int(bool(intermediate)), priority, deadline, error)
+    )
+    conn.executemany("INSERT INTO job_dependencies (job_id, parent_id) VALUES (?, ?)",
+                     [(job_id, parent_id) for parent_id in depends_on])
+    return job_id
+
+def failed_on_insert(conn, job_ids):
+    """(id, error) of those of job_ids that insert_job recorded 'failed' because a parent had failed or been cancelled"""
+    job_ids = list(set(job_ids))
+    return conn.execute(
+        f"SELECT id, error FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))}) AND status = 'failed'", job_ids
+    ).fetchall()
+
+def start_batch(specs, heads=None, probes=None):
+    """
+    Queues job specs (dicts of func, kwargs, idempotency_key and the options parse_job_options
+    returns) under one batch id in a single transaction. Input URLs used more than once across
+    the batch are prefetched into the download cache first, so each is fetched once.
+    Returns (batch_id, job_ids, shared_urls).
+    """
+    # HEAD and probe each distinct input once for the whole batch
+    heads = {} if heads is None else heads
+    probes = {} if probes is None else probes
+    fingerprints = [request_fingerprint(spec["func"].__name__, spec["kwargs"], spec["idempotency_key"], heads,
+                                        spec["intermediate"])
+                    for spec in specs]
+    reusable = [reuses_completed(spec["kwargs"], spec["idempotency_key"], heads) for spec in specs]
+    estimates = [estimate_job_resources(spec["func"].__name__, spec["kwargs"], heads, probes) for spec in specs]
+    uses = Counter(url for spec in specs for url in input_urls(spec["kwargs"]) if not is_job_ref(url))
+    shared = [url for url, count in uses.items() if count > 1]
+    if shared and DOWNLOAD_CACHE_MAX_BYTES > 0:
+        prefetch_inputs(shared)
+
+    batch_id = str(uuid.uuid4())
+    try:
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            job_ids = [insert_job(conn, spec["func"].__name__, spec["kwargs"], fingerprint, spec["callback_url"],
+                                  resources, spec["depends_on"], spec["intermediate"], spec["priority"],
+                                  spec["deadline"], reuse_completed)
+                       for spec, fingerprint, resources, reuse_completed in zip(specs, fingerprints, estimates, reusable)]
+            conn.executemany(
+                "INSERT INTO batch_jobs (batch_id, position, job_id) VALUES (?, ?, ?)",
+                [(batch_id, position, job_id) for position, job_id in enumerate(job_ids)]
+            )
+            failed = failed_on_insert(conn, job_ids) if any(spec["depends_on"] for spec in specs) else []
+    except Exception as e:
+        logger.error(f"Failed to create batch: {e}")
+        return None, [], shared
+
+    logger.info(f"Batch {batch_id}: {len(job_ids)} job(s), {len(shared)} shared input(s)")
+    for failed_id, error in failed:
+        settle_finished_job(failed_id, 'failed', error)
+    notify_workers()
+    for spec, job_id in zip(specs, job_ids):
+        if spec["callback_url"] and (get_job_from_db(job_id) or {}).get('status') == 'completed':
+            schedule_callback(job_id, [spec["callback_url"]])  # Matched an already finished job, as in submit_job
+    return batch_id, job_ids, shared
+
+# --- Job Chaining ---
+# A job input may be `job:<id>`, the output of another job. The dependent job waits until its
+# parents complete, then reads their output from ARTIFACT_DIR. A parent submitted as intermediate
+# keeps its output there instead of uploading it; any other parent with dependents waiting
+# uploads its output as usual and keeps a copy there too.
+
+JOB_REF_PREFIX = "job:"
+
+def is_job_ref(url):
+    return isinstance(url, str) and url.startswith(JOB_REF_PREFIX)
+
+def settle_dependents(job_id, status):
+    """After a job finishes: queues dependents whose parents have all completed, or fails them if it didn't"""
+    released = 0
+    try:
+        with get_conn() as conn:
+            children = [row[0] for row in conn.execute(
+                "SELECT jobs.id FROM job_dependencies JOIN jobs ON jobs.id = job_dependencies.job_id "
+                "WHERE job_dependencies.parent_id = ? AND jobs.status = 'waiting'",
+                (job_id,)
+            ).fetchall()]
+            if children and status == 'completed':
+                released = conn.execute(
+                    f"UPDATE jobs SET status = 'queued', updated_at = ? WHERE id IN ({', '.join('?' * len(children))}) "
+                    "AND status = 'waiting' AND NOT EXISTS (SELECT 1 FROM job_dependencies d JOIN jobs p "
+                    "ON p.id = d.parent_id WHERE d.job_id = jobs.id AND p.status != 'completed')",
+                    (time.time(), *children)
+                ).rowcount
+    except Exception as e:
+        logger.error(f"Failed to settle dependents of job {job_id}: {e}")
+        return
+    if not children:
+        return
+    if status != 'completed':
+        for child_id in children:
+            update_job(child_id, 'failed', error=f"Dependency {job_id} {status}")
+        return
+    if released:
+        logger.info(f"Job {job_id} completed, released {released} dependent job(s)")
+        notify_job_changed()
+        notify_workers()
+
+def settle_waiting_jobs():
+    """
+    Queues waiting jobs whose parents have all completed and fails those with a parent that didn't.
+    settle_dependents does this as each parent finishes; this catches jobs it missed, e.g. when the
+    process was killed between recording a parent's status and settling its dependents.
+    Runs at pool start and with every heartbeat.
+    """
+    try:
+        conn = get_conn()
+        parents = {}
+        for job_id, parent_id, parent_status in conn.execute(
+            "SELECT jobs.id, d.parent_id, COALESCE(p.status, 'missing') FROM jobs "
+            "JOIN job_dependencies d ON d.job_id = jobs.id LEFT JOIN jobs p ON p.id = d.parent_id "
+            "WHERE jobs.status = 'waiting'"
+        ).fetchall():
+            parents.setdefault(job_id, []).append((parent_id, parent_status))
+        released, failed = [], []
+        now = time.time()
+        with conn:
+            for job_id, statuses in parents.items():
+                if any(status not in TERMINAL_STATUSES + ('missing',) for _, status in statuses):
+                    continue  # A parent hasn't finished; settle_dependents will see to this one
+                dead = [(parent_id, status) for parent_id, status in statuses if status != 'completed']
+                if not dead:
+                    if conn.execute(
+                        "UPDATE jobs SET status = 'queued', updated_at = ? WHERE id = ? AND status = 'waiting'",
+                        (now, job_id)
+                    ).rowcount:
+                        released.append(job_id)
+                else:
+                    error = f"Dependency {dead[0][0]} {dead[0][1]}"
+                    if conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ? AND status = 'waiting'",
+                        (error, now, job_id)
+                    ).rowcount:
+                        failed.append((job_id, error))
+    except Exception as e:
+        logger.error(f"Failed to settle waiting jobs: {e}")
+        return
+    for job_id in released:
+        logger.warning(f"Job {job_id} was left waiting on finished parents, queued")
+    for job_id, error in failed:
+        logger.warning(f"Job {job_id} was left waiting on a failed parent, failed")
+        settle_finished_job(job_id, 'failed', error)
+    if released or failed:
+        notify_job_changed()
+    if released:
+        notify_workers()
+
+def has_pending_dependents(job_id):
+    row = get_conn().execute(
+        "SELECT 1 FROM job_dependencies JOIN jobs ON jobs.id = job_dependencies.job_id "
+        "WHERE job_dependencies.parent_id = ? AND jobs.status IN ('waiting', 'queued', 'processing') LIMIT 1",
+        (job_id,)
+    ).fetchone()
+    return row is not None
+
+def keeps_output(job_id):
+    """True for an intermediate job, whose output goes to ARTIFACT_DIR for dependent jobs instead of R2"""
+    if job_id is None:
+        return False
+    try:
+        row = get_conn().execute("SELECT intermediate FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+    except Exception as e:
+        logger.error(f"Failed to look up job {job_id}: {e}")
+        return False
+
+def share_output(job_id, output_path):
+    """After uploading: keeps the output in ARTIFACT_DIR too when dependent jobs are waiting to read it"""
+    if job_id is None:
+        return
+    try:
+        if not has_pending_dependents(job_id):
+            return
+    except Exception as e:
+        logger.error(f"Failed to look up dependents of job {job_id}: {e}")
+        return
+    store_artifact(job_id, output_path)
+
+def store_artifact(job_id, output_path):
+    """Moves a finished output into ARTIFACT_DIR and returns the job:<id> reference dependents read it by"""
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    artifact = os.path.join(ARTIFACT_DIR, f"{job_id}{os.path.splitext(output_path)[1]}")
+    shutil.move(output_path, artifact)
+    with get_conn() as conn:
+        conn.execute("UPDATE jobs SET artifact = ? WHERE id = ?", (artifact, job_id))
+    logger.info(f"Job {job_id} kept its output for dependent jobs: {artifact}")
+    return f"{JOB_REF_PREFIX}{job_id}"
+
+def resolve_job_ref(ref):
+    """(artifact path, None) or (None, uploaded URL) for the output a job:<id> input refers to"""
+    job = get_job_from_db(ref[len(JOB_REF_PREFIX):])
+    if not job or job['status'] != 'completed':
+        raise Exception(f"Input {ref} has not completed")
+    if job.get('artifact') and os.path.exists(job['artifact']):
+        return job['artifact'], None
+    url = (job.get('result') or {}).get('url')
+    if url and url.endswith(".m3u8"):
+        raise Exception(f"Output of {ref} is an HLS playlist, not a file")
+    if url:
+        return None, url
+    raise Exception(f"Output of {ref} is no longer available")
+
+def check_dependencies(parent_ids):
+    """Raises ValueError unless every parent exists and has completed (with its output still around) or may yet"""
+    if not parent_ids:
+        return
+    with get_conn() as conn:
+        rows = {row['id']: row for row in conn.execute(
+            f"SELECT id, status, result, artifact, params, intermediate FROM jobs "
+            f"WHERE id IN ({', '.join('?' * len(parent_ids))})",
+            tuple(parent_ids)
+        ).fetchall()}
+    for parent_id in parent_ids:
+        row = rows.get(parent_id)
+        if row is None:
+            raise ValueError(f"depends_on: unknown job {parent_id}")
+        if row['status'] in TERMINAL_STATUSES and row['status'] != 'completed':
+            raise ValueError(f"depends_on: job {parent_id} {row['status']}")
+        if (row['status'] not in TERMINAL_STATUSES and not row['intermediate']
+                and json.loads(row['params'] or '{}').get('output') == 'hls'):
+            raise ValueError(f"depends_on: output of job {parent_id} will be an HLS playlist")
+        if row['status'] == 'completed' and not row['artifact']:
+            url = json.loads(row['result'] or '{}').get('url')
+            if not url:
+                raise ValueError(f"depends_on: output of job {parent_id} is no longer available")
+            if url.endswith(".m3u8"):
+                raise ValueError(f"depends_on: output of job {parent_id} is an HLS playlist")
+
+def collect_artifacts():
+    """
+    Deletes kept outputs no waiting, queued or running job reads any more: once all their
+    dependents have finished, or after ARTIFACT_TTL_SECONDS if nothing ever referenced them.
+    """
+    try:
+        with get_conn() as conn:
+            rows = conn.execute(
+                "SELECT id, artifact, updated_at, "
+                "EXISTS (SELECT 1 FROM job_dependencies d WHERE d.parent_id = jobs.id) AS referenced "
+                "FROM jobs WHERE artifact IS NOT NULL AND NOT EXISTS (SELECT 1 FROM job_dependencies d "
+                "JOIN jobs c ON c.id = d.job_id WHERE d.parent_id = jobs.id "
+                "AND c.status IN ('waiting', 'queued', 'processing'))"
+            ).fetchall()
+            now = time.time()
+            collected = [row for row in rows
+                         if row['referenced'] or now - (row['updated_at'] or 0) > ARTIFACT_TTL_SECONDS]
+            conn.executemany("UPDATE jobs SET artifact = NULL WHERE id = ?", [(row['id'],) for row in collected])
+    except Exception as e:
+        logger.error(f"Artifact collection failed: {e}")
+        return
+    for row in collected:
+        try:
+            os.remove(row['artifact'])
+        except FileNotFoundError:
+            pass
+        logger.info(f"Removed kept output of job {row['id']}")
+
+# --- Crash Recovery ---
+# A job's work dir survives its worker process being killed, so stages it finished
+# are recorded on the row and skipped when the requeued job runs again.
+
+def load_checkpoint(job_id):
+    try:
+        row = get_conn().execute("SELECT checkpoint FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+    except Exception as e:
+        logger.error(f"Failed to read checkpoint of job {job_id}: {e}")
+        return {}
+
+def save_checkpoint(job_id, stage, value):
+    if job_id is None:
+        return
+    try:
+        with get_conn() as conn:
+            conn.execute(
+                "UPDATE jobs SET checkpoint = json_set(COALESCE(checkpoint, '{}'), ?, json(?)) WHERE id = ?",
+                (f"$.{stage}", json.dumps(value), job_id)
+            )
+    except Exception as e:
+        logger.error(f"Failed to save {stage} checkpoint of job {job_id}: {e}")
+
+def checkpointed_files(job_id, stage):
+    """Paths an earlier attempt recorded for `stage`, if they are all still on disk"""
+    paths = load_checkpoint(job_id).get(stage)
+    if paths and all(os.path.exists(path) for path in paths):
+        logger.info(f"Job {job_id} resuming past stage '{stage}'")
+        return paths
+    return None
+
+def resume_from_checkpoint(job_id):
+    """Result URL of an interrupted job that got as far as encoding (uploading it if needed), else None"""
+    checkpoint = load_checkpoint(job_id)
+    if checkpoint.get('uploaded'):
+        return checkpoint['uploaded']
+    encoded = checkpointed_files(job_id, 'encoded')
+    if not encoded:
+        return None
+    set_job_stage(job_id, "upload")
+    try:
+        if keeps_output(job_id):
+            url = store_artifact(job_id, encoded[0])
+            save_checkpoint(job_id, 'uploaded', url)
+            return url
+        url, error = upload_to_r2(encoded[0], os.path.basename(encoded[0]), job_id=job_id)
+        if error:
+            raise Exception(f"Upload failed: {error}")
+        share_output(job_id, encoded[0])
+        save_checkpoint(job_id, 'uploaded', url)
+        return url
+    finally:
+        shutil.rmtree(get_work_dir(job_id), ignore_errors=True)
+
+HOSTNAME = socket.gethostname()
+PROCESS_STARTED_AT = time.time()
+
+def process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def job_orphaned(row, now):
+    """A 'processing' job whose lease lapsed, or whose process on this host is gone"""
+    if row['lease_expires_at'] is not None and row['lease_expires_at'] < now:
+        return True
+    if row['worker_host'] not in (None, HOSTNAME):
+        return False  # Another host's pid means nothing here; its lease decides
+    if row['worker_pid'] == os.getpid():
+        return (row['started_at'] or 0) < PROCESS_STARTED_AT  # Claimed by an earlier process with a recycled pid
+    return not process_alive(row['worker_pid'])
+
+def remove_partial_hls(job_id):
+    """Deletes the HLS objects a job that will never finish published before its worker died"""
+    checkpoint = load_checkpoint(job_id)
+    if not checkpoint.get('hls_prefix') or checkpoint.get('uploaded'):
+        return
+    try:
+        removed = delete_r2_prefix(checkpoint['hls_prefix'])
+    except Exception as e:
+        logger.error(f"Failed to remove partial HLS output of job {job_id}: {e}")
+        return
+    logger.info(f"Removed {removed} HLS object(s) of abandoned job {job_id}")
+
+def recover_orphaned_jobs():
+    """
+    Requeues 'processing' jobs whose worker is gone (gunicorn timeout, OOM kill, redeploy,
+    a dead worker container). Queued jobs need nothing: their params are stored and the pool
+    picks them up. Jobs already started MAX_JOB_ATTEMPTS times are failed instead of crashing
+    workers forever. Runs at pool start and with every heartbeat.
+    """
+    try:
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, attempts, started_at, worker_pid, worker_host, lease_expires_at, cancel_requested "
+                "FROM jobs WHERE status = 'processing'"
+            ).fetchall()
+            now = time.time()
+            orphaned = [row for row in rows if job_orphaned(row, now)]
+            cancelled = [row['id'] for row in orphaned if row['cancel_requested']]
+            exhausted = [row['id'] for row in orphaned
+                         if row['id'] not in cancelled and (row['attempts'] or 0) >= MAX_JOB_ATTEMPTS]
+            requeued = [row['id'] for row in orphaned if row['id'] not in cancelled and row['id'] not in exhausted]
+            conn.executemany(
+                "UPDATE jobs SET status = 'queued', worker_pid = NULL, worker_host = NULL, lease_expires_at = NULL, "
+                "progress = NULL, updated_at = ? WHERE id = ?",
+                [(now, job_id) for job_id in requeued]
+            )
+    except Exception as e:
+        logger.error(f"Crash recovery failed: {e}")
+        return
+
+    for job_id in requeued:
+        logger.warning(f"Job {job_id} was interrupted, requeued")
+    for job_id in cancelled + exhausted:
+        if job_id in cancelled:
+            update_job(job_id, 'cancelled', error="Cancelled")  # Its worker died before it could
+        else:
+            update_job(job_id, 'failed', error=f"Interrupted {MAX_JOB_ATTEMPTS} times, giving up")
+        for root in scratch_roots():
+            shutil.rmtree(os.path.join(root, job_id), ignore_errors=True)
+        remove_partial_hls(job_id)
+    if requeued or exhausted or cancelled:
+        notify_job_changed()
+
+# --- Admission Control ---
+# Each job stores an estimate of its peak scratch disk and memory, made at submit time from
+# the inputs' Content-Length and probed resolution/duration. Workers only claim a job whose
+# estimate fits beside what the jobs already running (in any process) have reserved.
+
+MB = 1024 * 1024
+DEFAULT_RESOURCES = {"disk": 2 * DEFAULT_INPUT_MB * MB, "memory": JOB_MEMORY_MB * MB}  # Jobs queued before estimates
+ENCODING_JOBS = ("logic_add_subtitles", "logic_pipeline")  # Always run libx264; concat only when re-encoding
+ADMISSION_SCAN_LIMIT = 20  # Queued jobs looked at per claim for one that fits
+
+_work_dirs = {}  # job_id -> scratch root picked at admission, for jobs running in this process
+_lookahead_caps = {}  # job_id -> rc-lookahead that fits the memory budget, for jobs running in this process
+_deferred_jobs = set()  # Already logged as not fitting
+
+def scratch_roots():
+    return [WORK_ROOT] + ([SCRATCH_TMPFS_DIR] if SCRATCH_TMPFS_DIR else [])
+
+def get_work_dir(job_id):
+    """Scratch directory of a job: under the tmpfs area or WORK_ROOT, as admission decided"""
+    return os.path.join(_work_dirs.get(job_id, WORK_ROOT), job_id)
+
+# libx264 holds about two yuv420p frames per lookahead frame, ten per thread and forty more
+# (references, source and encoder copies), fitted to peak RSS of 1080p encodes from 0 to 60
+# lookahead frames and 1 to 4 threads; FFMPEG_BASE_MEMORY_MB covers the rest of the process
+X264_FRAMES_PER_LOOKAHEAD = 2
+X264_FRAMES_PER_THREAD = 10
+X264_BASE_FRAMES = 40
+
+def x264_memory(width, height, lookahead, threads):
+    """libx264's peak footprint for one encode"""
+    frames = X264_FRAMES_PER_LOOKAHEAD * lookahead + X264_FRAMES_PER_THREAD * threads + X264_BASE_FRAMES
+    return int(width * height * 1.5 * frames)
+
+def fitting_lookahead(width, height, threads, memory):
+    """Longest lookahead with which one encode fits in `memory` bytes (0 when none does)"""
+    frame = width * height * 1.5
+    frames = memory / frame - X264_FRAMES_PER_THREAD * threads - X264_BASE_FRAMES
+    return max(0, int(frames // X264_FRAMES_PER_LOOKAHEAD))
+
+def estimate_job_resources(job_type, params, heads=None, probes=None):
+    """
+    {"disk": bytes, "memory": bytes} a job needs at its peak. `heads` and `probes` may hold
+    url -> head_input / probe_url results already fetched (a batch shares them).
+    """
+    urls = input_urls(params)
+    heads = fetch_heads(urls, {} if heads is None else heads)
+    input_bytes = sum(heads[url][1] or DEFAULT_INPUT_MB * MB for url in urls)
+    resources = {
+        "disk": int(input_bytes * SCRATCH_DISK_FACTORS.get(job_type, 2.0)),
+        "memory": FFMPEG_BASE_MEMORY_MB * MB,
+    }
+    if job_type not in ENCODING_JOBS and not params.get("reencode"):
+        return resources  # Stream copy: demux/mux buffers only
+
+    video_urls = params.get("video_urls") or [params.get("video_url")]
+    probes = probe_inputs(video_urls, heads, {} if probes is None else probes)
+    videos = [first_stream(probes[url], "video") for url in video_urls]
+    if not all(v and v.get("width") and v.get("height") for v in videos):
+        resources["memory"] = JOB_MEMORY_MB * MB  # Unknown resolution
+        return resources
+
+    largest = max(videos, key=lambda v: v["width"] * v["height"])
+    duration = _number(probes[video_urls[0]].get("format", {}).get("duration")) or 0
+    encoders = 1
+    if job_type == "logic_add_subtitles" and duration >= SEGMENT_MIN_DURATION:
+        encoders = segment_parallelism()
+    threads = max(1, X264_THREAD_BUDGET // WORKER_POOL_SIZE // encoders)
+    width, height = largest["width"], largest["height"]
+    lookahead = ENCODE_PROFILES[params.get("profile") or DEFAULT_ENCODE_PROFILE]["lookahead"]
+    # An encode that can't fit the memory budget even on an idle instance runs with a shorter lookahead
+    fitting = fitting_lookahead(width, height, threads, MEMORY_BUDGET_MB * MB // encoders - FFMPEG_BASE_MEMORY_MB * MB)
+    if fitting < lookahead:
+        lookahead = resources["lookahead"] = fitting
+    resources["memory"] = encoders * (FFMPEG_BASE_MEMORY_MB * MB + x264_memory(width, height, lookahead, threads))
+    return resources
+
+def job_resources(row):
+    try:
+        return json.loads(row['resources'] or 'null') or dict(DEFAULT_RESOURCES)
+    except ValueError:
+        return dict(DEFAULT_RESOURCES)
+
+def reserved_resources(conn):
+    """Bytes of disk, memory and tmpfs reserved by the jobs being processed on this host, and how many there are"""
+    reserved = {"disk": 0, "memory": 0, "tmpfs": 0, "running": 0}
+    for row in conn.execute(
+        "SELECT resources FROM jobs WHERE status = 'processing' AND (worker_host = ? OR worker_host IS NULL)",
+        (HOSTNAME,)
+    ).fetchall():
+        resources = job_resources(row)
+        reserved["running"] += 1
+        reserved["memory"] += resources["memory"]
+        if SCRATCH_TMPFS_DIR and resources.get("scratch") == SCRATCH_TMPFS_DIR:
+            reserved["tmpfs"] += resources["disk"]
+            reserved["memory"] += resources["disk"]  # tmpfs pages are RAM
+        else:
+            reserved["disk"] += resources["disk"]
+    return reserved
+
+def scratch_usage():
+    """
+    root -> (statvfs free bytes, bytes written under it) for each scratch root. Walking the
+    work dirs is slow, so claims measure this before taking the job store's write lock.
+    """
+    usage = {}
+    for root in filter(None, (WORK_ROOT, SCRATCH_TMPFS_DIR)):
+        os.makedirs(root, exist_ok=True)
+        usage[root] = (shutil.disk_usage(root).free, directory_size(root))
+    return usage
+
+def free_bytes(usage, reserved):
+    """
+    Free space of a scratch root (its scratch_usage entry) not yet promised to running jobs. Whatever
+    they have already written is gone from statvfs's free figure, so only the unwritten rest is subtracted.
+    """
+    free, written = usage
+    return free - max(0, reserved - written)
+
+def available_resources(conn, usage=None):
+    usage = usage or scratch_usage()
+    reserved = reserved_resources(conn)
+    available = {
+        "running": reserved["running"],
+        "memory": MEMORY_BUDGET_MB * MB - reserved["memory"],
+        "disk": free_bytes(usage[WORK_ROOT], reserved["disk"]) - DISK_HEADROOM_MB * MB,
+    }
+    if SCRATCH_TMPFS_DIR:
+        available["tmpfs"] = free_bytes(usage[SCRATCH_TMPFS_DIR], reserved["tmpfs"])
+    return available
+
+def admit(resources, available):
+    """Scratch root for a job that fits in the available resources now, else None"""
+    disk, memory = resources["disk"], resources["memory"]
+    if (SCRATCH_TMPFS_DIR and disk <= TMPFS_MAX_JOB_MB * MB
+            and disk <= available["tmpfs"] and disk + memory <= available["memory"]):
+        return SCRATCH_TMPFS_DIR
+    if available["running"] == 0:
+        return WORK_ROOT  # An idle instance takes anything rather than deferring it forever
+    if memory <= available["memory"] and disk <= available["disk"]:
+        return WORK_ROOT
+    return None
+
+def fits_now(resources):
+    try:
+        with get_conn() as conn:
+            return admit(resources, available_resources(conn)) is not None
+    except Exception as e:
+        logger.error(f"Failed to check admission: {e}")
+        return True
+
+# --- Worker Pool ---
+# A fixed number of threads pull from the jobs table in FIFO order, so a burst
+# of requests queues up instead of starting dozens of encodes at once. The pool runs
+# in the web process (EMBEDDED_WORKERS) and/or in `python -m app worker` processes;
+# claims are atomic in SQLite, so any number of them can share one job store.
+
+_queue_cond = threading.Condition()
+_pool_threads = []
+_pool_lock = threading.Lock()
+_stopping = threading.Event()  # Set on SIGTERM in a standalone worker: finish running jobs, claim no more
+
+def default_pool_size():
+    """One slot per CPU, capped by how many encodes fit in the memory budget"""
+    by_cpu = os.cpu_count() or 1
+    by_memory = MEMORY_BUDGET_MB // max(JOB_MEMORY_MB, 1)
+    return max(1, min(by_cpu, by_memory))
+
+WORKER_POOL_SIZE = MAX_CONCURRENT_JOBS if MAX_CONCURRENT_JOBS > 0 else default_pool_size()
+
+def notify_workers():
+    """Wakes idle pool workers so a new job doesn't wait for the next poll"""
+    with _queue_cond:
+        _queue_cond.notify_all()
+
+def claim_next_job():
+    """
+    Atomically moves the first queued job (highest priority, then oldest) that fits the free
+    disk and memory to 'processing' and returns it. A job passed over for longer than
+    ADMISSION_MAX_DEFER_SECONDS holds back the ones behind it, so a big job isn't starved by
+    a stream of small ones. Jobs past their deadline are dropped rather than claimed.
+    """
+    expire_overdue_jobs()
+    try:
+        usage = scratch_usage()
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' AND (deadline IS NULL OR deadline >= ?) "
+                "ORDER BY priority DESC, created_at, rowid LIMIT ?",
+                (time.time(), ADMISSION_SCAN_LIMIT)
+            ).fetchall()
+            if not rows:
+                return None
+            available = available_resources(conn, usage)
+            now = time.time()
+            for row in rows:
+                resources = job_resources(row)
+                scratch = admit(resources, available)
+                if scratch:
+                    break
+                if row['id'] not in _deferred_jobs:
+                    _deferred_jobs.add(row['id'])
+                    logger.info(f"Job {row['id']} deferred: needs {resources['disk'] // MB} MB disk and "
+                                f"{resources['memory'] // MB} MB memory, {max(available['disk'], 0) // MB} MB "
+                                f"and {max(available['memory'], 0) // MB} MB free")
+                if now - row['created_at'] > ADMISSION_MAX_DEFER_SECONDS:
+                    return None
+            else:
+                return None
+            _deferred_jobs.discard(row['id'])
+            # A requeued job goes back to the root holding its checkpointed files
+            resources["scratch"] = resources.get("scratch") or scratch
+            conn.execute(
+                "UPDATE jobs SET status = 'processing', started_at = ?, updated_at = ?, "
+                "attempts = COALESCE(attempts, 0) + 1, worker_pid = ?, worker_host = ?, lease_expires_at = ?, "
+                "resources = ? WHERE id = ?",
+                (now, now, os.getpid(), HOSTNAME, now + JOB_LEASE_SECONDS, json.dumps(resources), row['id'])
+            )
+            return dict(row, resources=json.dumps(resources))
+    except Exception as e:
+        logger.error(f"Failed to claim job: {e}")
+        return None
+
+def run_claimed_job(job):
+    job_id = job['id']
+    func = JOB_FUNCTIONS.get(job['type'])
+    if func is None:
+        update_job(job_id, 'failed', error=f"Unknown job type: {job['type']}")
+        return
+    try:
+        kwargs = json.loads(job['params'] or '{}')
+    except ValueError as e:
+        update_job(job_id, 'failed', error=f"Corrupt job parameters: {e}")
+        return
+    logger.info(f"Job {job_id} started ({job['type']})")
+    _job_endpoints[job_id] = job_endpoint(job['type'])
+    _work_dirs[job_id] = job_resources(job).get("scratch") or WORK_ROOT
+    _lookahead_caps[job_id] = job_resources(job).get("lookahead")
+    with _cancel_lock:
+        _cancel_events[job_id] = threading.Event()
+    try:
+        worker_wrapper(job_id, func, **kwargs)
+    finally:
+        _job_endpoints.pop(job_id, None)
+        _work_dirs.pop(job_id, None)
+        _lookahead_caps.pop(job_id, None)
+        with _cancel_lock:
+            _cancel_events.pop(job_id, None)
+        notify_workers()  # Its reservation is released; a deferred job may fit now
+
+def pool_worker():
+    while not _stopping.is_set():
+        job = claim_next_job()
+        if job is None:
+            with _queue_cond:
+                _queue_cond.wait(QUEUE_POLL_INTERVAL)
+            continue
+        run_claimed_job(job)
+
+def renew_leases():
+    """Pushes back the lease of every job this process is running"""
+    job_ids = list(_work_dirs)
+    if not job_ids:
+        return
+    try:
+        with get_conn() as conn:
+            conn.execute(
+                f"UPDATE jobs SET lease_expires_at = ? WHERE id IN ({', '.join('?' * len(job_ids))}) "
+                "AND status = 'processing' AND worker_host = ? AND worker_pid = ?",
+                (time.time() + JOB_LEASE_SECONDS, *job_ids, HOSTNAME, os.getpid())
+            )
+    except Exception as e:
+        logger.error(f"Failed to renew job leases: {e}")
+
+def heartbeat():
+    """
+    Keeps this process's leases alive, requeues jobs whose worker stopped renewing theirs, settles
+    waiting jobs whose parents finished unnoticed and drops overdue jobs while every slot is busy
+    (idle workers drop them when claiming)
+    """
+    while True:
+        time.sleep(JOB_LEASE_SECONDS / 3)
+        renew_leases()
+        recover_orphaned_jobs()
+        settle_waiting_jobs()
+        expire_overdue_jobs()
+
+def start_worker_pool(size=None):
+    """Starts the pool threads and their heartbeat once per process"""
+    with _pool_lock:
+        if _pool_threads:
+            return
+        recover_orphaned_jobs()
+        settle_waiting_jobs()
+        size = size or WORKER_POOL_SIZE
+        for i in range(size):
+            thread = threading.Thread(target=pool_worker, name=f"job-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            _pool_threads.append(thread)
+        for target in (heartbeat, watch_cancellations):
+            thread = threading.Thread(target=target, name=f"job-{target.__name__.replace('_', '-')}")
+            thread.daemon = True
+            thread.start()
+        logger.info(f"Started worker pool with {size} slot(s) on {HOSTNAME}:{os.getpid()}")
+
+def run_worker(size=None):
+    """
+    Standalone worker process (`python -m app worker [slots]`): runs the pool without serving
+    HTTP. SIGTERM/SIGINT stop it claiming jobs; it exits once the running ones finish.
+    """
+    def stop(signum, frame):
+        logger.info(f"Received signal {signum}, finishing running jobs")
+        _stopping.set()
+        notify_workers()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    start_worker_pool(size)
+    for thread in _pool_threads:
+        while thread.is_alive():
+            thread.join(1)  # Short joins so the main thread keeps handling signals
+    # Webhooks of the jobs that just finished may still be being delivered (and retried)
+    callbacks = pending_callbacks()
+    if callbacks:
+        logger.info(f"Waiting for {len(callbacks)} callback delivery(ies)")
+    for thread in callbacks:
+        while thread.is_alive():
+            thread.join(1)
+    logger.info("Worker stopped")
+
+def average_job_seconds(conn):
+    """Mean run time of the last 20 completed jobs"""
+    return conn.execute(
+        "SELECT AVG(updated_at - started_at) FROM (SELECT updated_at, started_at FROM jobs "
+        "WHERE status = 'completed' AND started_at IS NOT NULL ORDER BY updated_at DESC LIMIT 20)"
+    ).fetchone()[0] or DEFAULT_JOB_SECONDS
+
+def get_queue_info(job):
+    """Queue position and estimated start time for a queued job"""
+    try:
+        with get_conn() as conn:
+            priority = job.get('priority') or 0
+            ahead = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND (priority > ? OR (priority = ? AND "
+                "(created_at < ? OR (created_at = ? AND rowid < (SELECT rowid FROM jobs WHERE id = ?)))))",
+                (priority, priority, job['created_at'], job['created_at'], job['id'])
+            ).fetchone()[0]
+            running = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'processing'"
+            ).fetchone()[0]
+            avg_seconds = average_job_seconds(conn)
+    except Exception as e:
+        logger.error(f"Failed to compute queue info for {job['id']}: {e}")
+        return {}
+
+    # Jobs that have to finish before a slot opens for this one, drained by all slots in parallel
+    must_finish = max(0, running + ahead + 1 - WORKER_POOL_SIZE)
+    wait_seconds = must_finish * avg_seconds / WORKER_POOL_SIZE
+    return {
+        "queue_position": ahead + 1,
+        "estimated_start_at": time.time() + wait_seconds,
+        "estimated_wait_seconds": round(wait_seconds, 1),
+    }
+
+# --- Core Logic Functions ---
+
+def _stream_to_file(response, local_path, job_id=None):
+    with open(local_path, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=8192):
+            check_cancelled(job_id)
+            f.write(chunk)
+
+def _store_response(url, r, local_path, job_id=None):
+    """Writes a 200 response into the cache (or straight to local_path if it can't be revalidated)"""
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    if not etag and not last_modified:
+        # Nothing to revalidate against, so caching would serve stale content
+        _stream_to_file(r, local_path, job_id)
+        return None
+
+    os.makedirs(DOWNLOAD_CACHE_DIR, exist_ok=True)
+    key = hashlib.sha256(f"{url}\n{etag}\n{last_modified}".encode()).hexdigest()
+    cache_path = os.path.join(DOWNLOAD_CACHE_DIR, key)
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex[:6]}.part"
+    try:
+        _stream_to_file(r, tmp_path, job_id)
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return _cache_store(url, cache_path, etag, last_modified)
+
+def download_file(url, local_path, job_id=None):
+    """
+    Fetches url into local_path (see _fetch_input) and records the download's time and size.
+    A job:<id> input is linked from the parent's kept output, or fetched from its uploaded URL.
+    """
+    check_cancelled(job_id)
+    started = time.time()
+    if is_job_ref(url):
+        artifact, url = resolve_job_ref(url)
+        if artifact:
+            link_or_copy(artifact, local_path)
+            record_job_stat(job_id, 'fetch', 'artifact')
+            return local_path
+    _fetch_input(url, local_path, job_id)
+    observe_stage(job_id, "download", time.time() - started, os.path.getsize(local_path))
+    return local_path
+
+def _fetch_input(url, local_path, job_id):
+    """
+    Fetches url into local_path, going through the shared input cache.
+    Cached files are revalidated with a conditional GET and hardlinked into the
+    job's work dir, so evicting a cache entry never pulls a file from under a running job.
+    """
+    if DOWNLOAD_CACHE_MAX_BYTES <= 0:
+        with _download_slots, HTTP_SESSION.get(url, stream=True) as r:
+            r.raise_for_status()
+            _stream_to_file(r, local_path, job_id)
+        return local_path
+
+    with _url_lock(url), _download_slots:
+        entry = _cache_lookup(url)
+        headers = {}
+        if entry and os.path.exists(entry['path']):
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        r = HTTP_SESSION.get(url, stream=True, headers=headers)
+        try:
+            if r.status_code == 304:
+                if headers and _cache_link(entry, local_path):
+                    record_job_stat(job_id, 'cache', 'hits')
+                    return local_path
+                # Entry vanished after revalidation; fetch the full body
+                r.close()
+                r = HTTP_SESSION.get(url, stream=True)
+
+            r.raise_for_status()
+            record_job_stat(job_id, 'cache', 'misses')
+            entry = _store_response(url, r, local_path, job_id)
+        finally:
+            r.close()
 
-    if not all([R2_ENDPOINT, R2_ACCESS_KEY, R2_SECRET_KEY, R2_BUCKET]):
-        return None, "R2 configuration missing"
+        if entry and not _cache_link(entry, local_path):
+            # Evicted by another process between storing and linking: a miss, so fetch this job's copy directly
+            logger.warning(f"Cached download of {url} disappeared before it could be used, downloading again")
+            with HTTP_SESSION.get(url, stream=True) as r:
+                r.raise_for_status()
+                _stream_to_file(r, local_path, job_id)
 
-    s3_client = boto3.client(
-        's3',
-        endpoint_url=R2_ENDPOINT,
-        aws_access_key_id=R2_ACCESS_KEY,
-        aws_secret_access_key=R2_SECRET_KEY
-    )
+    evict_download_cache()
+    return local_path
 
+def supports_partial_fetch(url):
+    """
+    True when the server honours Range requests and the source is an MP4/MOV,
+    so ffmpeg can read the moov atom and only the first seconds of mdat over HTTP.
+    """
+    if not PARTIAL_FETCH_ENABLED or not url.startswith(("http://", "https://")):
+        return False
     try:
-        s3_client.upload_file(file_path, R2_BUCKET, object_name)
-        # Construct public URL
-        url = f"{R2_PUBLIC_URL}/{object_name}"
-        return url, None
-    except NoCredentialsError:
-        return None, "Credentials not available"
+        with _download_slots, HTTP_SESSION.get(url, headers={'Range': 'bytes=0-11'}, stream=True, timeout=10) as r:
+            if r.status_code != 206:
+                return False
+            head = r.raw.read(12)
+            return head[4:8] == b'ftyp'
     except Exception as e:
-        return None, str(e)
+        logger.info(f"Range probe failed for {url}, using full download: {e}")
+        return False
 
-# --- Async Worker Logic ---
+# --- Probing ---
+# ffprobe run straight against an input URL reads the container header (for MP4, the moov box
+# via Range requests) rather than the whole file. URL results are kept in an LRU keyed by URL
+# and validator, so a source that changed is probed again.
 
-def worker_wrapper(job_id, func, **kwargs):
-    """Executes the function and updates job status"""
+_probe_cache = OrderedDict()  # (url, validator) -> run_ffprobe result
+_probe_cache_lock = threading.Lock()
+# Inputs must be fetched over the network; keeps ffprobe and partial-fetch trims (and playlists
+# they follow) off local files
+URL_PROBE_PROTOCOLS = "http,https,tcp,tls,crypto"
+
+def run_ffprobe(source, protocols=None, timeout=30, data_hash=False):
+    """
+    ffprobe's streams and format of a file or URL, or {"error": message} when it can't be read
+    ({"error": message, "timed_out": True} when it took longer than `timeout` seconds).
+    With data_hash, each stream carries an extradata_hash of its codec headers (SPS/PPS, AAC config).
+    """
+    cmd = ["ffprobe", "-v", "error"]
+    if protocols:
+        # A stalled server fails the read instead of holding ffprobe until the kill
+        cmd += ["-protocol_whitelist", protocols, "-rw_timeout", str(int(timeout * 1_000_000))]
+    if data_hash:
+        cmd += ["-show_data_hash", "SHA256"]
+    cmd += ["-show_streams", "-show_format", "-of", "json", source]
     try:
-        update_job(job_id, 'processing')
-        result_url = func(job_id, **kwargs) # Pass job_id to func
-        
-        if result_url:
-             update_job(job_id, 'completed', result={'url': result_url})
-        else:
-             # If func returns None but didn't raise exception (shouldn't happen with current logic)
-             update_job(job_id, 'failed', error="No URL returned")
-             
-    except Exception as e:
-        logger.error(f"Job {job_id} failed: {e}")
-        update_job(job_id, 'failed', error=str(e))
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, text=True)
+    except subprocess.TimeoutExpired:
+        return {"error": f"ffprobe timed out after {timeout}s", "timed_out": True}
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        return {"error": lines[-1] if lines else f"ffprobe exited with code {result.returncode}"}
+    try:
+        data = json.loads(result.stdout)
+    except ValueError:
+        return {"error": "ffprobe printed invalid JSON"}
+    return {"streams": data.get("streams", []), "format": data.get("format", {})}
 
-def start_async_job(func, **kwargs):
-    job_id = str(uuid.uuid4())
-    
-    # Insert initial job record directly into DB before thread starts
+def first_stream(probe, codec_type):
+    return next((st for st in probe.get("streams", []) if st.get("codec_type") == codec_type), None)
+
+def probe_url(url, heads=None, cached_only=False):
+    """
+    run_ffprobe of an input URL through the cache. `heads` may hold its head_input result
+    already. Sources without an ETag or Last-Modified are never cached. With cached_only,
+    a miss returns None instead of probing.
+    """
+    heads = fetch_heads([url], {} if heads is None else heads)
+    key = (url, heads[url][0])
+    if key[1]:
+        with _probe_cache_lock:
+            if key in _probe_cache:
+                _probe_cache.move_to_end(key)
+                return _probe_cache[key]
+    if cached_only:
+        return None
+    if not url.startswith(("http://", "https://")):
+        return {"error": "Not an http(s) URL"}
+    probe = run_ffprobe(url, protocols=URL_PROBE_PROTOCOLS, timeout=PROBE_TIMEOUT_SECONDS)
+    if key[1] and "error" not in probe and PROBE_CACHE_SIZE > 0:
+        with _probe_cache_lock:
+            _probe_cache[key] = probe
+            while len(_probe_cache) > PROBE_CACHE_SIZE:
+                _probe_cache.popitem(last=False)
+    return probe
+
+def probe_inputs(urls, heads, probes):
+    """Fills probes (url -> probe_url result) for the urls it doesn't have yet, several at a time"""
+    missing = [url for url in dict.fromkeys(urls) if url not in probes]
+    fetch_heads(missing, heads)
+    with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_CONCURRENCY, len(missing)))) as pool:
+        probes.update(zip(missing, pool.map(lambda url: probe_url(url, heads), missing)))
+    return probes
+
+def input_probe(url, path):
+    """Probe of a downloaded input: the cached URL probe when there is one, else ffprobe of the local copy"""
+    probe = probe_url(url, cached_only=True)
+    return probe if probe is not None else run_ffprobe(path)
+
+# Stream each input parameter has to carry; the jobs map it with -map N:v:0 / N:a:0 or filter it
+REQUIRED_STREAMS = {"video_urls": "video", "video_url": "video", "audio_url": "audio"}
+
+def validate_inputs(params, heads=None, probes=None):
+    """
+    Raises ValueError when an input can't be read, lacks the stream its job uses, or is too large.
+    Inputs whose probe timed out pass: the worker reads them without the request's time limit.
+    """
+    heads = {} if heads is None else heads
+    urls = [url for url in input_urls(params) if not is_job_ref(url)]
+    probes = probe_inputs(urls, heads, {} if probes is None else probes)
+    for name, codec_type in REQUIRED_STREAMS.items():
+        value = params.get(name)
+        for url in ([value] if isinstance(value, str) else value or []):
+            if is_job_ref(url):
+                continue  # Produced by another job, checked when it runs
+            probe = probes[url]
+            if probe.get("timed_out"):
+                logger.warning(f"Skipping validation of {url}: {probe['error']}")
+                continue
+            if "error" in probe:
+                raise ValueError(f"{name}: cannot read {url}: {probe['error']}")
+            stream = first_stream(probe, codec_type)
+            if stream is None:
+                raise ValueError(f"{name}: {url} has no {codec_type} stream")
+            pixels = (stream.get("width") or 0) * (stream.get("height") or 0)
+            if codec_type == "video" and MAX_INPUT_PIXELS and pixels > MAX_INPUT_PIXELS:
+                raise ValueError(f"{name}: {url} is {stream['width']}x{stream['height']}, "
+                                 f"above the {MAX_INPUT_PIXELS}-pixel limit")
+
+def _number(value, kind=float):
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            conn.execute(
-                "INSERT INTO jobs (id, status, created_at, updated_at, type) VALUES (?, ?, ?, ?, ?)",
-                (job_id, 'queued', time.time(), time.time(), func.__name__)
-            )
-    except Exception as e:
-        logger.error(f"Failed to create job record: {e}")
+        return kind(value)
+    except (TypeError, ValueError):
         return None
 
-    # Start background thread
-    thread = threading.Thread(target=worker_wrapper, args=(job_id, func), kwargs=kwargs)
-    thread.daemon = True 
-    thread.start()
-    
-    return job_id
+def probe_summary(url, probe):
+    """The parts of a probe POST /probe returns"""
+    if "error" in probe:
+        return {"url": url, "ok": False, "error": probe["error"]}
+    fmt = probe.get("format", {})
+    video = first_stream(probe, "video")
+    audio = first_stream(probe, "audio")
+    return {
+        "url": url,
+        "ok": True,
+        "format": fmt.get("format_name"),
+        "duration": _number(fmt.get("duration")),
+        "size": _number(fmt.get("size"), int),
+        "bit_rate": _number(fmt.get("bit_rate"), int),
+        "video": video and {
+            "codec": video.get("codec_name"),
+            "profile": video.get("profile"),
+            "width": video.get("width"),
+            "height": video.get("height"),
+            "pix_fmt": video.get("pix_fmt"),
+            "frame_rate": video.get("r_frame_rate"),
+        },
+        "audio": audio and {
+            "codec": audio.get("codec_name"),
+            "sample_rate": _number(audio.get("sample_rate"), int),
+            "channels": audio.get("channels"),
+        },
+    }
 
-# --- Core Logic Functions ---
+# Stream properties that have to match for the concat demuxer to stream-copy segments back to back
+VIDEO_SIGNATURE_KEYS = ("codec_name", "profile", "width", "height", "pix_fmt", "r_frame_rate",
+                        "time_base", "sample_aspect_ratio")
+AUDIO_SIGNATURE_KEYS = ("codec_name", "profile", "sample_rate", "channels", "channel_layout")
 
-def download_file(url, local_path):
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(local_path, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
-    return local_path
+def probe_streams(path):
+    """First video and first audio stream of a file as ffprobe dicts (None when absent)"""
+    probe = run_ffprobe(path, data_hash=True)
+    if "error" in probe:
+        logger.warning(f"ffprobe failed for {path}: {probe['error']}")
+        return None
+    return first_stream(probe, "video"), first_stream(probe, "audio")
+
+def stream_signature(streams):
+    video, audio = streams
+    return (
+        tuple(video.get(k) for k in VIDEO_SIGNATURE_KEYS) if video else None,
+        tuple(audio.get(k) for k in AUDIO_SIGNATURE_KEYS) if audio else None,
+    )
+
+def can_normalize(reference):
+    """libx264/aac can only reproduce an 8-bit 4:2:0 h264 reference with aac (or no) audio"""
+    video, audio = reference
+    return (bool(video) and video.get("codec_name") == "h264" and video.get("pix_fmt") == "yuv420p"
+            and (not audio or audio.get("codec_name") == "aac"))
+
+def codec_headers(streams):
+    """extradata hashes of a segment's streams; None when ffprobe didn't report one for the video"""
+    video, audio = streams
+    if not video.get("extradata_hash"):
+        return None
+    return video["extradata_hash"], audio.get("extradata_hash") if audio else None
+
+def annexb_cmd(source, output_path):
+    """Remuxes an MP4 segment to MPEG-TS, which repeats its SPS/PPS and AAC config in-band"""
+    return [
+        "ffmpeg", "-y",
+        "-i", source,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-c", "copy",
+        "-bsf:v", "h264_mp4toannexb",
+        "-f", "mpegts",
+        output_path,
+    ]
 
-def logic_concat(job_id, video_urls, trim_duration):
-    work_dir = f"/tmp/ffmpeg_work/{job_id}"
+def normalize_cmd(source, output_path, reference, profile=DEFAULT_ENCODE_PROFILE, job_id=None):
+    """Re-encodes one segment to the reference segment's stream parameters so it can be stream-copied with the rest"""
+    video, audio = reference
+    sar = (video.get("sample_aspect_ratio") or "1:1").replace(":", "/")
+    vf = f"scale={video['width']}:{video['height']},setsar={sar},fps={video['r_frame_rate']},format={video['pix_fmt']}"
+    h264_profile = (video.get("profile") or "high").lower().replace("constrained ", "")
+    cmd = [
+        "ffmpeg", "-y",
+        "-i", source,
+        "-vf", vf,
+        *x264_args(profile, encode_threads(), job_id),
+        "-profile:v", h264_profile,
+        "-video_track_timescale", video["time_base"].split("/")[1],
+    ]
+    if audio:
+        cmd += ["-c:a", "aac", "-b:a", AUDIO_BITRATE, "-ar", str(audio["sample_rate"]), "-ac", str(audio["channels"])]
+    else:
+        cmd += ["-an"]
+    cmd.append(output_path)
+    return cmd
+
+def plan_concat(trimmed_files, profile=None):
+    """
+    Decides how to join the trimmed segments. Anything but a re-encode passes the reference
+    streams through, so those must be what a re-encode would produce (h264 yuv420p, aac) and
+    no encode profile may have been asked for:
+      'copy'       every segment has the same stream signature and codec headers
+      'annexb'     same signature, different codec headers: joined as MPEG-TS, which carries them in-band
+      'normalize'  a minority differ and can be re-encoded to match the rest; joined like 'annexb'
+      'reencode'   a profile was given, probing failed, or the mismatch can't be fixed per segment
+    Returns (path, reference_streams, indexes_to_normalize).
+    """
+    if profile is not None:
+        return "reencode", None, []
+    probes = [probe_streams(path) for path in trimmed_files]
+    if any(p is None or p[0] is None for p in probes):
+        return "reencode", None, []
+    signatures = [stream_signature(p) for p in probes]
+    reference_signature = Counter(signatures).most_common(1)[0][0]
+    reference = probes[signatures.index(reference_signature)]
+    if not can_normalize(reference):
+        return "reencode", reference, []
+    mismatched = [i for i, sig in enumerate(signatures) if sig != reference_signature]
+    if not mismatched:
+        headers = {codec_headers(p) for p in probes}
+        return ("copy" if len(headers) == 1 and None not in headers else "annexb"), reference, []
+    # A segment without audio can't be stream-copied next to ones with it (and vice versa)
+    if any((probes[i][1] is None) != (reference[1] is None) for i in mismatched):
+        return "reencode", reference, []
+    return "normalize", reference, mismatched
+
+def logic_concat(job_id, video_urls, trim_duration, reencode=False, profile=None, output="mp4"):
+    work_dir = get_work_dir(job_id)
     os.makedirs(work_dir, exist_ok=True)
     
     try:
         # 1. Download and Trim
-        trimmed_files = []
-        for i, url in enumerate(video_urls):
-            input_path = os.path.join(work_dir, f"input_{i}.mp4")
-            download_file(url, input_path)
-            
-            trimmed_path = os.path.join(work_dir, f"trimmed_{i}.mp4")
-            
+        set_job_stage(job_id, "download")
+        # Inputs download concurrently; each trim starts as soon as its own input lands
+        def trim_cmd(source, trimmed_path, input_options=()):
             # Use 'make_zero' to reset timestamps prevent sync issues
             # Using copy for speed; if this fails or OOMs, we might need to re-encode (slow)
-            cmd = [
+            return [
                 "ffmpeg", "-y",
-                "-i", input_path,
+                *input_options,
+                "-i", source,
                 "-t", str(trim_duration),
                 "-c", "copy",
                 "-avoid_negative_ts", "make_zero",
                 trimmed_path
             ]
+
+        def fetch_and_trim(i, url):
+            trimmed_path = os.path.join(work_dir, f"trimmed_{i}.mp4")
+            if checkpointed_files(job_id, f"trimmed_{i}"):
+                return trimmed_path
+            
+            # Partial fetch: let ffmpeg seek the remote file with Range requests so only the
+            # moov atom and the first trim_duration seconds cross the network.
+            # Inputs already in the download cache are cheaper to revalidate than to re-read.
+            if not is_cached_input(url) and supports_partial_fetch(url):
+                with _download_slots:
+                    # Same protocols as a URL probe: the remote file must not lead ffmpeg to local ones
+                    input_options = ("-protocol_whitelist", URL_PROBE_PROTOCOLS, "-seekable", "1")
+                    success, error = run_ffmpeg(trim_cmd(url, trimmed_path, input_options), job_id=job_id)
+                if success:
+                    record_job_stat(job_id, 'fetch', 'partial')
+                    save_checkpoint(job_id, f"trimmed_{i}", [trimmed_path])
+                    return trimmed_path
+                logger.warning(f"Partial fetch failed for video {i}, falling back to full download: {error}")
             
-            success, error = run_ffmpeg(cmd, job_id=job_id)
+            input_path = os.path.join(work_dir, f"input_{i}.mp4")
+            download_file(url, input_path, job_id=job_id)
+            record_job_stat(job_id, 'fetch', 'full')
+            
+            success, error = run_ffmpeg(trim_cmd(input_path, trimmed_path), job_id=job_id)
             if not success:
                 raise Exception(f"Trim failed for video {i}: {error}")
             
-            trimmed_files.append(trimmed_path)
+            save_checkpoint(job_id, f"trimmed_{i}", [trimmed_path])
+            return trimmed_path
+
+        with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_CONCURRENCY, len(video_urls)))) as pool:
+            futures = [pool.submit(fetch_and_trim, i, url) for i, url in enumerate(video_urls)]
+            try:
+                trimmed_files = [future.result() for future in futures]
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        # 2. Pick the concat path: stream copy when every segment matches, re-encode only when forced
+        # or when the segments can't be made compatible one by one
+        started = time.time()
+        concat_path, reference, mismatched = ("reencode", None, []) if reencode else plan_concat(trimmed_files, profile)
+        profile = profile or DEFAULT_ENCODE_PROFILE
+        for i in mismatched:
+            normalized_path = os.path.join(work_dir, f"normalized_{i}.mp4")
+            success, error = run_ffmpeg(normalize_cmd(trimmed_files[i], normalized_path, reference, profile, job_id),
+                                        job_id=job_id)
+            if not success:
+                raise Exception(f"Normalize failed for video {i}: {error}")
+            trimmed_files[i] = normalized_path
+        if concat_path in ("annexb", "normalize"):
+            # The MP4 sample entry only holds the first segment's SPS/PPS: carry every segment's own in-band
+            for i, path in enumerate(trimmed_files):
+                ts_path = os.path.join(work_dir, f"annexb_{i}.ts")
+                success, error = run_ffmpeg(annexb_cmd(path, ts_path), job_id=job_id)
+                if not success:
+                    raise Exception(f"Remux to MPEG-TS failed for video {i}: {error}")
+                trimmed_files[i] = ts_path
+        normalize_seconds = time.time() - started
 
-        # 2. Create Concat List
         list_path = os.path.join(work_dir, "list.txt")
         with open(list_path, "w") as f:
             for path in trimmed_files:
                 f.write(f"file '{path}'\n")
 
-        # 3. Concatenate with re-encoding for smooth transitions
+        # 3. Concatenate
         output_filename = f"concat_{uuid.uuid4().hex}.mp4"
         output_path = os.path.join(work_dir, output_filename)
+        duration = sum(filter(None, map(probe_duration, trimmed_files))) or None
         
         cmd = [
             "ffmpeg", "-y",
             "-f", "concat",
             "-safe", "0",
             "-i", list_path,
-            "-c:v", "libx264",
-            "-preset", "medium",
-            "-crf", "23",
-            "-pix_fmt", "yuv420p",
-            "-c:a", "aac",
-            "-b:a", "128k",
-            output_path
         ]
+        if concat_path == "reencode":
+            # Re-encode for smooth transitions between mismatched clips
+            cmd += [
+                *x264_args(profile, encode_threads(), job_id),
+                "-pix_fmt", "yuv420p",
+                "-c:a", "aac",
+                "-b:a", AUDIO_BITRATE,
+            ]
+        else:
+            cmd += ["-c", "copy"]
+            if concat_path != "copy" and reference[1]:
+                cmd += ["-bsf:a", "aac_adtstoasc"]
+        cmd.append(output_path)
         
-        success, error = run_ffmpeg(cmd, job_id=job_id)
-        if not success:
-             raise Exception(f"Concat failed: {error}")
-
-        # 4. Upload
-        url, error = upload_to_r2(output_path, output_filename)
-        if error:
-            raise Exception(f"Upload failed: {error}")
-            
-        return url
+        set_job_stat(job_id, 'concat', 'path', concat_path)
+        if concat_path != "reencode":
+            set_job_stat(job_id, 'concat', 'normalized_segments', mismatched)
+            if duration:
+                saved = estimate_encode_seconds(duration) - normalize_seconds
+                set_job_stat(job_id, 'concat', 'estimated_seconds_saved', round(max(saved, 0), 1))
+        logger.info(f"Job {job_id} concat path: {concat_path} (normalized {len(mismatched)} segment(s))")
+        
+        # 4. Encode (or mux) and upload
+        return encode_and_upload(cmd, output_path, output_filename, "Concat failed", job_id=job_id,
+                                 duration=duration, stage="encode" if concat_path == "reencode" else "mux",
+                                 output=output)
         
     finally:
         shutil.rmtree(work_dir, ignore_errors=True)
 
-def logic_merge_audio(job_id, video_url, audio_url, shortest):
-    work_dir = f"/tmp/ffmpeg_work/{job_id}"
+def logic_merge_audio(job_id, video_url, audio_url, shortest, output="mp4"):
+    """
+    Muxes the video track with an audio input's normalized AAC (see fetch_audio_asset),
+    stream-copying both. With shortest, the cut point comes from the probed durations,
+    which is exact where -shortest with stream copy overshoots by up to a packet run.
+    """
+    work_dir = get_work_dir(job_id)
     os.makedirs(work_dir, exist_ok=True)
     
     try:
         video_path = os.path.join(work_dir, "input_video.mp4")
-        audio_path = os.path.join(work_dir, "input_audio.mp3")
+        audio_path = os.path.join(work_dir, "input_audio.m4a")
         output_filename = f"merged_{uuid.uuid4().hex}.mp4"
         output_path = os.path.join(work_dir, output_filename)
         
-        download_file(video_url, video_path)
-        download_file(audio_url, audio_path)
-        
+        if not checkpointed_files(job_id, "inputs"):
+            set_job_stage(job_id, "download")
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                video = pool.submit(download_file, video_url, video_path, job_id=job_id)
+                audio = pool.submit(fetch_audio_asset, job_id, audio_url, audio_path, work_dir)
+                video.result(), audio.result()
+            save_checkpoint(job_id, "inputs", [video_path, audio_path])
+
         cmd = [
             "ffmpeg", "-y",
             "-i", video_path,
             "-i", audio_path,
-            "-c:v", "copy",
-            "-c:a", "aac",
+            "-c", "copy",
             "-map", "0:v:0",
             "-map", "1:a:0"
         ]
         
         if shortest:
-            cmd.append("-shortest")
+            durations = [probe_duration(video_path), probe_duration(audio_path)]
+            if all(durations):
+                cmd += ["-t", f"{min(durations):.3f}"]
+            else:
+                cmd.append("-shortest")
             
         cmd.append(output_path)
         
-        success, error = run_ffmpeg(cmd, job_id=job_id)
-        if not success: raise Exception(f"Merge failed: {error}")
-        
-        url, error = upload_to_r2(output_path, output_filename)
-        if error: raise Exception(f"Upload failed: {error}")
-        return url
+        return encode_and_upload(cmd, output_path, output_filename, "Merge failed", job_id=job_id, stage="mux",
+                                 output=output)
 
     finally:
         shutil.rmtree(work_dir, ignore_errors=True)
 
-def logic_add_subtitles(job_id, video_url, subtitle_content, format):
-    work_dir = f"/tmp/ffmpeg_work/{job_id}"
+def segment_parallelism():
+    """How many segments one job may encode at once: its share of the thread budget, given the pool size"""
+    if SEGMENT_PARALLELISM > 0:
+        return SEGMENT_PARALLELISM
+    return max(1, X264_THREAD_BUDGET // WORKER_POOL_SIZE)
+
+def split_segments(job_id, input_path, segment_list, segment_time):
+    """Stream-copies the video track into keyframe-aligned segments, listed as name,start,end in a CSV"""
+    cmd = [
+        "ffmpeg", "-y",
+        "-i", input_path,
+        "-map", "0:v:0",
+        "-c", "copy",
+        # Keep B-frame streams unshifted so the listed start times match frame timestamps
+        "-avoid_negative_ts", "disabled",
+        "-f", "segment",
+        "-segment_time", f"{segment_time:.3f}",
+        "-reset_timestamps", "1",
+        "-segment_list", segment_list,
+        "-segment_list_type", "csv",
+        os.path.join(os.path.dirname(segment_list), "source_%03d.mp4")
+    ]
+    success, error = run_ffmpeg(cmd, job_id=job_id)
+    if not success:
+        raise Exception(f"Segment split failed: {error}")
+
+def encode_segments(job_id, input_path, work_dir, video_filter, duration, parallelism,
+                    profile=DEFAULT_ENCODE_PROFILE, timeout=600):
+    """
+    Splits the video stream at keyframes into ~parallelism segments, runs video_filter and
+    libx264 on each in parallel, and returns the encoded segment paths in order.
+
+    Each segment's timestamps are shifted back to its position in the source while the
+    filter runs, so time-based filters (ass subtitles) see the same clock as a single pass.
+    Segments are cut on keyframes with stream copy, so every source frame lands in exactly one.
+    The split and each encoded segment are checkpointed, so a resumed job only redoes the rest.
+    Returns None when the encoded segments differ in stream signature or codec headers (as
+    plan_concat checks them), since the concat demuxer can't stream-copy them into one file;
+    the caller then encodes in a single pass.
+    """
+    segment_dir = os.path.join(work_dir, "segments")
+    os.makedirs(segment_dir, exist_ok=True)
+    segment_list = os.path.join(segment_dir, "segments.csv")
+    if not checkpointed_files(job_id, "split"):
+        split_segments(job_id, input_path, segment_list, duration / parallelism)
+        save_checkpoint(job_id, "split", [segment_list])
+
+    # CSV rows: filename,start,end (seconds in the source timeline)
+    with open(segment_list) as f:
+        segments = [(os.path.join(segment_dir, name), float(start))
+                    for name, start, _end in (line.strip().split(",") for line in f if line.strip())]
+    mark_stage(job_id, "encode")
+    threads = encode_threads(share=min(parallelism, len(segments)))
+    logger.info(f"Job {job_id} encoding {len(segments)} segment(s) in parallel, {threads} thread(s) each")
+
+    done = []
+    done_lock = threading.Lock()
+
+    def encode(index, source, start):
+        encoded_path = os.path.join(segment_dir, f"encoded_{index:03d}.mp4")
+        if not checkpointed_files(job_id, f"segment_{index}"):
+            cmd = [
+                "ffmpeg", "-y",
+                "-i", source,
+                "-vf", f"setpts=PTS-STARTPTS+{start}/TB,{video_filter},setpts=PTS-STARTPTS",
+                *x264_args(profile, threads, job_id),
+                "-an",
+                encoded_path
+            ]
+            success, error = run_ffmpeg(cmd, timeout=timeout, job_id=job_id)
+            if not success:
+                raise Exception(f"Segment {index} encode failed: {error}")
+            save_checkpoint(job_id, f"segment_{index}", [encoded_path])
+        with done_lock:
+            done.append(index)
+            set_job_progress(job_id, {"stage": "encode", "percent": round(len(done) / len(segments) * 100, 1),
+                                      "segments_done": len(done), "segments": len(segments)})
+        return encoded_path
+
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        futures = [pool.submit(encode, i, source, start) for i, (source, start) in enumerate(segments)]
+        try:
+            encoded = [future.result() for future in futures]
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+
+    probes = [probe_streams(path) for path in encoded]
+    joinable = all(p is not None and p[0] is not None for p in probes)
+    if joinable:
+        headers = {codec_headers(p) for p in probes}
+        joinable = len({stream_signature(p) for p in probes}) == 1 and len(headers) == 1 and None not in headers
+    if not joinable:
+        logger.warning(f"Job {job_id}: encoded segments differ in stream parameters, encoding in a single pass")
+        set_job_stat(job_id, 'encode', 'segments_discarded', len(encoded))
+        shutil.rmtree(segment_dir, ignore_errors=True)
+        return None
+    return encoded
+
+def logic_add_subtitles(job_id, video_url, subtitle_content, format, profile=DEFAULT_ENCODE_PROFILE,
+                        output="mp4"):
+    work_dir = get_work_dir(job_id)
     os.makedirs(work_dir, exist_ok=True)
     
     try:
@@ -340,7 +3299,10 @@ def logic_add_subtitles(job_id, video_url, subtitle_content, format):
         output_filename = f"subtitled_{uuid.uuid4().hex}.mp4"
         output_path = os.path.join(work_dir, output_filename)
         
-        download_file(video_url, video_path)
+        if not checkpointed_files(job_id, "inputs"):
+            set_job_stage(job_id, "download")
+            download_file(video_url, video_path, job_id=job_id)
+            save_checkpoint(job_id, "inputs", [video_path])
         
         # Write subtitle file with .ass extension (ass filter requires .ass extension)
         sub_path = os.path.join(work_dir, "subtitle.ass")
@@ -352,36 +3314,338 @@ def logic_add_subtitles(job_id, video_url, subtitle_content, format):
         with open(sub_path, "w") as f:
             f.write(subtitle_content)
             
+        # Long videos: burn subtitles into keyframe-aligned segments in parallel,
+        # then stitch them losslessly with the original audio (a single pass if they can't be)
+        parallelism = segment_parallelism()
+        duration = probe_duration(video_path)
+        encoded = None
+        if parallelism > 1 and duration and duration >= SEGMENT_MIN_DURATION:
+            encoded = encode_segments(job_id, video_path, work_dir, f"ass={sub_path}", duration, parallelism, profile)
+        if encoded:
+            list_path = os.path.join(work_dir, "list.txt")
+            with open(list_path, "w") as f:
+                for path in encoded:
+                    f.write(f"file '{path}'\n")
+            cmd = [
+                "ffmpeg", "-y",
+                "-f", "concat",
+                "-safe", "0",
+                "-i", list_path,
+                "-i", video_path,
+                "-map", "0:v:0",
+                "-map", "1:a?",  # Keep original audio, if any
+                "-c", "copy",
+                output_path
+            ]
+            set_job_stat(job_id, 'encode', 'segments', len(encoded))
+            return encode_and_upload(cmd, output_path, output_filename, "Subtitle stitch failed",
+                                     job_id=job_id, duration=duration, stage="mux", output=output)
+            
         # Hardcode subtitles using the 'ass' filter
         # Must re-encode video to burn in subtitles (filters require encoding)
         cmd = [
             "ffmpeg", "-y",
             "-i", video_path,
             "-vf", f"ass={sub_path}",
-            "-c:v", "libx264",
-            "-preset", "medium",  # Balanced speed/quality
-            "-crf", "23",
+            *x264_args(profile, encode_threads(), job_id),
             "-c:a", "copy",  # Keep original audio
             output_path
         ]
         
-        success, error = run_ffmpeg(cmd, timeout=600, job_id=job_id)  # Increased timeout
-        if not success: raise Exception(f"Subtitle burn failed: {error}")
+        return encode_and_upload(cmd, output_path, output_filename, "Subtitle burn failed",
+                                 timeout=600, job_id=job_id, output=output)  # Increased timeout
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def logic_pipeline(job_id, video_urls, trim_duration, audio_url, subtitle_content=None, shortest=True,
+                   profile=DEFAULT_ENCODE_PROFILE, output="mp4"):
+    """
+    Concat + merge-audio + burn-subtitles in one ffmpeg run.
+    One filtergraph means a single decode, a single libx264 encode and a single upload,
+    instead of three round trips through R2 and two encode passes.
+    """
+    work_dir = get_work_dir(job_id)
+    os.makedirs(work_dir, exist_ok=True)
+    
+    try:
+        # 1. Download inputs concurrently
+        video_paths = [os.path.join(work_dir, f"input_{i}.mp4") for i in range(len(video_urls))]
+        audio_path = os.path.join(work_dir, "input_audio.mp3")
+        downloads = list(zip(video_urls, video_paths)) + [(audio_url, audio_path)]
+        if not checkpointed_files(job_id, "inputs"):
+            set_job_stage(job_id, "download")
+            with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_CONCURRENCY, len(downloads)))) as pool:
+                for future in [pool.submit(download_file, url, path, job_id=job_id) for url, path in downloads]:
+                    future.result()
+            save_checkpoint(job_id, "inputs", [path for _url, path in downloads])
         
-        url, error = upload_to_r2(output_path, output_filename)
-        if error: raise Exception(f"Upload failed: {error}")
-        return url
+        sub_path = None
+        if subtitle_content:
+            sub_path = os.path.join(work_dir, "subtitle.ass")
+            with open(sub_path, "w") as f:
+                f.write(subtitle_content)
+        
+        # 2. Build the filtergraph: trim happens on the input side with -t,
+        # timestamps are reset per clip, then concat -> ass
+        cmd = ["ffmpeg", "-y"]
+        for path in video_paths:
+            cmd += ["-t", str(trim_duration), "-i", path]
+        cmd += ["-i", audio_path]
+        audio_index = len(video_paths)
+        
+        graph = [f"[{i}:v:0]setpts=PTS-STARTPTS[v{i}]" for i in range(len(video_paths))]
+        concat_inputs = "".join(f"[v{i}]" for i in range(len(video_paths)))
+        graph.append(f"{concat_inputs}concat=n={len(video_paths)}:v=1:a=0[vcat]")
+        if sub_path:
+            graph.append(f"[vcat]ass={sub_path}[vout]")
+            video_label = "[vout]"
+        else:
+            video_label = "[vcat]"
+        
+        output_filename = f"pipeline_{uuid.uuid4().hex}.mp4"
+        output_path = os.path.join(work_dir, output_filename)
+        
+        cmd += [
+            "-filter_complex", ";".join(graph),
+            "-map", video_label,
+            "-map", f"{audio_index}:a:0",
+            *x264_args(profile, encode_threads(), job_id),
+            "-pix_fmt", "yuv420p",
+            "-c:a", "aac",
+            "-b:a", AUDIO_BITRATE
+        ]
+        
+        if shortest:
+            cmd.append("-shortest")
+        
+        cmd.append(output_path)
+        
+        # 3. Single encode and single upload
+        return encode_and_upload(cmd, output_path, output_filename, "Pipeline failed",
+                                 timeout=600, job_id=job_id, duration=float(trim_duration) * len(video_urls),
+                                 output=output)
 
     finally:
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+# --- Request Fingerprinting ---
+# Identical submissions (e.g. n8n retries) resolve to the same job instead of re-encoding.
+
+INPUT_URL_PARAMS = ("video_urls", "video_url", "audio_url")
+
+def head_input(url):
+    """
+    (validator, size) of an input from a HEAD request. The validator (ETag or Last-Modified)
+    keeps a changed source from matching an old job; the size feeds admission control.
+    """
+    if is_job_ref(url):
+        return None, None  # Another job's output, which doesn't exist yet
+    try:
+        r = HTTP_SESSION.head(url, allow_redirects=True, timeout=5)
+        size = r.headers.get('Content-Length')
+        return r.headers.get('ETag') or r.headers.get('Last-Modified'), int(size) if size and size.isdigit() else None
+    except Exception as e:
+        logger.info(f"Could not fetch validator for {url}: {e}")
+        return None, None
+
+def fetch_heads(urls, heads):
+    """Fills heads (url -> head_input result) for the urls it doesn't have yet"""
+    missing = [url for url in dict.fromkeys(urls) if url not in heads]
+    with ThreadPoolExecutor(max_workers=max(1, min(DOWNLOAD_CONCURRENCY, len(missing)))) as pool:
+        heads.update(zip(missing, pool.map(head_input, missing)))
+    return heads
+
+def input_urls(params):
+    urls = []
+    for name in INPUT_URL_PARAMS:
+        value = params.get(name)
+        if isinstance(value, str):
+            urls.append(value)
+        elif isinstance(value, list):
+            urls.extend(value)
+    return urls
+
+def request_fingerprint(job_type, params, idempotency_key=None, heads=None, intermediate=False):
+    """
+    `heads` may hold url -> (validator, size) already fetched (a batch shares one dict across its jobs).
+    An intermediate request never matches a regular one: their outputs end up in different places.
+    """
+    if idempotency_key:
+        basis = {"type": job_type, "idempotency_key": idempotency_key}
+    else:
+        urls = input_urls(params)
+        heads = fetch_heads(urls, {} if heads is None else heads)
+        # Concat without a profile only encodes with the default one, and may not encode at all
+        profile = ENCODE_PROFILES.get(params["profile"] or DEFAULT_ENCODE_PROFILE) if "profile" in params else None
+        basis = {
+            "type": job_type,
+            "params": params,
+            "validators": {url: heads[url][0] for url in urls},
+            "encode": {"profile": profile, "audio_bitrate": AUDIO_BITRATE,
+                       "audio_asset": audio_asset_settings() if job_type == "logic_merge_audio" else None},
+        }
+    if intermediate:
+        basis["intermediate"] = True
+    return hashlib.sha256(json.dumps(basis, sort_keys=True).encode()).hexdigest()
+
+def reuses_completed(params, idempotency_key=None, heads=None):
+    """
+    Whether a completed job with the same fingerprint may answer the request. Without an ETag or
+    Last-Modified for every input, the source may have changed behind the same URL, so only a
+    job still in flight is shared. An Idempotency-Key always names the same request.
+    """
+    if idempotency_key:
+        return True
+    urls = input_urls(params)
+    heads = fetch_heads(urls, {} if heads is None else heads)
+    return all(is_job_ref(url) or heads[url][0] for url in urls)
+
+
+# Maps the `type` column back to the function a pool worker should run
+JOB_FUNCTIONS = {
+    func.__name__: func
+    for func in (logic_concat, logic_merge_audio, logic_add_subtitles, logic_pipeline)
+}
+
+
+# --- Job Specs ---
+# Request bodies -> (logic function, kwargs), shared by the per-operation endpoints and /batch.
+# Each parser raises ValueError with the message returned to the client.
+
+def parse_profile(data):
+    profile = data.get("profile", DEFAULT_ENCODE_PROFILE)
+    if profile not in ENCODE_PROFILES:
+        raise ValueError(f"Unknown profile, expected one of {sorted(ENCODE_PROFILES)}")
+    return profile
+
+OUTPUT_FORMATS = ("mp4", "hls")
+
+def parse_output(data):
+    """mp4: one file uploaded when ready; hls: segments uploaded as they are encoded, result is the playlist"""
+    output = data.get("output", "mp4")
+    if output not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output, expected one of {list(OUTPUT_FORMATS)}")
+    return output
+
+def parse_concat(data):
+    video_urls = data.get("video_urls")
+    if not video_urls:
+        raise ValueError("Missing video_urls")
+    return logic_concat, dict(
+        video_urls=video_urls,
+        trim_duration=data.get("trim_duration", 5),
+        reencode=bool(data.get("reencode", False)),  # Force the exact libx264 re-encode path
+        profile=parse_profile(data) if "profile" in data else None,  # An explicit profile re-encodes
+        output=parse_output(data),
+    )
+
+def parse_merge_audio(data):
+    video_url = data.get("video_url")
+    audio_url = data.get("audio_url")
+    if not video_url or not audio_url:
+        raise ValueError("Missing video_url or audio_url")
+    return logic_merge_audio, dict(video_url=video_url, audio_url=audio_url, shortest=data.get("shortest", False),
+                                   output=parse_output(data))
+
+def parse_add_subtitles(data):
+    video_url = data.get("video_url")
+    subtitle_content = data.get("subtitle_content")
+    if not video_url or not subtitle_content:
+        raise ValueError("Missing video_url or subtitle_content")
+    return logic_add_subtitles, dict(
+        video_url=video_url,
+        subtitle_content=subtitle_content,
+        format=data.get("format", "srt"),
+        profile=parse_profile(data),
+        output=parse_output(data),
+    )
+
+def parse_pipeline(data):
+    video_urls = data.get("video_urls")
+    audio_url = data.get("audio_url")
+    if not video_urls or not audio_url:
+        raise ValueError("Missing video_urls or audio_url")
+    return logic_pipeline, dict(
+        video_urls=video_urls,
+        trim_duration=data.get("trim_duration", 5),
+        audio_url=audio_url,
+        subtitle_content=data.get("subtitle_content"),
+        shortest=data.get("shortest", True),
+        profile=parse_profile(data),
+        output=parse_output(data),
+    )
+
+JOB_SPECS = {
+    "concat": parse_concat,
+    "merge-audio": parse_merge_audio,
+    "add-subtitles": parse_add_subtitles,
+    "pipeline": parse_pipeline,
+}
+
+def parse_callback_url(data):
+    callback_url = data.get("callback_url")
+    if callback_url and not callback_url.startswith(("http://", "https://")):
+        raise ValueError("callback_url must be an http(s) URL")
+    return callback_url
+
+def parse_deadline(data):
+    """Epoch seconds from `deadline` (absolute) or `deadline_seconds` (from now), else None"""
+    deadline, seconds = data.get("deadline"), data.get("deadline_seconds")
+    if deadline is not None and seconds is not None:
+        raise ValueError("Give either deadline or deadline_seconds, not both")
+    for name, value in (("deadline", deadline), ("deadline_seconds", seconds)):
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f"{name} must be a number")
+    if seconds is not None:
+        deadline = time.time() + seconds
+    if deadline is not None and deadline <= time.time():
+        raise ValueError("deadline has already passed")
+    return deadline
+
+def parse_job_options(data, kwargs):
+    """
+    Options any operation accepts: callback_url, intermediate (keep the output for later
+    job:<id> inputs instead of uploading it), depends_on (a job id or a list of them),
+    priority (integer, higher runs first) and a deadline (see parse_deadline).
+    Parents referenced as job:<id> inputs are dependencies whether listed or not.
+    """
+    priority = data.get("priority", 0)
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        raise ValueError("priority must be an integer")
+    depends_on = data.get("depends_on") or []
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    if not isinstance(depends_on, list) or not all(isinstance(job_id, str) for job_id in depends_on):
+        raise ValueError("depends_on must be a job id or a list of job ids")
+    depends_on = list(dict.fromkeys(
+        depends_on + [url[len(JOB_REF_PREFIX):] for url in input_urls(kwargs) if is_job_ref(url)]
+    ))
+    check_dependencies(depends_on)
+    return dict(
+        callback_url=parse_callback_url(data),
+        depends_on=depends_on,
+        intermediate=bool(data.get("intermediate", False)),
+        priority=priority,
+        deadline=parse_deadline(data),
+    )
+
+
 # --- API Endpoints ---
 
 @app.route("/health", methods=["GET"])
 def health():
     return jsonify({"status": "healthy", "service": "ffmpeg-api-async-sqlite"}), 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus exposition; like /health it needs no API key"""
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(prometheus_client.generate_latest(METRICS_REGISTRY),
+                    content_type=prometheus_client.CONTENT_TYPE_LATEST)
+
 def require_api_key(func):
     def wrapper(*args, **kwargs):
         if request.headers.get("X-API-Key") != FFMPEG_API_KEY:
@@ -390,57 +3654,268 @@ def require_api_key(func):
     wrapper.__name__ = func.__name__
     return wrapper
 
+def submit_job(kind, data):
+    """Enqueues a job, or returns the matching one for a repeated request"""
+    data = data or {}
+    try:
+        func, kwargs = JOB_SPECS[kind](data)
+        options = parse_job_options(data, kwargs)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    heads, probes = {}, {}
+    if PROBE_VALIDATION:
+        try:
+            validate_inputs(kwargs, heads, probes)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    idempotency_key = request.headers.get("Idempotency-Key")
+    fingerprint = request_fingerprint(func.__name__, kwargs, idempotency_key, heads, options["intermediate"])
+    reuse_completed = reuses_completed(kwargs, idempotency_key, heads)
+    resources = estimate_job_resources(func.__name__, kwargs, heads, probes)
+    if ADMISSION_REJECT and not fits_now(resources):
+        with get_conn() as conn:
+            existing = matching_job(conn, fingerprint, reuse_completed)
+            retry_after = max(1, round(average_job_seconds(conn)))
+        if not existing:
+            response = jsonify({"error": "Not enough free disk or memory for this job, retry later",
+                                "disk_bytes": resources["disk"], "memory_bytes": resources["memory"]})
+            return response, 429, {"Retry-After": str(retry_after)}
+    job_id = start_async_job(func, fingerprint=fingerprint, resources=resources, reuse_completed=reuse_completed,
+                             **options, **kwargs)
+    if not job_id:
+         return jsonify({"error": "Failed to start job"}), 500
+
+    job = get_job_from_db(job_id) or {"status": "queued"}
+    if job['status'] == 'completed':
+        if options["callback_url"]:
+            # The caller is waiting on its webhook, which the original run fired before it was added
+            schedule_callback(job_id, [options["callback_url"]])
+        return jsonify({"job_id": job_id, "status": job['status'], "result": job['result']}), 200
+    return jsonify({"job_id": job_id, "status": job['status']}), 202
+
+@app.route("/probe", methods=["POST"])
+@require_api_key
+def probe():
+    """Stream metadata of input URLs: {"urls": [...]} -> {"results": [...]} in the same order"""
+    urls = (request.json or {}).get("urls")
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+        return jsonify({"error": "Missing urls"}), 400
+    if len(urls) > PROBE_MAX_URLS:
+        return jsonify({"error": f"At most {PROBE_MAX_URLS} urls per request"}), 400
+    probes = probe_inputs(urls, {}, {})
+    return jsonify({"results": [probe_summary(url, probes[url]) for url in urls]})
+
+@app.route("/stats", methods=["GET"])
+@require_api_key
+def get_stats():
+    """
+    ffmpeg resource usage aggregated by job type, for capacity planning:
+    ?since=<epoch> (default: the last day)&status=completed,failed
+    """
+    since = request.args.get("since", type=float)
+    if since is None:
+        since = time.time() - STATS_DEFAULT_WINDOW_SECONDS
+    statuses = [x for x in request.args.get("status", "").split(",") if x]
+    try:
+        return jsonify(usage_stats(since, statuses))
+    except Exception as e:
+        logger.error(f"Failed to aggregate stats: {e}")
+        return jsonify({"error": "Failed to aggregate stats"}), 500
+
+@app.route("/tasks", methods=["GET"])
+@require_api_key
+def list_tasks():
+    """Paginated job listing: ?status=queued,processing&since=<epoch>&limit=50&cursor=<next_cursor>"""
+    statuses = [x for x in request.args.get("status", "").split(",") if x]
+    since = request.args.get("since", type=float)
+    limit = max(1, min(request.args.get("limit", 50, type=int), 500))
+    cursor = None
+    if request.args.get("cursor"):
+        try:
+            created_at, rowid = request.args["cursor"].split(":")
+            cursor = (float(created_at), int(rowid))
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    try:
+        jobs, next_cursor = list_jobs(statuses, since, limit, cursor)
+    except Exception as e:
+        logger.error(f"Failed to list jobs: {e}")
+        return jsonify({"error": "Failed to list jobs"}), 500
+    return jsonify({"jobs": [job_view(job, queue_info=False) for job in jobs], "next_cursor": next_cursor})
+
 @app.route("/tasks/<job_id>", methods=["GET"])
 @require_api_key
 def get_task(job_id):
+    """Job status; with ?wait=N, holds the request until the status changes or N seconds pass"""
+    job = get_job_from_db(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+
+    wait = min(request.args.get("wait", 0, type=float), MAX_LONG_POLL_SECONDS)
+    if wait > 0 and job['status'] not in TERMINAL_STATUSES:
+        status = job['status']
+        deadline = time.time() + wait
+        # Progress updates don't end a long-poll; only a status change does
+        while job and job['status'] == status and time.time() < deadline:
+            job = wait_for_job_change(job_id, job_state(job), deadline - time.time())
+        if not job:
+            return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_view(job))
+
+@app.route("/tasks/<job_id>", methods=["DELETE"])
+@require_api_key
+def cancel_task(job_id):
+    """
+    Cancels a job. A waiting or queued job is cancelled at once (200); a running one is
+    stopped by its worker (202), after which the job reads 'cancelled'. A job that identical
+    requests share (see request_fingerprint) keeps running until the last of them cancels:
+    until then the reply is 200 with the job as it is and how many requests still share it.
+    """
+    try:
+        status, submitters = cancel_job(job_id)
+    except Exception as e:
+        logger.error(f"Failed to cancel job {job_id}: {e}")
+        return jsonify({"error": "Failed to cancel job"}), 500
+    if status is None:
+        return jsonify({"error": "Job not found"}), 404
+    if status in TERMINAL_STATUSES:
+        return jsonify({"error": f"Job already {status}"}), 409
+    job = job_view(get_job_from_db(job_id))
+    if submitters:
+        return jsonify({**job, "submitters": submitters}), 200
+    return jsonify(job), 202 if status == 'processing' else 200
+
+@app.route("/tasks/<job_id>/events", methods=["GET"])
+@require_api_key
+def stream_task_events(job_id):
+    """Server-sent events: 'progress' while the job runs, 'status' on each status change"""
     job = get_job_from_db(job_id)
     if not job:
         return jsonify({"error": "Job not found"}), 404
-    return jsonify(dict(job)) # Convert Row to dict
+
+    def events():
+        current = job
+        last_status = last_progress = None
+        while current:
+            if current['status'] != last_status:
+                last_status = current['status']
+                yield f"event: status\ndata: {json.dumps(job_view(current))}\n\n"
+                if last_status in TERMINAL_STATUSES:
+                    return
+            progress = current.get('progress')
+            if progress and progress != last_progress:
+                last_progress = progress
+                yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+            seen = job_state(current)
+            current = wait_for_job_change(job_id, seen, SSE_KEEPALIVE_SECONDS)
+            if current and job_state(current) == seen:
+                yield ": keepalive\n\n"
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/concat", methods=["POST"])
 @require_api_key
 def schedule_concat():
-    data = request.json
-    video_urls = data.get("video_urls")
-    trim_duration = data.get("trim_duration", 5)
-    
-    if not video_urls:
-        return jsonify({"error": "Missing video_urls"}), 400
-
-    job_id = start_async_job(logic_concat, video_urls=video_urls, trim_duration=trim_duration)
-    if not job_id:
-         return jsonify({"error": "Failed to start job"}), 500
-         
-    return jsonify({"job_id": job_id, "status": "queued"}), 202
+    return submit_job("concat", request.json)
 
 @app.route("/merge-audio", methods=["POST"])
 @require_api_key
 def schedule_merge_audio():
-    data = request.json
-    video_url = data.get("video_url")
-    audio_url = data.get("audio_url")
-    shortest = data.get("shortest", False)
-    
-    if not video_url or not audio_url:
-        return jsonify({"error": "Missing video_url or audio_url"}), 400
-
-    job_id = start_async_job(logic_merge_audio, video_url=video_url, audio_url=audio_url, shortest=shortest)
-    return jsonify({"job_id": job_id, "status": "queued"}), 202
+    return submit_job("merge-audio", request.json)
 
 @app.route("/add-subtitles", methods=["POST"])
 @require_api_key
 def schedule_add_subtitles():
-    data = request.json
-    video_url = data.get("video_url")
-    subtitle_content = data.get("subtitle_content")
-    fmt = data.get("format", "srt")
-    
-    if not video_url or not subtitle_content:
-        return jsonify({"error": "Missing video_url or subtitle_content"}), 400
+    return submit_job("add-subtitles", request.json)
+
+@app.route("/pipeline", methods=["POST"])
+@require_api_key
+def schedule_pipeline():
+    return submit_job("pipeline", request.json)
+
+@app.route("/batch", methods=["POST"])
+@require_api_key
+def schedule_batch():
+    """
+    Queues many jobs at once: {"jobs": [{"type": "concat", ...same body as POST /concat}, ...]}.
+    All jobs are validated before any is queued, and inserted in one transaction.
+    """
+    specs = (request.json or {}).get("jobs")
+    if not isinstance(specs, list) or not specs:
+        return jsonify({"error": "Missing jobs"}), 400
+    if len(specs) > BATCH_MAX_JOBS:
+        return jsonify({"error": f"At most {BATCH_MAX_JOBS} jobs per batch"}), 400
+
+    parsed = []
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict) or spec.get("type") not in JOB_SPECS:
+            return jsonify({"error": f"jobs[{i}]: type must be one of {sorted(JOB_SPECS)}"}), 400
+        try:
+            func, kwargs = JOB_SPECS[spec["type"]](spec)
+            parsed.append(dict(func=func, kwargs=kwargs, idempotency_key=spec.get("idempotency_key"),
+                               **parse_job_options(spec, kwargs)))
+        except ValueError as e:
+            return jsonify({"error": f"jobs[{i}]: {e}"}), 400
+
+    heads, probes = {}, {}
+    if PROBE_VALIDATION:
+        probe_inputs([url for spec in parsed for url in input_urls(spec["kwargs"]) if not is_job_ref(url)],
+                     heads, probes)
+        for i, spec in enumerate(parsed):
+            try:
+                validate_inputs(spec["kwargs"], heads, probes)
+            except ValueError as e:
+                return jsonify({"error": f"jobs[{i}]: {e}"}), 400
+
+    batch_id, job_ids, shared = start_batch(parsed, heads, probes)
+    if not batch_id:
+        return jsonify({"error": "Failed to start batch"}), 500
+    return jsonify({"batch_id": batch_id, "job_ids": job_ids, "shared_inputs": len(shared)}), 202
+
+@app.route("/batch/<batch_id>", methods=["GET"])
+@require_api_key
+def get_batch(batch_id):
+    """Aggregate status of a batch, with each job's status and result"""
+    jobs = get_batch_jobs(batch_id)
+    if not jobs:
+        return jsonify({"error": "Batch not found"}), 404
+
+    counts = Counter(job['status'] for job in jobs)
+    percents = []
+    for job in jobs:
+        if job['status'] in TERMINAL_STATUSES:
+            percents.append(100.0)
+        else:
+            percents.append(((job.get('progress') or {}).get('percent') or 0) if job['status'] == 'processing' else 0)
+    return jsonify({
+        "batch_id": batch_id,
+        "total": len(jobs),
+        "counts": dict(counts),
+        "percent": round(sum(percents) / len(jobs), 1),
+        "done": all(job['status'] in TERMINAL_STATUSES for job in jobs),
+        "jobs": [
+            {"job_id": job['id'], "type": job_endpoint(job['type']), "status": job['status'],
+             "result": job.get('result'), "error": job.get('error')}
+            for job in jobs
+        ],
+    })
+
+def start_retention_sweeper():
+    thread = threading.Thread(target=retention_sweeper, name="retention-sweeper")
+    thread.daemon = True
+    thread.start()
 
-    job_id = start_async_job(logic_add_subtitles, video_url=video_url, subtitle_content=subtitle_content, format=fmt)
-    return jsonify({"job_id": job_id, "status": "queued"}), 202
+if EMBEDDED_WORKERS and __name__ != "__main__":
+    start_worker_pool()  # Under gunicorn; `python -m app` decides below
+start_retention_sweeper()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000)
+    if sys.argv[1:2] == ["worker"]:
+        run_worker(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    else:
+        if EMBEDDED_WORKERS:
+            start_worker_pool()
+        app.run(host="0.0.0.0", port=8000)
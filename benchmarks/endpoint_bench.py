@@ -0,0 +1,248 @@
+"""
+End-to-end benchmark for the job endpoints, runnable offline.
+
+Synthetic inputs (testsrc2 video with a sine tone) are generated with ffmpeg at
+each duration/resolution and served from a local HTTP server; outputs go to a
+local S3 stand-in (moto's server by default, or any S3 endpoint such as MinIO
+via --s3-endpoint). Jobs are submitted through the Flask app and run by its
+worker pool with --concurrency slots. The report has per-stage timings from
+each job's result, jobs/minute, peak RSS and peak disk use of the work dirs.
+Needs ffmpeg/ffprobe on PATH and, for the default S3 stand-in, moto[server].
+
+    python benchmarks/endpoint_bench.py --durations 10,30 --resolutions 640x360,1280x720 \\
+        --concurrency 2 --jobs 2
+"""
+import argparse
+import functools
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+ENDPOINTS = ("concat", "merge-audio", "add-subtitles")
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--durations", default="10,30", help="Comma-separated input durations in seconds")
+parser.add_argument("--resolutions", default="640x360,1280x720", help="Comma-separated WxH input sizes")
+parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="Comma-separated endpoints to drive")
+parser.add_argument("--concurrency", type=int, default=2, help="Worker pool slots (jobs encoding at once)")
+parser.add_argument("--jobs", type=int, default=2, help="Jobs per endpoint and input")
+parser.add_argument("--profile", default=None, help="Encode profile sent with concat/add-subtitles")
+parser.add_argument("--cache", action="store_true", help="Keep the shared download cache enabled")
+parser.add_argument("--s3-endpoint", default=None,
+                    help="Existing S3 endpoint (e.g. MinIO); credentials from R2_ACCESS_KEY/R2_SECRET_KEY")
+parser.add_argument("--bucket", default="bench", help="Bucket to upload into (created if missing)")
+parser.add_argument("--timeout", type=float, default=1800, help="Give up waiting for jobs after this many seconds")
+args = parser.parse_args()
+
+work_dir = tempfile.mkdtemp(prefix="endpoint_bench_")
+inputs_dir = os.path.join(work_dir, "inputs")
+os.makedirs(inputs_dir)
+
+# --- Local S3 ---
+moto_server = None
+if args.s3_endpoint:
+    s3_endpoint = args.s3_endpoint
+else:
+    from moto.server import ThreadedMotoServer
+    moto_server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+    moto_server.start()
+    host, port = moto_server.get_host_and_port()
+    s3_endpoint = f"http://{host}:{port}"
+    os.environ.setdefault("R2_ACCESS_KEY", "bench")
+    os.environ.setdefault("R2_SECRET_KEY", "bench")
+
+# --- Local HTTP origin for the inputs ---
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *log_args):
+        pass
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        pass  # The partial-fetch probe hangs up mid-body on purpose
+
+http_server = QuietServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=inputs_dir))
+threading.Thread(target=http_server.serve_forever, daemon=True).start()
+origin = f"http://127.0.0.1:{http_server.server_address[1]}"
+
+os.environ.update({
+    "DB_PATH": os.path.join(work_dir, "jobs.db"),
+    "JOB_RETENTION_HOURS": "0",
+    "MAX_CONCURRENT_JOBS": str(args.concurrency),
+    "QUEUE_POLL_INTERVAL": "0.5",
+    "DOWNLOAD_CACHE_DIR": os.path.join(work_dir, "cache"),
+    "DOWNLOAD_CACHE_MAX_MB": os.environ.get("DOWNLOAD_CACHE_MAX_MB", "512") if args.cache else "0",
+    "R2_ENDPOINT": s3_endpoint,
+    "R2_BUCKET": args.bucket,
+    "R2_PUBLIC_URL": f"{s3_endpoint}/{args.bucket}",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402  (environment must be set first)
+
+try:
+    app.get_s3_client().create_bucket(Bucket=args.bucket)
+except Exception as e:
+    if "BucketAlready" not in str(e):
+        raise
+
+# --- Synthetic inputs ---
+
+def generate(name, lavfi_args):
+    path = os.path.join(inputs_dir, name)
+    cmd = ["ffmpeg", "-v", "error", "-y", *lavfi_args, path]
+    subprocess.run(cmd, check=True)
+    return f"{origin}/{name}"
+
+def make_subtitles(duration):
+    lines = ["[Script Info]", "ScriptType: v4.00+", "", "[Events]",
+             "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text"]
+    for start in range(0, int(duration), 2):
+        lines.append(f"Dialogue: 0,0:{start // 60:02d}:{start % 60:02d}.00,0:{(start + 1) // 60:02d}:"
+                     f"{(start + 1) % 60:02d}.50,Default,,0,0,0,,Line {start // 2 + 1}")
+    return "\n".join(lines) + "\n"
+
+variants = []
+for duration in [float(d) for d in args.durations.split(",")]:
+    for resolution in args.resolutions.split(","):
+        label = f"{resolution}_{duration:g}s"
+        video_url = generate(f"video_{label}.mp4", [
+            "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate=25:duration={duration}",
+            "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=44100:duration={duration}",
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest",
+        ])
+        audio_url = generate(f"audio_{label}.m4a", [
+            "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate=44100:duration={duration}", "-c:a", "aac",
+        ])
+        variants.append({"label": label, "duration": duration, "video_url": video_url, "audio_url": audio_url,
+                         "subtitles": make_subtitles(duration)})
+
+def payload(endpoint, variant):
+    if endpoint == "concat":
+        body = {"video_urls": [variant["video_url"]] * 2, "trim_duration": variant["duration"] / 2}
+    elif endpoint == "merge-audio":
+        body = {"video_url": variant["video_url"], "audio_url": variant["audio_url"], "shortest": True}
+    else:
+        body = {"video_url": variant["video_url"], "subtitle_content": variant["subtitles"], "format": "ass"}
+    if args.profile and endpoint != "merge-audio":
+        body["profile"] = args.profile
+    return body
+
+# --- Resource sampling ---
+
+peak = {"disk_bytes": 0}
+sampling = threading.Event()
+
+def tree_size(path):
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def sample_disk():
+    while not sampling.is_set():
+        used = tree_size("/tmp/ffmpeg_work") + tree_size(os.environ["DOWNLOAD_CACHE_DIR"])
+        peak["disk_bytes"] = max(peak["disk_bytes"], used)
+        sampling.wait(0.2)
+
+# --- Run ---
+
+client = app.app.test_client()
+headers = {"X-API-Key": app.FFMPEG_API_KEY}
+submitted = []
+
+sampler = threading.Thread(target=sample_disk, daemon=True)
+sampler.start()
+started = time.time()
+for endpoint in args.endpoints.split(","):
+    for variant in variants:
+        for _ in range(args.jobs):
+            # A fresh Idempotency-Key keeps identical payloads from collapsing into one job
+            response = client.post(f"/{endpoint}", json=payload(endpoint, variant),
+                                   headers=dict(headers, **{"Idempotency-Key": uuid.uuid4().hex}))
+            if response.status_code not in (200, 202):
+                raise SystemExit(f"POST /{endpoint} returned {response.status_code}: {response.get_json()}")
+            submitted.append((endpoint, variant["label"], response.get_json()["job_id"]))
+
+jobs = {}
+deadline = started + args.timeout
+while len(jobs) < len(submitted) and time.time() < deadline:
+    for endpoint, label, job_id in submitted:
+        if job_id not in jobs:
+            job = app.get_job_from_db(job_id)
+            if job and job["status"] in app.TERMINAL_STATUSES:
+                jobs[job_id] = job
+    time.sleep(0.2)
+elapsed = time.time() - started
+sampling.set()
+sampler.join()
+
+# --- Report ---
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "mean": round(statistics.mean(values), 3),
+        "p50": round(values[len(values) // 2], 3),
+        "max": round(values[-1], 3),
+    }
+
+groups = {}
+for endpoint, label, job_id in submitted:
+    group = groups.setdefault(f"{endpoint} {label}", {"jobs": 0, "failed": 0, "unfinished": 0,
+                                                      "latency": [], "queue_wait": [], "stages": {}})
+    group["jobs"] += 1
+    job = jobs.get(job_id)
+    if job is None:
+        group["unfinished"] += 1
+        continue
+    if job["status"] != "completed":
+        group["failed"] += 1
+        group.setdefault("errors", []).append(job["error"])
+        continue
+    group["latency"].append(job["updated_at"] - job["created_at"])
+    group["queue_wait"].append(job["started_at"] - job["created_at"])
+    for stage, seconds in (job["result"].get("timings") or {}).items():
+        group["stages"].setdefault(stage, []).append(seconds)
+
+results = {}
+for name, group in groups.items():
+    results[name] = dict(
+        {k: v for k, v in group.items() if k not in ("latency", "queue_wait", "stages")},
+        latency_seconds=summarize(group["latency"]),
+        queue_wait_seconds=summarize(group["queue_wait"]),
+        stage_seconds={stage: summarize(values) for stage, values in sorted(group["stages"].items())},
+    )
+
+completed = sum(1 for job in jobs.values() if job["status"] == "completed")
+report = {
+    "config": vars(args),
+    "wall_seconds": round(elapsed, 2),
+    "jobs_completed": completed,
+    "jobs_per_minute": round(completed / elapsed * 60, 2) if elapsed else None,
+    # ru_maxrss is in KiB on Linux; the children figure is the largest single ffmpeg process (input generation included)
+    "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    "peak_disk_mb": round(peak["disk_bytes"] / 1024 / 1024, 1),
+    "results": results,
+}
+print(json.dumps(report, indent=2))
+
+http_server.shutdown()
+if moto_server:
+    moto_server.stop()
+shutil.rmtree(work_dir, ignore_errors=True)
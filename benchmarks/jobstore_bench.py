@@ -0,0 +1,117 @@
+"""
+Micro-benchmark for the SQLite job store.
+
+Worker threads write status/progress updates while poller threads read job
+rows the way /tasks/<id> does. The same load runs twice: once with the
+original access pattern (a new connection per call, rollback journal) and
+once through app.py's job store (WAL, per-thread connections, busy_timeout).
+
+    python benchmarks/jobstore_bench.py --writers 2 --pollers 8 --seconds 5
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+parser.add_argument("--writers", type=int, default=2, help="Threads updating job rows")
+parser.add_argument("--pollers", type=int, default=8, help="Threads reading job rows")
+parser.add_argument("--jobs", type=int, default=50, help="Job rows to spread the load over")
+parser.add_argument("--seconds", type=float, default=5, help="Duration of each run")
+args = parser.parse_args()
+
+work_dir = tempfile.mkdtemp(prefix="jobstore_bench_")
+os.environ["DB_PATH"] = os.path.join(work_dir, "jobs.db")
+os.environ["JOB_RETENTION_HOURS"] = "0"
+os.environ["EMBEDDED_WORKERS"] = "false"  # No pool or heartbeat recovering the seeded 'processing' rows
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402  (environment must be set first)
+
+LEGACY_DB_PATH = os.path.join(work_dir, "legacy.db")
+
+
+def legacy_update(job_id, progress):
+    with sqlite3.connect(LEGACY_DB_PATH) as conn:
+        conn.execute("UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                     (json.dumps(progress), time.time(), job_id))
+
+
+def legacy_get(job_id):
+    with sqlite3.connect(LEGACY_DB_PATH) as conn:
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+
+def store_update(job_id, progress):
+    with app.get_conn() as conn:
+        conn.execute("UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                     (json.dumps(progress), time.time(), job_id))
+
+
+def seed(conn, job_ids):
+    with conn:
+        conn.executemany(
+            "INSERT INTO jobs (id, status, created_at, updated_at, type) VALUES (?, 'processing', ?, ?, 'logic_concat')",
+            [(job_id, time.time(), time.time()) for job_id in job_ids]
+        )
+
+
+def run(update, get, job_ids):
+    stop = threading.Event()
+    counts = {"writes": 0, "reads": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def loop(kind, op):
+        done = errors = 0
+        i = 0
+        while not stop.is_set():
+            job_id = job_ids[i % len(job_ids)]
+            i += 1
+            try:
+                op(job_id)
+                done += 1
+            except sqlite3.OperationalError:
+                errors += 1
+        with lock:
+            counts[kind] += done
+            counts["errors"] += errors
+
+    threads = [threading.Thread(target=loop, args=("writes", lambda j: update(j, {"percent": 50})))
+               for _ in range(args.writers)]
+    threads += [threading.Thread(target=loop, args=("reads", get)) for _ in range(args.pollers)]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return {
+        "writes_per_sec": round(counts["writes"] / args.seconds, 1),
+        "reads_per_sec": round(counts["reads"] / args.seconds, 1),
+        "errors": counts["errors"],
+    }
+
+
+job_ids = [str(uuid.uuid4()) for _ in range(args.jobs)]
+
+with sqlite3.connect(LEGACY_DB_PATH) as conn:
+    conn.execute("CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at REAL, "
+                 "updated_at REAL, type TEXT, result TEXT, error TEXT, progress TEXT)")
+seed(sqlite3.connect(LEGACY_DB_PATH), job_ids)
+seed(app.get_conn(), job_ids)
+
+results = {
+    "config": vars(args),
+    "legacy": run(legacy_update, legacy_get, job_ids),
+    "job_store": run(store_update, app.get_job_from_db, job_ids),
+}
+print(json.dumps(results, indent=2))
+shutil.rmtree(work_dir, ignore_errors=True)
@@ -1,7 +1,21 @@
 
+import argparse
 import json
 import uuid
 
+parser = argparse.ArgumentParser(description="Rebuild the Evolution Video workflow around the async FFmpeg API")
+parser.add_argument("--pipeline", action="store_true",
+                    help="Use the single-pass /pipeline endpoint instead of chaining /concat, /merge-audio and /add-subtitles")
+parser.add_argument("--completion", choices=["poll", "longpoll", "webhook"], default="poll",
+                    help="How each block learns its job finished: fixed 10s polling, ?wait= long-polling, "
+                         "or a callback_url that resumes a webhook Wait node")
+args = parser.parse_args()
+
+API_BASE = "https://arrogant-debby-rudraksh-034175cd.koyeb.app"
+AUDIO_URL = "https://pub-879b72d29274423bab4fd53b5946501d.r2.dev/background_music.mp3"
+# A webhook Wait gives up after this long (lost delivery, n8n restarted) and the block polls the job instead
+WEBHOOK_WAIT_MINUTES = 30
+
 # Load original
 with open('Evolution_Video_Cloud_Complete.json', 'r') as f:
     workflow = json.load(f)
@@ -27,21 +41,177 @@ for name in list(connections.keys()):
         del connections[name]
     # Remove connections TO them (cleaned up during rebuilding)
 
+def result_node_name(name_prefix):
+    """Node whose output is the finished job record ({ status, result: { url } })"""
+    return f"{name_prefix} Check" if args.completion == "webhook" else f"{name_prefix} Poll"
+
+def poll_node(name_prefix, start_node_name, position, long_poll):
+    """GET /tasks/<job_id> of the job the Start node queued (?wait=30 when long-polling)"""
+    return {
+        "parameters": {
+            "method": "GET",
+            "url": f"={API_BASE}/tasks/{{{{ $('{start_node_name}').item.json.job_id }}}}" + ("?wait=30" if long_poll else ""),
+            "sendHeaders": True,
+            "headerParameters": { "parameters": [
+                { "name": "X-API-Key", "value": "ffmpeg_sk_9a7b3c2e1f4d8a6b5c3e7f2a1b9d4c8e" }
+            ]}
+        },
+        "id": get_id(),
+        "name": f"{name_prefix} Poll",
+        "type": "n8n-nodes-base.httpRequest",
+        "typeVersion": 4.2,
+        "position": position
+    }
+
+def status_node(name, statuses, position):
+    """If node: true when the job record's status is one of statuses"""
+    conditions = {
+        "options": { "caseSensitive": True, "leftValue": "", "typeValidation": "strict", "version": 3 },
+        "conditions": [{
+            "id": get_id(),
+            "leftValue": "={{ $json.status }}",
+            "rightValue": status,
+            "operator": { "type": "string", "operation": "equals" }
+        } for status in statuses]
+    }
+    if len(statuses) > 1:
+        conditions["combinator"] = "or"
+    return {
+        "parameters": { "conditions": conditions },
+        "id": get_id(),
+        "name": name,
+        "type": "n8n-nodes-base.if",
+        "typeVersion": 2,
+        "position": position
+    }
+
+def error_node(name, position):
+    """Fails the execution with the job's error"""
+    return {
+        "parameters": {
+            "errorMessage": "={{ `FFmpeg job ${$json.id} ${$json.status}: ${$json.error}` }}"
+        },
+        "id": get_id(),
+        "name": name,
+        "type": "n8n-nodes-base.stopAndError",
+        "typeVersion": 1,
+        "position": position
+    }
+
+def create_webhook_block(name_prefix, api_url, json_body, start_x, start_y, input_node_name):
+    """
+    Creates [Start (callback_url = resume URL)] -> [Wait for webhook] -> [Result] -> [Check] -> (Done)
+    The API POSTs the job record to the resume URL when the job ends, so nothing polls.
+    A job that failed or was cancelled goes to [Failed?] -> [Stop and Error], as in create_async_block.
+    A webhook that never arrives (lost delivery, restarted n8n) ends the Wait after
+    WEBHOOK_WAIT_MINUTES; [Failed?] then sends the still-running job to [Poll ?wait=30], which
+    long-polls it through the same Check until it ends.
+    Returns: list of nodes, final_node_name, next_x_pos
+    """
+    start_node_name = f"{name_prefix} Start"
+    wait_node_name = f"{name_prefix} Wait"
+    result_name = f"{name_prefix} Result"
+    poll_node_name = f"{name_prefix} Poll"
+    if_node_name = f"{name_prefix} Check"
+    failed_node_name = f"{name_prefix} Failed?"
+    error_node_name = f"{name_prefix} Error"
+
+    json_body = json_body.replace("JSON.stringify({", "JSON.stringify({callback_url: $execution.resumeUrl, ", 1)
+
+    node_start = {
+        "parameters": {
+            "method": "POST",
+            "url": api_url,
+            "sendHeaders": True,
+            "headerParameters": { "parameters": [
+                { "name": "Content-Type", "value": "application/json" },
+                { "name": "X-API-Key", "value": "ffmpeg_sk_9a7b3c2e1f4d8a6b5c3e7f2a1b9d4c8e" }
+            ]},
+            "sendBody": True,
+            "specifyBody": "json",
+            "jsonBody": json_body
+        },
+        "id": get_id(),
+        "name": start_node_name,
+        "type": "n8n-nodes-base.httpRequest",
+        "typeVersion": 4.2,
+        "position": [start_x + 200, start_y]
+    }
+
+    node_wait = {
+        "parameters": {
+            "resume": "webhook",
+            "httpMethod": "POST",
+            "limitWaitTime": True,
+            "limitType": "afterTimeInterval",
+            "resumeAmount": WEBHOOK_WAIT_MINUTES,
+            "resumeUnit": "minutes",
+            "options": {}
+        },
+        "id": get_id(),
+        "name": wait_node_name,
+        "type": "n8n-nodes-base.wait",
+        "typeVersion": 1.1,
+        "position": [start_x + 400, start_y],
+        "webhookId": get_id()
+    }
+
+    # The webhook item is { headers, params, query, body }; unwrap body so downstream
+    # nodes see the same shape as a Poll response. A Wait that timed out passes on the
+    # Start response ({ job_id, status }) instead, which Failed? sends on to Poll.
+    node_result = {
+        "parameters": { "jsCode": "return [{ json: $json.body ?? $json }];" },
+        "id": get_id(),
+        "name": result_name,
+        "type": "n8n-nodes-base.code",
+        "typeVersion": 2,
+        "position": [start_x + 600, start_y]
+    }
+
+    node_if = status_node(if_node_name, ("completed",), [start_x + 800, start_y])
+    node_failed = status_node(failed_node_name, ("failed", "cancelled"), [start_x + 1000, start_y + 200])
+    node_error = error_node(error_node_name, [start_x + 1200, start_y + 200])
+    node_poll = poll_node(name_prefix, start_node_name, [start_x + 1200, start_y + 400], long_poll=True)
+
+    if input_node_name not in connections: connections[input_node_name] = {"main": [[]]}
+    if not connections[input_node_name].get("main"): connections[input_node_name]["main"] = [[]]
+    connections[input_node_name]["main"][0].append({ "node": start_node_name, "type": "main", "index": 0 })
+    connections[start_node_name] = { "main": [[{ "node": wait_node_name, "type": "main", "index": 0 }]] }
+    connections[wait_node_name] = { "main": [[{ "node": result_name, "type": "main", "index": 0 }]] }
+    connections[result_name] = { "main": [[{ "node": if_node_name, "type": "main", "index": 0 }]] }
+    # If False -> Failed? -> Error when the job ended, else (the Wait timed out) long-poll it
+    connections[if_node_name] = { "main": [[], [{ "node": failed_node_name, "type": "main", "index": 0 }]] }
+    connections[failed_node_name] = { "main": [
+        [{ "node": error_node_name, "type": "main", "index": 0 }],
+        [{ "node": poll_node_name, "type": "main", "index": 0 }],
+    ]}
+    connections[poll_node_name] = { "main": [[{ "node": if_node_name, "type": "main", "index": 0 }]] }
+
+    return [node_start, node_wait, node_result, node_if, node_failed, node_error, node_poll], if_node_name, start_x + 800
+
 # Function to create an async block
 def create_async_block(name_prefix, api_url, json_body, start_x, start_y, input_node_name, result_field_path="data.result.url"):
     """
     Creates [Start] -> [Wait] -> [Poll] -> [If] -> (Done)
+    With --completion longpoll: [Start] -> [Poll ?wait=30] -> [If] -> (Done), looping straight back to Poll
+    A job that ended without completing (failed, cancelled) goes to [Failed?] -> [Stop and Error]
+    instead of looping, since polling it again returns the same status at once.
+    With --completion webhook: see create_webhook_block
     Returns: list of nodes, final_node_name, next_x_pos
     """
+    if args.completion == "webhook":
+        return create_webhook_block(name_prefix, api_url, json_body, start_x, start_y, input_node_name)
+    long_poll = args.completion == "longpoll"
+
     start_id = get_id()
     wait_id = get_id()
-    poll_id = get_id()
-    if_id = get_id()
     
     start_node_name = f"{name_prefix} Start"
     wait_node_name = f"{name_prefix} Wait"
     poll_node_name = f"{name_prefix} Poll"
     if_node_name = f"{name_prefix} Check"
+    failed_node_name = f"{name_prefix} Failed?"
+    error_node_name = f"{name_prefix} Error"
     
     # Node 1: Start Job
     node_start = {
@@ -75,44 +245,22 @@ def create_async_block(name_prefix, api_url, json_body, start_x, start_y, input_
     }
     
     # Node 3: Poll
-    node_poll = {
-        "parameters": {
-            "method": "GET",
-            "url": f"=https://arrogant-debby-rudraksh-034175cd.koyeb.app/tasks/{{{{ $('{start_node_name}').item.json.job_id }}}}",
-            "sendHeaders": True,
-            "headerParameters": { "parameters": [
-                { "name": "X-API-Key", "value": "ffmpeg_sk_9a7b3c2e1f4d8a6b5c3e7f2a1b9d4c8e" }
-            ]}
-        },
-        "id": poll_id,
-        "name": poll_node_name,
-        "type": "n8n-nodes-base.httpRequest",
-        "typeVersion": 4.2,
-        "position": [start_x + 600, start_y]
-    }
+    node_poll = poll_node(name_prefix, start_node_name, [start_x + 600, start_y], long_poll)
     
     # Node 4: If Completed
     # Check if status == 'completed'
-    node_if = {
-        "parameters": {
-            "conditions": {
-                "options": { "caseSensitive": True, "leftValue": "", "typeValidation": "strict", "version": 3 },
-                "conditions": [{
-                    "id": get_id(),
-                    "leftValue": "={{ $json.status }}",
-                    "rightValue": "completed",
-                    "operator": { "type": "string", "operation": "equals" }
-                }]
-            }
-        },
-        "id": if_id,
-        "name": if_node_name,
-        "type": "n8n-nodes-base.if",
-        "typeVersion": 2,
-        "position": [start_x + 800, start_y]
-    }
+    node_if = status_node(if_node_name, ("completed",), [start_x + 800, start_y])
     
-    new_nodes = [node_start, node_wait, node_poll, node_if]
+    # Node 5: Failed or cancelled? The other terminal statuses; anything else is still running
+    node_failed = status_node(failed_node_name, ("failed", "cancelled"), [start_x + 1000, start_y + 200])
+
+    # Node 6: Fail the execution with the job's error
+    node_error = error_node(error_node_name, [start_x + 1200, start_y + 200])
+
+    # Each long-poll request returns as soon as the status changes, so no Wait node is needed
+    new_nodes = [node_start, node_poll, node_if] if long_poll else [node_start, node_wait, node_poll, node_if]
+    new_nodes += [node_failed, node_error]
+    loop_target = poll_node_name if long_poll else wait_node_name
     
     # Connections
     # Input -> Start
@@ -121,19 +269,24 @@ def create_async_block(name_prefix, api_url, json_body, start_x, start_y, input_
     if not connections[input_node_name].get("main"): connections[input_node_name]["main"] = [[]]
     connections[input_node_name]["main"][0].append({ "node": start_node_name, "type": "main", "index": 0 })
     
-    # Start -> Wait
-    connections[start_node_name] = { "main": [[{ "node": wait_node_name, "type": "main", "index": 0 }]] }
+    # Start -> Wait (or straight to Poll when long-polling)
+    connections[start_node_name] = { "main": [[{ "node": loop_target, "type": "main", "index": 0 }]] }
     
     # Wait -> Poll
-    connections[wait_node_name] = { "main": [[{ "node": poll_node_name, "type": "main", "index": 0 }]] }
+    if not long_poll:
+        connections[wait_node_name] = { "main": [[{ "node": poll_node_name, "type": "main", "index": 0 }]] }
     
     # Poll -> If
     connections[poll_node_name] = { "main": [[{ "node": if_node_name, "type": "main", "index": 0 }]] }
     
-    # If False -> Wait (Loop)
+    # If False -> Failed? -> Error when the job ended, else back to Wait (Loop)
     conns_if = { "main": [[], []] } # [True, False]
-    conns_if["main"][1].append({ "node": wait_node_name, "type": "main", "index": 0 })
+    conns_if["main"][1].append({ "node": failed_node_name, "type": "main", "index": 0 })
     connections[if_node_name] = conns_if
+    connections[failed_node_name] = { "main": [
+        [{ "node": error_node_name, "type": "main", "index": 0 }],
+        [{ "node": loop_target, "type": "main", "index": 0 }],
+    ]}
     
     # Success branch (main[0]) is the output of the block
     # But wait, the downstream node needs the RESULT URL.
@@ -145,71 +298,96 @@ def create_async_block(name_prefix, api_url, json_body, start_x, start_y, input_
 
 # BUILD THE CHAIN
 
-# 1. Concat
-concat_body = "={{ JSON.stringify({video_urls: $('Store Video URLs').all().map(x => x.json.videoUrl), trim_duration: 5}) }}"
-concat_nodes, concat_out, current_x = create_async_block(
-    "Concat", 
-    "https://arrogant-debby-rudraksh-034175cd.koyeb.app/concat", 
-    concat_body, 
-    start_x, start_y, 
-    "Store Video URLs"
-)
-workflow['nodes'].extend(concat_nodes)
-
-# 2. Generate On Screen Text
-# Needs to run after Concat to be in sequence, OR parallel.
-# Let's put it in sequence to keep it simple, but we must pass 'url' through.
-# The original 'Generate On Screen Text' node is at index ?
 gen_text_node = next(n for n in workflow['nodes'] if n['name'] == 'Generate On Screen Text ') # Note space
-# Fix its code to pass through 'url'
-# It uses: return [{ content: assContent }];
-# Change to: return [{ json: { content: assContent, url: $('Concat Poll').item.json.result.url } }];
-# Wait, access the item from the PREVIOUS node (which is If -> Poll).
-# Use $input.item.json.result.url
-new_code = gen_text_node['parameters']['jsCode'].replace(
-    "return [{ content: assContent }];",
-    "const inputUrl = $('Concat Poll').item.json.result.url;\nreturn [{ json: { content: assContent, url: inputUrl } }];"
-)
-gen_text_node['parameters']['jsCode'] = new_code
-gen_text_node['position'] = [current_x + 200, start_y]
-
-# Connect Concat Out (If True) -> Gen Text
-connections[concat_out]["main"][0].append({ "node": gen_text_node['name'], "type": "main", "index": 0 })
-
-current_x += 200 # For Gen Text
-
-# 3. Merge Audio
-# Input: url (from Gen Text), audio_url
-merge_body = "={{ JSON.stringify({video_url: $json.url, audio_url: \"https://pub-879b72d29274423bab4fd53b5946501d.r2.dev/background_music.mp3\", shortest: true}) }}"
-merge_nodes, merge_out, current_x = create_async_block(
-    "Merge Audio", 
-    "https://arrogant-debby-rudraksh-034175cd.koyeb.app/merge-audio", 
-    merge_body, 
-    current_x, start_y, 
-    gen_text_node['name']
-)
-workflow['nodes'].extend(merge_nodes)
-
-# 4. Add Subtitles
-# Input: url (from Merge Audio), subtitle_content (from Gen Text)
-# Note: Merge Audio Poll result will be { status: completed, result: { url: ... } }. So $json.result.url
-# Wait, Create Async Block 'If' node passes the Poll output.
-# Poll output structure: { "status": "completed", "result": { "url": "..." }, ... }
-# So we need to access $json.result.url
-sub_body = "={{ JSON.stringify({video_url: $json.result.url, subtitle_content: $('Generate On Screen Text ').first().json.content, format: \"ass\"}) }}"
-# Note: accessed via node name for subtitle content, which is fine.
-
-sub_nodes, sub_out, current_x = create_async_block(
-    "Add Subtitles", 
-    "https://arrogant-debby-rudraksh-034175cd.koyeb.app/add-subtitles", 
-    sub_body, 
-    current_x, start_y, 
-    merge_out
-)
-workflow['nodes'].extend(sub_nodes)
+
+if args.pipeline:
+    # Store Video URLs -> Generate On Screen Text -> Pipeline (concat + audio + subtitles in one job)
+    gen_text_node['position'] = [start_x + 200, start_y]
+    connections["Store Video URLs"] = { "main": [[{ "node": gen_text_node['name'], "type": "main", "index": 0 }]] }
+    connections[gen_text_node['name']] = { "main": [[]] }
+
+    pipeline_body = (
+        "={{ JSON.stringify({video_urls: $('Store Video URLs').all().map(x => x.json.videoUrl), trim_duration: 5, "
+        "audio_url: \"%s\", shortest: true, subtitle_content: $json.content}) }}" % AUDIO_URL
+    )
+    pipeline_nodes, pipeline_out, current_x = create_async_block(
+        "Pipeline",
+        f"{API_BASE}/pipeline",
+        pipeline_body,
+        start_x + 200, start_y,
+        gen_text_node['name']
+    )
+    workflow['nodes'].extend(pipeline_nodes)
+    output_file = 'Evolution_Video_Cloud_Pipeline'
+else:
+    # 1. Concat
+    concat_body = "={{ JSON.stringify({video_urls: $('Store Video URLs').all().map(x => x.json.videoUrl), trim_duration: 5}) }}"
+    concat_nodes, concat_out, current_x = create_async_block(
+        "Concat", 
+        f"{API_BASE}/concat", 
+        concat_body, 
+        start_x, start_y, 
+        "Store Video URLs"
+    )
+    workflow['nodes'].extend(concat_nodes)
+
+    # 2. Generate On Screen Text
+    # Needs to run after Concat to be in sequence, OR parallel.
+    # Let's put it in sequence to keep it simple, but we must pass 'url' through.
+    # Fix its code to pass through 'url'
+    # It uses: return [{ content: assContent }];
+    # Change to: return [{ json: { content: assContent, url: $('Concat Poll').item.json.result.url } }];
+    # Wait, access the item from the PREVIOUS node (which is If -> Poll).
+    # Use $input.item.json.result.url
+    new_code = gen_text_node['parameters']['jsCode'].replace(
+        "return [{ content: assContent }];",
+        f"const inputUrl = $('{result_node_name('Concat')}').item.json.result.url;\nreturn [{{ json: {{ content: assContent, url: inputUrl }} }}];"
+    )
+    gen_text_node['parameters']['jsCode'] = new_code
+    gen_text_node['position'] = [current_x + 200, start_y]
+
+    # Connect Concat Out (If True) -> Gen Text
+    connections[concat_out]["main"][0].append({ "node": gen_text_node['name'], "type": "main", "index": 0 })
+
+    current_x += 200 # For Gen Text
+
+    # 3. Merge Audio
+    # Input: url (from Gen Text), audio_url
+    merge_body = "={{ JSON.stringify({video_url: $json.url, audio_url: \"%s\", shortest: true}) }}" % AUDIO_URL
+    merge_nodes, merge_out, current_x = create_async_block(
+        "Merge Audio", 
+        f"{API_BASE}/merge-audio", 
+        merge_body, 
+        current_x, start_y, 
+        gen_text_node['name']
+    )
+    workflow['nodes'].extend(merge_nodes)
+
+    # 4. Add Subtitles
+    # Input: url (from Merge Audio), subtitle_content (from Gen Text)
+    # Note: Merge Audio Poll result will be { status: completed, result: { url: ... } }. So $json.result.url
+    # Wait, Create Async Block 'If' node passes the Poll output.
+    # Poll output structure: { "status": "completed", "result": { "url": "..." }, ... }
+    # So we need to access $json.result.url
+    sub_body = "={{ JSON.stringify({video_url: $json.result.url, subtitle_content: $('Generate On Screen Text ').first().json.content, format: \"ass\"}) }}"
+    # Note: accessed via node name for subtitle content, which is fine.
+
+    sub_nodes, sub_out, current_x = create_async_block(
+        "Add Subtitles", 
+        f"{API_BASE}/add-subtitles", 
+        sub_body, 
+        current_x, start_y, 
+        merge_out
+    )
+    workflow['nodes'].extend(sub_nodes)
+    output_file = 'Evolution_Video_Cloud_Async'
+
+if args.completion != "poll":
+    output_file += {"longpoll": "_LongPoll", "webhook": "_Webhook"}[args.completion]
+output_file += '.json'
 
 # Save
-with open('Evolution_Video_Cloud_Async.json', 'w') as f:
+with open(output_file, 'w') as f:
     json.dump(workflow, f, indent=2)
 
-print("Generated Evolution_Video_Cloud_Async.json")
+print(f"Generated {output_file}")
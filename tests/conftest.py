@@ -0,0 +1,100 @@
+"""
+Shared fixtures. app.py reads its configuration at import time, so the job store and
+scratch directories are pointed at a temporary directory before it is imported.
+
+    pip install pytest moto[server]
+    python -m pytest -q
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+work_dir = tempfile.mkdtemp(prefix="ffmpeg_api_tests_")
+os.environ["DB_PATH"] = os.path.join(work_dir, "jobs.db")
+os.environ["DOWNLOAD_CACHE_DIR"] = os.path.join(work_dir, "cache")
+os.environ["AUDIO_ASSET_DIR"] = os.path.join(work_dir, "audio_assets")
+os.environ["ARTIFACT_DIR"] = os.path.join(work_dir, "artifacts")
+os.environ["EMBEDDED_WORKERS"] = "false"
+os.environ["PROBE_VALIDATION"] = "false"
+os.environ["METRICS_ENABLED"] = "false"
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402  (configuration must be set first)
+
+JOB_TABLES = ("jobs", "job_dependencies", "batch_jobs", "prefetching")
+
+
+@pytest.fixture(autouse=True)
+def job_store(monkeypatch):
+    """Empty job store; input HEAD requests answered locally with a fixed validator per URL"""
+    with app.get_conn() as conn:
+        for table in JOB_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+    monkeypatch.setattr(app, "head_input",
+                        lambda url: (None, None) if app.is_job_ref(url) else (f"etag-{url}", 1000))
+    yield app.get_conn()
+
+
+@pytest.fixture
+def new_job():
+    """insert_job in its own write transaction, as start_async_job runs it"""
+    def insert(job_type="logic_concat", params=None, **options):
+        with app.get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            return app.insert_job(conn, job_type, params or {"video_urls": ["https://example.com/a.mp4"]},
+                                  **options)
+    return insert
+
+
+@pytest.fixture
+def set_processing():
+    """Puts a job in the state a worker leaves it in after claiming it, with the given column overrides"""
+    def update(job_id, **columns):
+        columns = {"status": "processing", "started_at": time.time(), "attempts": 1, **columns}
+        with app.get_conn() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in columns)} WHERE id = ?",
+                         (*columns.values(), job_id))
+    return update
+
+
+@pytest.fixture
+def dead_pid():
+    proc = subprocess.Popen(["true"])
+    proc.wait()
+    return proc.pid
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def moto_endpoint():
+    server_module = pytest.importorskip("moto.server")
+    server = server_module.ThreadedMotoServer(ip_address="127.0.0.1", port=free_port(), verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+
+@pytest.fixture
+def r2(monkeypatch, moto_endpoint):
+    """R2 settings pointed at a moto S3 server, with a fresh bucket; yields the S3 client"""
+    monkeypatch.setattr(app, "R2_ENDPOINT", moto_endpoint)
+    monkeypatch.setattr(app, "R2_ACCESS_KEY", "test")
+    monkeypatch.setattr(app, "R2_SECRET_KEY", "test")
+    monkeypatch.setattr(app, "R2_BUCKET", f"bkt-{free_port()}")
+    monkeypatch.setattr(app, "R2_PUBLIC_URL", "https://r2.example.com")
+    monkeypatch.setattr(app, "_s3_client", None)
+    client = app.get_s3_client()
+    client.create_bucket(Bucket=app.R2_BUCKET)
+    return client
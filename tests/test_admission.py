@@ -0,0 +1,33 @@
+"""Admission control: claiming only jobs whose disk and memory estimates fit"""
+import app
+
+SMALL = {"disk": app.MB, "memory": app.MB}
+
+
+def test_claim_skips_a_job_that_does_not_fit_beside_the_running_ones(new_job, monkeypatch):
+    monkeypatch.setattr(app, "MEMORY_BUDGET_MB", 64)
+    running = new_job(resources={"disk": app.MB, "memory": 32 * app.MB})
+    assert app.claim_next_job()["id"] == running
+    too_big = new_job(params={"video_urls": ["https://example.com/b.mp4"]},
+                      resources={"disk": app.MB, "memory": 48 * app.MB})
+    fits = new_job(params={"video_urls": ["https://example.com/c.mp4"]}, resources=SMALL)
+
+    assert app.claim_next_job()["id"] == fits
+    assert app.get_job_from_db(too_big)["status"] == "queued"
+    # Once the instance is idle it takes the job anyway rather than deferring it forever
+    with app.get_conn() as conn:
+        conn.execute("UPDATE jobs SET status = 'completed' WHERE id IN (?, ?)", (running, fits))
+    assert app.claim_next_job()["id"] == too_big
+
+
+def test_claim_records_the_scratch_root(new_job):
+    job_id = new_job(resources=SMALL)
+    app.claim_next_job()
+    assert app.job_resources(app.get_job_from_db(job_id))["scratch"] == app.WORK_ROOT
+
+
+def test_lookahead_is_capped_to_fit_the_budget():
+    width, height, threads = 1920, 1080, 1
+    budget = app.x264_memory(width, height, 10, threads)
+    assert app.fitting_lookahead(width, height, threads, budget) == 10
+    assert app.fitting_lookahead(width, height, threads, app.x264_memory(width, height, 0, threads) - 1) == 0
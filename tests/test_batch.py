@@ -0,0 +1,62 @@
+"""start_batch: one transaction for all jobs, dedup within the batch and against queued jobs"""
+import json
+import threading
+import time
+
+import app
+
+CONCAT = {"video_urls": ["https://example.com/a.mp4", "https://example.com/b.mp4"], "trim_duration": 5,
+          "reencode": False, "profile": None, "output": "mp4"}
+MERGE = {"video_url": "https://example.com/a.mp4", "audio_url": "https://example.com/music.mp3",
+         "shortest": False, "output": "mp4"}
+
+
+def spec(func, kwargs):
+    return dict(func=func, kwargs=kwargs, idempotency_key=None, callback_url=None, depends_on=[],
+                intermediate=False, priority=0, deadline=None)
+
+
+def test_batch_jobs_are_listed_in_submission_order(monkeypatch):
+    monkeypatch.setattr(app, "DOWNLOAD_CACHE_MAX_BYTES", 0)  # No prefetch of the shared input
+    batch_id, job_ids, shared = app.start_batch([spec(app.logic_concat, CONCAT), spec(app.logic_merge_audio, MERGE)])
+
+    assert len(set(job_ids)) == 2
+    assert shared == ["https://example.com/a.mp4"]
+    jobs = app.get_batch_jobs(batch_id)
+    assert [job["id"] for job in jobs] == job_ids
+    assert [job["type"] for job in jobs] == ["logic_concat", "logic_merge_audio"]
+    assert json.loads(jobs[1]["params"]) == MERGE
+    assert app.get_batch_jobs("no-such-batch") == []
+
+
+def test_batch_dedups_within_and_across_requests(new_job, monkeypatch):
+    monkeypatch.setattr(app, "DOWNLOAD_CACHE_MAX_BYTES", 0)
+    existing = new_job(params=CONCAT, fingerprint=app.request_fingerprint("logic_concat", CONCAT))
+
+    batch_id, job_ids, shared = app.start_batch([spec(app.logic_concat, CONCAT), spec(app.logic_concat, CONCAT)])
+    assert job_ids == [existing, existing]
+    assert sorted(shared) == sorted(CONCAT["video_urls"])
+    assert [job["id"] for job in app.get_batch_jobs(batch_id)] == [existing, existing]
+
+
+def test_batch_marks_shared_inputs_for_prefetch(monkeypatch):
+    release = threading.Event()
+    fetched = []
+
+    def download_file(url, path, job_id=None):
+        release.wait(10)
+        fetched.append(url)
+        raise Exception("offline")
+    monkeypatch.setattr(app, "download_file", download_file)
+
+    app.start_batch([spec(app.logic_concat, CONCAT), spec(app.logic_merge_audio, MERGE)])
+    # Jobs that start meanwhile wait for the prefetch instead of fetching the input themselves
+    assert app.is_cached_input("https://example.com/a.mp4")
+    assert not app.is_cached_input("https://example.com/b.mp4")
+
+    release.set()
+    deadline = time.time() + 10
+    while app.is_cached_input("https://example.com/a.mp4") and time.time() < deadline:
+        time.sleep(0.05)
+    assert fetched == ["https://example.com/a.mp4"]
+    assert not app.is_cached_input("https://example.com/a.mp4")  # A failed prefetch leaves it to the jobs
@@ -0,0 +1,89 @@
+"""Cancellation, priorities and deadlines"""
+import os
+import time
+
+import app
+
+SMALL = {"disk": app.MB, "memory": app.MB}
+
+
+def test_claim_takes_the_highest_priority_then_the_oldest_job(new_job):
+    first = new_job(resources=SMALL)
+    second = new_job(params={"video_urls": ["https://example.com/b.mp4"]}, resources=SMALL)
+    urgent = new_job(params={"video_urls": ["https://example.com/c.mp4"]}, resources=SMALL, priority=5)
+
+    assert [app.claim_next_job()["id"] for _ in range(3)] == [urgent, first, second]
+    assert app.claim_next_job() is None
+
+
+def test_claim_drops_a_job_past_its_deadline(new_job):
+    job_id = new_job(resources=SMALL, deadline=time.time() + 60)
+    with app.get_conn() as conn:
+        conn.execute("UPDATE jobs SET deadline = ? WHERE id = ?", (time.time() - 1, job_id))
+
+    assert app.claim_next_job() is None
+    job = app.get_job_from_db(job_id)
+    assert job["status"] == "cancelled"
+    assert job["error"] == "Deadline passed before the job started"
+
+
+def test_repeated_request_raises_priority_and_keeps_the_later_deadline(new_job):
+    soon, later = time.time() + 60, time.time() + 600
+    job_id = new_job(fingerprint="same-request", deadline=soon)
+    assert new_job(fingerprint="same-request", priority=3, deadline=later) == job_id
+
+    job = app.get_job_from_db(job_id)
+    assert job["priority"] == 3 and job["deadline"] == later
+    new_job(fingerprint="same-request")  # No deadline at all
+    assert app.get_job_from_db(job_id)["deadline"] is None
+
+
+def test_cancel_a_queued_job(new_job):
+    job_id = new_job()
+
+    assert app.cancel_job(job_id) == ("queued", 0)
+    assert app.get_job_from_db(job_id)["status"] == "cancelled"
+    assert app.cancel_job(job_id) == ("cancelled", 0)
+    assert app.cancel_job("no-such-job") == (None, 0)
+
+
+def test_cancel_a_running_job_stops_its_worker(new_job, set_processing, monkeypatch):
+    job_id = new_job()
+    set_processing(job_id, worker_pid=os.getpid(), worker_host=app.HOSTNAME)
+    event = app.threading.Event()
+    monkeypatch.setitem(app._cancel_events, job_id, event)
+
+    assert app.cancel_job(job_id) == ("processing", 0)
+    assert event.is_set() and app.job_cancelled(job_id)
+    job = app.get_job_from_db(job_id)
+    assert job["status"] == "processing"  # The worker records 'cancelled' once ffmpeg is down
+    assert job["cancel_requested"] is not None
+
+
+def test_cancel_a_shared_job_only_for_its_last_submitter(new_job):
+    job_id = new_job(fingerprint="same-request")
+    assert new_job(fingerprint="same-request") == job_id
+    assert new_job(fingerprint="same-request") == job_id
+    assert app.get_job_from_db(job_id)["submitters"] == 3
+
+    assert app.cancel_job(job_id) == ("queued", 2)
+    assert app.cancel_job(job_id) == ("queued", 1)
+    assert app.get_job_from_db(job_id)["status"] == "queued"
+    assert app.cancel_job(job_id) == ("queued", 0)
+    assert app.get_job_from_db(job_id)["status"] == "cancelled"
+    # A cancelled job is never handed to a new request
+    assert new_job(fingerprint="same-request") != job_id
+
+
+def test_a_job_being_cancelled_is_not_shared(new_job, set_processing):
+    job_id = new_job(fingerprint="same-request")
+    set_processing(job_id, cancel_requested=time.time())
+    assert new_job(fingerprint="same-request") != job_id
+
+
+def test_recovery_finishes_the_cancellation_of_a_dead_workers_job(new_job, set_processing, dead_pid):
+    job_id = new_job(resources=SMALL)
+    set_processing(job_id, worker_pid=dead_pid, worker_host=app.HOSTNAME, cancel_requested=time.time())
+
+    app.recover_orphaned_jobs()
+    assert app.get_job_from_db(job_id)["status"] == "cancelled"
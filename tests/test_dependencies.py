@@ -0,0 +1,150 @@
+"""Job chaining: depends_on / job:<id> inputs, releasing and failing dependents, reading parents' outputs"""
+import os
+
+import pytest
+
+import app
+
+
+def status(job_id):
+    return app.get_job_from_db(job_id)["status"]
+
+
+def test_dependent_waits_and_is_queued_when_every_parent_completes(new_job):
+    first = new_job()
+    second = new_job(params={"video_urls": ["https://example.com/b.mp4"]})
+    child = new_job(params={"video_urls": [f"job:{first}", f"job:{second}"]}, depends_on=[first, second])
+    assert status(child) == "waiting"
+
+    app.update_job(first, "completed", result={"url": "https://r2.example.com/first.mp4"})
+    assert status(child) == "waiting"
+    app.update_job(second, "completed", result={"url": "https://r2.example.com/second.mp4"})
+    assert status(child) == "queued"
+
+
+def test_dependent_on_a_completed_parent_is_queued_at_once(new_job):
+    parent = new_job()
+    app.update_job(parent, "completed", result={"url": "https://r2.example.com/parent.mp4"})
+    assert status(new_job(params={"video_urls": [f"job:{parent}"]}, depends_on=[parent])) == "queued"
+
+
+@pytest.mark.parametrize("outcome", ["failed", "cancelled"])
+def test_dependents_fail_with_their_parent(new_job, outcome):
+    parent = new_job()
+    child = new_job(params={"video_urls": [f"job:{parent}"]}, depends_on=[parent])
+    grandchild = new_job(params={"video_urls": [f"job:{child}"]}, depends_on=[child])
+
+    app.update_job(parent, outcome, error="boom")
+    assert app.get_job_from_db(child)["error"] == f"Dependency {parent} {outcome}"
+    assert status(child) == "failed"
+    assert status(grandchild) == "failed"
+
+
+def test_cancelling_a_waiting_parent_fails_its_dependents(new_job):
+    parent = new_job()
+    child = new_job(params={"video_urls": [f"job:{parent}"]}, depends_on=[parent])
+    assert app.cancel_job(parent) == ("queued", 0)
+    assert status(child) == "failed"
+
+
+def test_job_refs_in_inputs_are_dependencies(new_job):
+    parent = new_job()
+    options = app.parse_job_options({"depends_on": parent}, {"video_urls": [f"job:{parent}", "https://example.com/b.mp4"]})
+    assert options["depends_on"] == [parent]
+    options = app.parse_job_options({}, {"video_url": f"job:{parent}", "audio_url": "https://example.com/a.mp3"})
+    assert options["depends_on"] == [parent]
+
+
+def test_check_dependencies_rejects_parents_that_cannot_deliver(new_job):
+    with pytest.raises(ValueError, match="unknown job nope"):
+        app.check_dependencies(["nope"])
+
+    failed = new_job()
+    app.update_job(failed, "failed", error="boom")
+    with pytest.raises(ValueError, match=f"job {failed} failed"):
+        app.check_dependencies([failed])
+
+    hls = new_job(params={"video_urls": ["https://example.com/b.mp4"], "output": "hls"})
+    with pytest.raises(ValueError, match="will be an HLS playlist"):
+        app.check_dependencies([hls])
+    intermediate_hls = new_job(params={"video_urls": ["https://example.com/c.mp4"], "output": "hls"},
+                               intermediate=True)
+    app.check_dependencies([intermediate_hls])  # Kept as a file for its dependents
+
+    gone = new_job(params={"video_urls": ["https://example.com/d.mp4"]})
+    app.update_job(gone, "completed", result={"stats": {}})
+    with pytest.raises(ValueError, match="no longer available"):
+        app.check_dependencies([gone])
+
+
+def test_resolve_job_ref_prefers_the_kept_artifact(new_job, tmp_path):
+    parent = new_job()
+    with pytest.raises(Exception, match="has not completed"):
+        app.resolve_job_ref(f"job:{parent}")
+
+    output = tmp_path / "out.mp4"
+    output.write_bytes(b"video")
+    assert app.store_artifact(parent, str(output)) == f"job:{parent}"
+    app.update_job(parent, "completed", result={"url": "https://r2.example.com/out.mp4"})
+    artifact, url = app.resolve_job_ref(f"job:{parent}")
+    assert url is None and open(artifact, "rb").read() == b"video"
+
+    with app.get_conn() as conn:
+        conn.execute("UPDATE jobs SET artifact = NULL WHERE id = ?", (parent,))
+    assert app.resolve_job_ref(f"job:{parent}") == (None, "https://r2.example.com/out.mp4")
+
+
+def test_resolve_job_ref_refuses_an_hls_playlist(new_job):
+    parent = new_job()
+    app.update_job(parent, "completed", result={"url": "https://r2.example.com/hls/x/index.m3u8"})
+    with pytest.raises(Exception, match="HLS playlist"):
+        app.resolve_job_ref(f"job:{parent}")
+
+
+def test_uploaded_parent_keeps_a_copy_only_while_dependents_wait(new_job, tmp_path):
+    parent = new_job()
+    output = tmp_path / "out.mp4"
+    output.write_bytes(b"video")
+    app.share_output(parent, str(output))
+    assert app.get_job_from_db(parent)["artifact"] is None  # Nobody to read it
+
+    new_job(params={"video_urls": [f"job:{parent}"]}, depends_on=[parent])
+    app.share_output(parent, str(output))
+    artifact = app.get_job_from_db(parent)["artifact"]
+    assert artifact.startswith(app.ARTIFACT_DIR) and os.path.exists(artifact)
+
+
+def test_intermediate_and_regular_requests_never_share_a_job():
+    params = {"video_urls": ["https://example.com/a.mp4"], "trim_duration": 5}
+    regular = app.request_fingerprint("logic_concat", params)
+    intermediate = app.request_fingerprint("logic_concat", params, intermediate=True)
+    assert intermediate != regular
+    assert app.request_fingerprint("logic_concat", params, intermediate=True) == intermediate
+
+
+@pytest.mark.parametrize("outcome", ["failed", "cancelled"])
+def test_dependent_of_a_parent_that_already_failed_is_failed_on_arrival(new_job, outcome):
+    parent = new_job()
+    app.update_job(parent, outcome, error="boom")
+    # check_dependencies passed before the parent finished; insert_job reads it again
+    child = new_job(params={"video_urls": [f"job:{parent}"]}, depends_on=[parent])
+    assert status(child) == "failed"
+    assert app.get_job_from_db(child)["error"] == f"Dependency {parent} {outcome}"
+
+
+def test_heartbeat_settles_waiting_jobs_whose_parents_finished_unnoticed(new_job):
+    done = new_job()
+    lost = new_job(params={"video_urls": ["https://example.com/b.mp4"]})
+    running = new_job(params={"video_urls": ["https://example.com/c.mp4"]})
+    released = new_job(params={"video_urls": [f"job:{done}"]}, depends_on=[done])
+    failed = new_job(params={"video_urls": [f"job:{done}", f"job:{lost}"]}, depends_on=[done, lost])
+    waiting = new_job(params={"video_urls": [f"job:{done}", f"job:{running}"]}, depends_on=[done, running])
+    with app.get_conn() as conn:  # As if the process died before settling the dependents
+        conn.execute("UPDATE jobs SET status = 'completed' WHERE id = ?", (done,))
+        conn.execute("UPDATE jobs SET status = 'failed' WHERE id = ?", (lost,))
+
+    app.settle_waiting_jobs()
+    assert status(released) == "queued"
+    assert status(failed) == "failed"
+    assert app.get_job_from_db(failed)["error"] == f"Dependency {lost} failed"
+    assert status(waiting) == "waiting"
@@ -0,0 +1,31 @@
+"""Encode profiles: request parsing and their part in request fingerprints"""
+import pytest
+
+import app
+
+CONCAT = {"video_urls": ["https://example.com/a.mp4", "https://example.com/b.mp4"], "trim_duration": 5,
+          "reencode": False, "profile": None, "output": "mp4"}
+
+
+def test_parse_profile():
+    assert app.parse_profile({}) == app.DEFAULT_ENCODE_PROFILE
+    assert app.parse_profile({"profile": "fast"}) == "fast"
+    with pytest.raises(ValueError, match="Unknown profile"):
+        app.parse_profile({"profile": "ultra"})
+
+
+def test_explicit_profile_and_its_encoder_settings_are_part_of_the_fingerprint(monkeypatch):
+    explicit = {**CONCAT, "profile": app.DEFAULT_ENCODE_PROFILE}
+    # An explicit profile re-encodes, while concat without one may stream-copy
+    assert app.request_fingerprint("logic_concat", CONCAT) != app.request_fingerprint("logic_concat", explicit)
+    before = app.request_fingerprint("logic_concat", explicit)
+    monkeypatch.setitem(app.ENCODE_PROFILES, app.DEFAULT_ENCODE_PROFILE,
+                        {**app.ENCODE_PROFILES[app.DEFAULT_ENCODE_PROFILE], "crf": "30"})
+    assert app.request_fingerprint("logic_concat", explicit) != before  # No old output for new settings
+
+
+def test_x264_args_follow_the_profile():
+    args = app.x264_args("fast", 2)
+    assert args[args.index("-preset") + 1] == "veryfast"
+    assert args[args.index("-crf") + 1] == "26"
+    assert args[args.index("-threads") + 1] == "2"
@@ -0,0 +1,54 @@
+"""Request fingerprints and how insert_job answers a repeated request with the existing job"""
+import app
+
+CONCAT = {"video_urls": ["https://example.com/a.mp4", "https://example.com/b.mp4"], "trim_duration": 5,
+          "reencode": False, "profile": None, "output": "mp4"}
+
+
+def fingerprint(params=CONCAT, **options):
+    return app.request_fingerprint("logic_concat", params, **options)
+
+
+def test_same_request_same_fingerprint():
+    assert fingerprint() == fingerprint(dict(CONCAT))
+    assert fingerprint() != fingerprint({**CONCAT, "trim_duration": 6})
+    assert fingerprint() != app.request_fingerprint("logic_pipeline", CONCAT)
+
+
+def test_changed_input_changes_the_fingerprint(monkeypatch):
+    before = fingerprint()
+    monkeypatch.setattr(app, "head_input", lambda url: ("etag-v2", 1000))
+    assert fingerprint() != before
+
+
+def test_idempotency_key_names_the_request():
+    keyed = fingerprint(idempotency_key="order-42")
+    assert fingerprint({**CONCAT, "trim_duration": 9}, idempotency_key="order-42") == keyed
+    assert fingerprint(idempotency_key="order-43") != keyed
+
+
+def test_repeated_request_shares_the_queued_job(new_job):
+    job_id = new_job(params=CONCAT, fingerprint=fingerprint())
+    assert new_job(params=CONCAT, fingerprint=fingerprint()) == job_id
+    assert app.get_conn().execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 1
+
+
+def test_completed_job_answers_only_when_its_inputs_are_validated(new_job):
+    job_id = new_job(params=CONCAT, fingerprint=fingerprint())
+    app.update_job(job_id, "completed", result={"url": "https://r2.example.com/concat.mp4"})
+
+    assert app.reuses_completed(CONCAT)
+    assert new_job(params=CONCAT, fingerprint=fingerprint(), reuse_completed=True) == job_id
+    assert new_job(params=CONCAT, fingerprint=fingerprint(), reuse_completed=False) != job_id
+
+
+def test_unvalidated_inputs_are_not_reused(monkeypatch):
+    monkeypatch.setattr(app, "head_input", lambda url: (None, None))
+    assert not app.reuses_completed(CONCAT)
+    assert app.reuses_completed(CONCAT, idempotency_key="order-42")
+
+
+def test_failed_job_is_not_shared(new_job):
+    failed = new_job(params=CONCAT, fingerprint=fingerprint())
+    app.update_job(failed, "failed", error="boom")
+    assert new_job(params=CONCAT, fingerprint=fingerprint()) != failed
@@ -0,0 +1,94 @@
+"""HlsUpload: publishing segments and playlists to R2 while the encode runs"""
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def fast_polls(monkeypatch):
+    monkeypatch.setattr(app.HlsUpload, "POLL_INTERVAL", 0.05)
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def object_keys(client, prefix=""):
+    response = client.list_objects_v2(Bucket=app.R2_BUCKET, Prefix=prefix)
+    return sorted(obj["Key"] for obj in response.get("Contents", []))
+
+
+def write_hls(hls_dir, segments, ended=False):
+    """An fMP4 HLS output as ffmpeg leaves it: segment files, then the playlist listing them"""
+    (hls_dir / "init.mp4").write_bytes(b"init")
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7", "#EXT-X-TARGETDURATION:4", '#EXT-X-MAP:URI="init.mp4"']
+    for name in segments:
+        if not (hls_dir / name).exists():
+            (hls_dir / name).write_bytes(name.encode())
+        lines += ["#EXTINF:4.000000,", name]
+    if ended:
+        lines.append("#EXT-X-ENDLIST")
+    (hls_dir / "index.m3u8.tmp").write_text("\n".join(lines) + "\n")
+    os.replace(hls_dir / "index.m3u8.tmp", hls_dir / "index.m3u8")  # hls_flags temp_file
+
+
+def test_hls_upload_publishes_segments_before_the_playlist(r2, fast_polls, tmp_path, new_job):
+    job_id = new_job()
+    app.update_job(job_id, "processing")
+    hls_dir = tmp_path / "hls"
+    hls_dir.mkdir()
+
+    upload = app.HlsUpload(job_id, str(hls_dir), f"hls/{job_id}")
+    assert upload.start() is None
+    write_hls(hls_dir, ["seg0.m4s"])
+    wait_until(lambda: upload.published)
+    # The playlist is readable while the job runs, and every segment it names is already there
+    assert app.get_job_from_db(job_id)["result"] == {"playlist_url": upload.playlist_url}
+    assert object_keys(r2, f"hls/{job_id}/") == [f"hls/{job_id}/{name}" for name in ("index.m3u8", "init.mp4", "seg0.m4s")]
+    assert not (hls_dir / "seg0.m4s").exists()
+
+    write_hls(hls_dir, ["seg0.m4s", "seg1.m4s"], ended=True)
+    url, error = upload.finish(True)
+    assert error is None
+    assert url == f"https://r2.example.com/hls/{job_id}/index.m3u8"
+    playlist = r2.get_object(Bucket=app.R2_BUCKET, Key=f"hls/{job_id}/index.m3u8")["Body"].read().decode()
+    assert "seg1.m4s" in playlist and "#EXT-X-ENDLIST" in playlist
+    assert f"hls/{job_id}/seg1.m4s" in object_keys(r2)
+
+
+def test_hls_upload_removes_a_failed_output(r2, fast_polls, tmp_path, new_job):
+    job_id = new_job()
+    hls_dir = tmp_path / "hls"
+    hls_dir.mkdir()
+    write_hls(hls_dir, ["seg0.m4s"])
+
+    upload = app.HlsUpload(job_id, str(hls_dir), f"hls/{job_id}")
+    assert upload.start() is None
+    wait_until(lambda: upload.published)
+
+    url, error = upload.finish(False)
+    assert url is None and error == "Encode failed"
+    assert object_keys(r2) == []
+
+
+def test_resumed_hls_upload_deletes_what_the_interrupted_attempt_got_further_with(r2, fast_polls, tmp_path, new_job):
+    job_id = new_job()
+    prefix = f"hls/{job_id}"
+    for name in ("init.mp4", "seg0.m4s", "seg1.m4s", "seg2.m4s", "index.m3u8"):
+        r2.put_object(Bucket=app.R2_BUCKET, Key=f"{prefix}/{name}", Body=b"stale")
+    hls_dir = tmp_path / "hls"
+    hls_dir.mkdir()
+    write_hls(hls_dir, ["seg0.m4s", "seg1.m4s"], ended=True)
+
+    upload = app.HlsUpload(job_id, str(hls_dir), prefix, resumed=True)
+    assert upload.start() is None
+    url, error = upload.finish(True)
+    assert error is None and url == upload.playlist_url
+    assert object_keys(r2, f"{prefix}/") == [f"{prefix}/{name}" for name in ("index.m3u8", "init.mp4", "seg0.m4s", "seg1.m4s")]
+    assert r2.get_object(Bucket=app.R2_BUCKET, Key=f"{prefix}/seg1.m4s")["Body"].read() == b"seg1.m4s"
@@ -0,0 +1,53 @@
+"""Leases of jobs run by (possibly remote) worker processes"""
+import os
+import time
+
+import pytest
+
+import app
+
+SMALL = {"disk": app.MB, "memory": app.MB}
+
+
+def test_claim_takes_a_lease(new_job):
+    job_id = new_job(resources=SMALL)
+    app.claim_next_job()
+    job = app.get_job_from_db(job_id)
+    assert job["worker_pid"] == os.getpid() and job["worker_host"] == app.HOSTNAME
+    assert job["lease_expires_at"] == pytest.approx(time.time() + app.JOB_LEASE_SECONDS, abs=5)
+
+
+def test_renew_leases_extends_only_jobs_running_here(new_job, set_processing, monkeypatch):
+    mine = new_job(resources=SMALL)
+    other = new_job(params={"video_urls": ["https://example.com/b.mp4"]}, resources=SMALL)
+    soon = time.time() + 1
+    set_processing(mine, worker_pid=os.getpid(), worker_host=app.HOSTNAME, lease_expires_at=soon)
+    set_processing(other, worker_pid=os.getpid(), worker_host="elsewhere", lease_expires_at=soon)
+    monkeypatch.setitem(app._work_dirs, mine, app.WORK_ROOT)
+    monkeypatch.setitem(app._work_dirs, other, app.WORK_ROOT)
+
+    app.renew_leases()
+    assert app.get_job_from_db(mine)["lease_expires_at"] > soon + app.JOB_LEASE_SECONDS / 2
+    assert app.get_job_from_db(other)["lease_expires_at"] == soon
+
+
+def test_another_hosts_job_is_requeued_only_once_its_lease_lapses(new_job, set_processing):
+    job_id = new_job(resources=SMALL)
+    set_processing(job_id, worker_pid=1, worker_host="elsewhere", lease_expires_at=time.time() + 60)
+
+    app.recover_orphaned_jobs()
+    assert app.get_job_from_db(job_id)["status"] == "processing"  # Its pid means nothing on this host
+
+    with app.get_conn() as conn:
+        conn.execute("UPDATE jobs SET lease_expires_at = ? WHERE id = ?", (time.time() - 1, job_id))
+    app.recover_orphaned_jobs()
+    assert app.get_job_from_db(job_id)["status"] == "queued"
+
+
+def test_a_recycled_pid_does_not_keep_a_job_alive(new_job, set_processing):
+    job_id = new_job(resources=SMALL)
+    set_processing(job_id, worker_pid=os.getpid(), worker_host=app.HOSTNAME,
+                   started_at=app.PROCESS_STARTED_AT - 10, lease_expires_at=time.time() + 60)
+
+    app.recover_orphaned_jobs()
+    assert app.get_job_from_db(job_id)["status"] == "queued"
@@ -0,0 +1,83 @@
+"""Finished-job metrics: every path to a terminal status is counted once, under the job's endpoint"""
+import time
+from collections import Counter
+
+import pytest
+
+import app
+
+SMALL = {"disk": app.MB, "memory": app.MB}
+
+
+class FakeCounter:
+    def __init__(self):
+        self.counts = Counter()
+
+    def labels(self, *labels):
+        counts = self.counts
+
+        class Child:
+            def inc(self):
+                counts[labels] += 1
+        return Child()
+
+
+@pytest.fixture
+def finished(monkeypatch):
+    """Counts of (endpoint, status) and (endpoint, reason), with metrics enabled"""
+    jobs, failures = FakeCounter(), FakeCounter()
+    monkeypatch.setattr(app, "METRICS_ENABLED", True)
+    monkeypatch.setattr(app, "JOBS_FINISHED", jobs, raising=False)
+    monkeypatch.setattr(app, "JOB_FAILURES", failures, raising=False)
+    return jobs.counts, failures.counts
+
+
+def run(job_id, func, monkeypatch):
+    monkeypatch.setitem(app.JOB_FUNCTIONS, "logic_concat", func)
+    app.run_claimed_job(app.get_job_from_db(job_id))
+
+
+def test_jobs_run_by_a_worker_are_counted(new_job, finished, monkeypatch):
+    jobs, failures = finished
+    run(new_job(), lambda job_id, **kwargs: "https://r2.example.com/out.mp4", monkeypatch)
+
+    def fail(job_id, **kwargs):
+        raise Exception("Upload failed: boom")
+    run(new_job(params={"video_urls": ["https://example.com/b.mp4"]}), fail, monkeypatch)
+
+    assert jobs == {("concat", "completed"): 1, ("concat", "failed"): 1}
+    assert failures == {("concat", "upload"): 1}
+
+
+def test_jobs_that_never_ran_are_counted(new_job, finished):
+    jobs, failures = finished
+    app.cancel_job(new_job())
+    overdue = new_job(params={"video_urls": ["https://example.com/b.mp4"]}, deadline=time.time() + 60)
+    with app.get_conn() as conn:
+        conn.execute("UPDATE jobs SET deadline = ? WHERE id = ?", (time.time() - 1, overdue))
+    app.expire_overdue_jobs()
+
+    parent = new_job(params={"video_urls": ["https://example.com/c.mp4"]})
+    new_job(params={"video_urls": [f"job:{parent}"]}, depends_on=[parent])
+    app.update_job(parent, "failed", error="FFmpeg exited with 1")
+
+    assert jobs == {("concat", "cancelled"): 2, ("concat", "failed"): 2}
+    assert failures == {("concat", "ffmpeg"): 1, ("concat", "dependency"): 1}
+
+
+def test_recovered_and_unrunnable_jobs_are_counted(new_job, set_processing, dead_pid, finished):
+    jobs, failures = finished
+    cancelled = new_job(resources=SMALL)
+    set_processing(cancelled, worker_pid=dead_pid, worker_host=app.HOSTNAME, cancel_requested=time.time())
+    exhausted = new_job(params={"video_urls": ["https://example.com/b.mp4"]}, resources=SMALL)
+    set_processing(exhausted, worker_pid=dead_pid, worker_host=app.HOSTNAME, attempts=app.MAX_JOB_ATTEMPTS)
+    app.recover_orphaned_jobs()
+
+    app.run_claimed_job(app.get_job_from_db(new_job(job_type="logic_gone")))
+    corrupt = new_job(params={"video_urls": ["https://example.com/c.mp4"]})
+    with app.get_conn() as conn:
+        conn.execute("UPDATE jobs SET params = '{' WHERE id = ?", (corrupt,))
+    app.run_claimed_job(app.get_job_from_db(corrupt))
+
+    assert jobs == {("concat", "cancelled"): 1, ("concat", "failed"): 2, ("unknown", "failed"): 1}
+    assert failures == {("concat", "interrupted"): 1, ("concat", "other"): 1, ("unknown", "other"): 1}
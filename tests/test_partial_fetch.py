@@ -0,0 +1,27 @@
+"""Partial fetch: logic_concat trimming a remote input with Range requests instead of downloading it"""
+import pytest
+
+import app
+
+
+def test_partial_fetch_trim_reads_only_network_protocols(new_job, monkeypatch):
+    commands = []
+
+    def run_ffmpeg(cmd, **kwargs):
+        commands.append(cmd)
+        return False, "stop"
+
+    def download_file(url, local_path, job_id=None):
+        raise Exception("Full download")
+
+    monkeypatch.setattr(app, "supports_partial_fetch", lambda url: True)
+    monkeypatch.setattr(app, "run_ffmpeg", run_ffmpeg)
+    monkeypatch.setattr(app, "download_file", download_file)
+    job_id = new_job()
+    with pytest.raises(Exception, match="Full download"):
+        app.logic_concat(job_id, ["https://example.com/a.mp4"], 5)
+
+    cmd = commands[0]
+    whitelist = cmd.index("-protocol_whitelist")
+    assert cmd[whitelist + 1] == app.URL_PROBE_PROTOCOLS
+    assert whitelist < cmd.index("-i") and cmd[cmd.index("-i") + 1] == "https://example.com/a.mp4"
@@ -0,0 +1,73 @@
+"""plan_concat: how trimmed segments are joined, from their (stubbed) ffprobe streams"""
+import pytest
+
+import app
+
+H264 = {"codec_name": "h264", "profile": "High", "width": 1280, "height": 720, "pix_fmt": "yuv420p",
+        "r_frame_rate": "30/1", "time_base": "1/15360", "sample_aspect_ratio": "1:1",
+        "extradata_hash": "SHA256:aaaa"}
+AAC = {"codec_name": "aac", "profile": "LC", "sample_rate": "48000", "channels": 2, "channel_layout": "stereo",
+       "extradata_hash": "SHA256:1111"}
+
+
+@pytest.fixture
+def segments(monkeypatch):
+    """Stubs probe_streams with the given (video, audio) per segment; returns the segment paths"""
+    def make(*streams):
+        paths = [f"trimmed_{i}.mp4" for i in range(len(streams))]
+        probes = dict(zip(paths, streams))
+        monkeypatch.setattr(app, "probe_streams", probes.__getitem__)
+        return paths
+    return make
+
+
+def test_identical_segments_are_stream_copied(segments):
+    paths = segments((H264, AAC), (dict(H264), dict(AAC)), (H264, AAC))
+    assert app.plan_concat(paths) == ("copy", (H264, AAC), [])
+
+
+def test_same_parameters_but_different_codec_headers_join_as_mpegts(segments):
+    other_sps = {**H264, "extradata_hash": "SHA256:bbbb"}
+    assert app.plan_concat(segments((H264, AAC), (other_sps, AAC)))[0] == "annexb"
+    other_asc = {**AAC, "extradata_hash": "SHA256:2222"}
+    assert app.plan_concat(segments((H264, AAC), (H264, other_asc)))[0] == "annexb"
+
+
+def test_unknown_codec_headers_are_not_trusted_to_match(segments):
+    no_hash = {key: value for key, value in H264.items() if key != "extradata_hash"}
+    assert app.plan_concat(segments((no_hash, AAC), (no_hash, AAC)))[0] == "annexb"
+
+
+def test_odd_segment_out_is_normalized_to_the_majority(segments):
+    small = {**H264, "width": 640, "height": 360}
+    path, reference, indexes = app.plan_concat(segments((H264, AAC), (small, AAC), (H264, AAC)))
+    assert (path, reference, indexes) == ("normalize", (H264, AAC), [1])
+
+
+def test_segments_without_audio_are_stream_copied_together(segments):
+    assert app.plan_concat(segments((H264, None), (H264, None)))[0] == "copy"
+
+
+@pytest.mark.parametrize("streams", [
+    # Audio on some segments only: a copy can't line the tracks up
+    [(H264, AAC), (H264, None), (H264, AAC)],
+    # The majority isn't something libx264/aac reproduce
+    [({**H264, "codec_name": "hevc"}, AAC), ({**H264, "codec_name": "hevc"}, AAC), (H264, AAC)],
+    [({**H264, "pix_fmt": "yuv420p10le"}, AAC), ({**H264, "pix_fmt": "yuv420p10le"}, AAC)],
+    [(H264, {**AAC, "codec_name": "opus"}), (H264, {**AAC, "codec_name": "opus"})],
+    # A segment without video
+    [(H264, AAC), (None, AAC)],
+])
+def test_mismatches_that_cannot_be_fixed_per_segment_reencode(segments, streams):
+    assert app.plan_concat(segments(*streams))[0] == "reencode"
+
+
+def test_failed_probe_reencodes(segments):
+    assert app.plan_concat(segments((H264, AAC), None)) == ("reencode", None, [])
+
+
+def test_explicit_profile_reencodes_without_probing(monkeypatch):
+    def probe_streams(path):
+        raise AssertionError("probed")
+    monkeypatch.setattr(app, "probe_streams", probe_streams)
+    assert app.plan_concat(["trimmed_0.mp4", "trimmed_1.mp4"], profile="fast") == ("reencode", None, [])
@@ -0,0 +1,85 @@
+"""upload_to_r2 and StreamingUpload against a moto S3 server"""
+import os
+import time
+
+import pytest
+
+import app
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def fast_polls(monkeypatch):
+    monkeypatch.setattr(app, "R2_MULTIPART_CHUNKSIZE", 5 * MB)  # S3's smallest part
+    monkeypatch.setattr(app.StreamingUpload, "POLL_INTERVAL", 0.05)
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+def object_keys(client, prefix=""):
+    response = client.list_objects_v2(Bucket=app.R2_BUCKET, Prefix=prefix)
+    return sorted(obj["Key"] for obj in response.get("Contents", []))
+
+
+def test_upload_to_r2_sends_large_files_in_parts(r2, fast_polls, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "R2_MULTIPART_THRESHOLD", 5 * app.MB)
+    path = tmp_path / "out.mp4"
+    data = os.urandom(11 * MB)
+    path.write_bytes(data)
+
+    url, error = app.upload_to_r2(str(path), "whole.mp4", content_type="video/mp4")
+    assert error is None and url == "https://r2.example.com/whole.mp4"
+    head = r2.head_object(Bucket=app.R2_BUCKET, Key="whole.mp4")
+    assert head["ContentType"] == "video/mp4"
+    assert head["ETag"].endswith('-3"')  # Multipart: three parts
+    assert r2.get_object(Bucket=app.R2_BUCKET, Key="whole.mp4")["Body"].read() == data
+
+
+def test_one_client_is_shared(r2):
+    assert app.get_s3_client() is r2
+
+
+def test_streaming_upload_sends_parts_while_the_file_grows(r2, fast_polls, tmp_path):
+    path = tmp_path / "out.mp4"
+    first, rest = os.urandom(6 * MB), os.urandom(3 * MB)
+    path.write_bytes(first)
+
+    upload = app.StreamingUpload(str(path), "stream.mp4")
+    assert upload.start() is None
+    # A full part is sent before the "encode" finishes; the 1MB remainder waits for more data
+    wait_until(lambda: len(upload.parts) == 1)
+    assert upload.offset == 5 * MB
+    with open(path, "ab") as f:
+        f.write(rest)
+
+    url, error = upload.finish(True)
+    assert error is None
+    assert url == "https://r2.example.com/stream.mp4"
+    assert [part["PartNumber"] for part in upload.parts] == [1, 2]
+    body = r2.get_object(Bucket=app.R2_BUCKET, Key="stream.mp4")["Body"].read()
+    assert body == first + rest
+
+
+def test_streaming_upload_aborts_a_failed_encode(r2, fast_polls, tmp_path):
+    path = tmp_path / "out.mp4"
+    path.write_bytes(os.urandom(6 * MB))
+
+    upload = app.StreamingUpload(str(path), "failed.mp4")
+    assert upload.start() is None
+    wait_until(lambda: upload.parts)
+
+    url, error = upload.finish(False)
+    assert url is None and error == "Encode failed"
+    assert object_keys(r2) == []
+    assert not r2.list_multipart_uploads(Bucket=app.R2_BUCKET).get("Uploads")
+
+
+def test_streaming_upload_needs_r2_configuration(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "R2_BUCKET", None)
+    assert app.StreamingUpload(str(tmp_path / "out.mp4"), "out.mp4").start() == "R2 configuration missing"
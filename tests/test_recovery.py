@@ -0,0 +1,48 @@
+"""Crash recovery: requeueing jobs whose worker process died"""
+import json
+import os
+import time
+
+import app
+
+SMALL = {"disk": app.MB, "memory": app.MB}
+
+
+def test_recovery_requeues_a_job_whose_worker_died(new_job, set_processing, dead_pid):
+    job_id = new_job(resources=SMALL)
+    set_processing(job_id, worker_pid=dead_pid, worker_host=app.HOSTNAME,
+                   lease_expires_at=time.time() + 60, progress=json.dumps({"percent": 50}))
+
+    app.recover_orphaned_jobs()
+    job = app.get_job_from_db(job_id)
+    assert job["status"] == "queued"
+    assert job["worker_pid"] is None and job["lease_expires_at"] is None and job["progress"] is None
+    assert app.claim_next_job()["id"] == job_id
+    assert app.get_job_from_db(job_id)["attempts"] == 2
+
+
+def test_recovery_leaves_a_live_workers_job_alone(new_job, set_processing):
+    job_id = new_job(resources=SMALL)
+    set_processing(job_id, worker_pid=os.getpid(), worker_host=app.HOSTNAME, lease_expires_at=time.time() + 60)
+
+    app.recover_orphaned_jobs()
+    assert app.get_job_from_db(job_id)["status"] == "processing"
+
+
+def test_recovery_gives_up_after_max_attempts(new_job, set_processing, dead_pid):
+    job_id = new_job(resources=SMALL)
+    set_processing(job_id, worker_pid=dead_pid, worker_host=app.HOSTNAME, attempts=app.MAX_JOB_ATTEMPTS)
+
+    app.recover_orphaned_jobs()
+    job = app.get_job_from_db(job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == f"Interrupted {app.MAX_JOB_ATTEMPTS} times, giving up"
+
+
+def test_checkpoints_survive_a_requeue(new_job, set_processing, dead_pid):
+    job_id = new_job(resources=SMALL)
+    set_processing(job_id, worker_pid=dead_pid, worker_host=app.HOSTNAME)
+    app.save_checkpoint(job_id, "trimmed_0", ["/tmp/trimmed_0.mp4"])
+
+    app.recover_orphaned_jobs()
+    assert app.load_checkpoint(job_id)["trimmed_0"] == ["/tmp/trimmed_0.mp4"]
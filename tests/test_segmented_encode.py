@@ -0,0 +1,81 @@
+"""Segmented subtitle burn-in against a single pass, with a real ffmpeg (skipped without one)"""
+import shutil
+import subprocess
+
+import pytest
+
+import app
+
+av = pytest.importorskip("av")
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None,
+                                reason="needs ffmpeg and ffprobe")
+
+SUBTITLES = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 320
+PlayResY: 240
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, Bold, Italic, Alignment, MarginL, MarginR, MarginV
+Style: Default,Arial,24,&H00FFFFFF,0,0,2,10,10,10
+
+[Events]
+Format: Layer, Start, End, Style, Text
+Dialogue: 0,0:00:01.00,0:00:05.00,Default,Hello
+"""
+
+
+@pytest.fixture(scope="module")
+def source(tmp_path_factory):
+    """6s of 25fps video with a keyframe every second, and audio"""
+    path = tmp_path_factory.mktemp("source") / "source.mp4"
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=25:duration=6",
+                    "-f", "lavfi", "-i", "sine=duration=6", "-c:v", "libx264", "-g", "25", "-c:a", "aac",
+                    "-shortest", str(path)], check=True)
+    return path
+
+
+@pytest.fixture
+def burn(source, new_job, monkeypatch):
+    """Runs logic_add_subtitles on the source as an intermediate job; returns its output file"""
+    monkeypatch.setattr(app, "download_file", lambda url, local_path, job_id=None: shutil.copy(source, local_path))
+    monkeypatch.setattr(app, "SEGMENT_MIN_DURATION", 1)
+
+    def run(parallelism):
+        monkeypatch.setattr(app, "SEGMENT_PARALLELISM", parallelism)
+        job_id = new_job("logic_add_subtitles", {"video_url": "https://example.com/v.mp4"}, intermediate=True)
+        assert app.logic_add_subtitles(job_id, "https://example.com/v.mp4", SUBTITLES, "ass") == f"job:{job_id}"
+        return job_id, app.get_job_from_db(job_id)["artifact"]
+    return run
+
+
+def frames_and_duration(path):
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        frames = sum(1 for packet in container.demux(stream) if packet.size)
+        return frames, float(stream.duration * stream.time_base)
+
+
+def test_segmented_output_matches_a_single_pass(burn):
+    _, single = burn(1)
+    job_id, segmented = burn(3)
+    assert app.pop_job_stats(job_id)["encode"]["segments"] > 1
+    frames, duration = frames_and_duration(segmented)
+    expected_frames, expected_duration = frames_and_duration(single)
+    assert frames == expected_frames == 150
+    assert duration == pytest.approx(expected_duration, abs=1 / 25)
+
+
+def test_segments_that_differ_fall_back_to_a_single_pass(burn, monkeypatch):
+    _, single = burn(1)
+    probe_streams = app.probe_streams
+
+    def differing(path):
+        video, audio = probe_streams(path)
+        return ({**video, "width": 640}, audio) if path.endswith("encoded_001.mp4") else (video, audio)
+    monkeypatch.setattr(app, "probe_streams", differing)
+
+    job_id, fallback = burn(3)
+    stats = app.pop_job_stats(job_id)["encode"]
+    assert stats["segments_discarded"] > 1 and "segments" not in stats
+    assert frames_and_duration(fallback)[0] == frames_and_duration(single)[0]
@@ -0,0 +1,19 @@
+"""Striped per-URL fetch locks of the download and audio asset caches"""
+import os
+
+import app
+
+
+def test_lock_files_stay_within_the_stripes():
+    for n in range(500):
+        with app._url_lock(f"https://example.com/{n}.mp4"):
+            pass
+    names = os.listdir(os.path.join(app.DOWNLOAD_CACHE_DIR, "locks"))
+    assert len(names) <= app.URL_LOCK_STRIPES
+    assert all(name.startswith("download-") for name in names)
+
+
+def test_audio_lock_then_download_lock_on_the_same_stripe():
+    # fetch_audio_asset downloads while holding its asset's lock; equal names mean equal stripes
+    with app._url_lock("same", "audio"), app._url_lock("same"):
+        pass